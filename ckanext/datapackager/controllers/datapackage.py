@@ -1,8 +1,17 @@
+import calendar
+import email.utils
 import json
+import os
+import re
+
+import six
 
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
-from flask import make_response
+import ckanext.datapackager.lib.archive_cache as archive_cache
+import ckanext.datapackager.lib.bulk_export as bulk_export
+import ckanext.datapackager.lib.util as util
+from flask import make_response, Response, stream_with_context
 
 def _authorize_or_abort(context):
     try:
@@ -59,6 +68,17 @@ def import_datapackage():
             params,
         )
 
+        if toolkit.asbool(params.get('background', False)):
+            # The dataset is being imported by a background job, so what we
+            # got back is the job's status.
+            if toolkit.check_ckan_version(min_version="2.9"):
+                return toolkit.redirect_to(
+                    'datapackager.import_datapackage_status',
+                    job_id=dataset['id'])
+            else:
+                return toolkit.redirect_to(
+                    'import_datapackage_status', job_id=dataset['id'])
+
         if toolkit.check_ckan_version(min_version="2.9"):
             return toolkit.redirect_to('dataset.read', id=dataset['name'])
         else:
@@ -71,8 +91,8 @@ def import_datapackage():
                         errors=errors,
                         error_summary=error_summary)
 
-def export_datapackage(package_id):
-    '''Return the given dataset as a Data Package JSON file.
+def import_datapackage_status(job_id):
+    '''Return the status of a background Data Package import as JSON.
 
     '''
     context = {
@@ -81,24 +101,499 @@ def export_datapackage(package_id):
         'user': toolkit.c.user,
     }
 
+    try:
+        status = toolkit.get_action(
+            'package_create_from_datapackage_status')(
+            context,
+            {'id': job_id}
+        )
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, toolkit._('Import job not found'))
+    except toolkit.NotAuthorized:
+        return toolkit.abort(
+            401, toolkit._('Unauthorized to see this import job'))
+
     r = make_response() if toolkit.check_ckan_version(min_version="2.9") else toolkit.response
-    r.content_disposition = 'attachment; filename=datapackage.json'.format(
-        package_id)
     r.content_type = 'application/json'
+
+    if toolkit.check_ckan_version(min_version="2.9"):
+        r.data = json.dumps(status)
+        return r
+    else:
+        return json.dumps(status)
+
+
+def _json_response(data, status=200):
+    if toolkit.check_ckan_version(min_version="2.9"):
+        r = make_response(json.dumps(data), status)
+        r.content_type = 'application/json'
+        return r
+    else:
+        toolkit.response.status_int = status
+        toolkit.response.content_type = 'application/json'
+        return json.dumps(data)
+
+
+def _request_params():
+    if toolkit.check_ckan_version(min_version="2.9"):
+        params = toolkit.request.args.to_dict()
+        params.update(toolkit.request.form.to_dict())
+        return params
+    else:
+        return dict(toolkit.request.params)
+
+
+def _query_params():
+    if toolkit.check_ckan_version(min_version="2.9"):
+        return toolkit.request.args.to_dict()
+    else:
+        return dict(toolkit.request.GET)
+
+
+def _call_upload_action(action, data_dict, status=200):
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': toolkit.c.user,
+    }
+    try:
+        result = toolkit.get_action(action)(context, data_dict)
+    except toolkit.ValidationError as e:
+        return _json_response({'error': e.error_dict}, 400)
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, toolkit._('Upload not found'))
+    except toolkit.NotAuthorized:
+        return toolkit.abort(401, toolkit._('Unauthorized to use this upload'))
+    return _json_response(result, status)
+
+
+def upload_init():
+    '''Start a resumable, chunked upload of a Data Package.
+
+    '''
+    return _call_upload_action(
+        'datapackage_upload_init', _request_params(), status=201)
+
+
+def upload_show(upload_id):
+    '''Return how much of a chunked upload has been received, as JSON.
+
+    '''
+    return _call_upload_action('datapackage_upload_show', {'id': upload_id})
+
+
+def upload_chunk(upload_id):
+    '''Write the request's body as a chunk of a chunked upload.
+
+    The chunk's offset is taken from the ``offset`` query string parameter,
+    or from the start of a ``Content-Range: bytes START-END/TOTAL`` header.
+    The body is never parsed as a form, so it's read straight from the
+    request, whatever its content type.
+
+    '''
+    offset = _query_params().get('offset')
+    match = re.match(r'bytes (\d+)-',
+                     toolkit.request.headers.get('Content-Range', ''))
+    if offset is None and match:
+        offset = match.group(1)
+
+    if toolkit.check_ckan_version(min_version="2.9"):
+        body = toolkit.request.stream
+    else:
+        from ckanext.datapackager.logic.action.create import (
+            _UploadLocalFileStorage)
+        body = _UploadLocalFileStorage(toolkit.request.body_file, 'chunk')
+
+    return _call_upload_action('datapackage_upload_chunk', {
+        'id': upload_id,
+        'offset': offset,
+        'upload': body,
+    })
+
+
+def upload_finalize(upload_id):
+    '''Import the Data Package sent in a chunked upload.
+
+    Returns the new dataset, or the status of the background job importing
+    it, as JSON.
+
+    '''
+    data_dict = _request_params()
+    data_dict['id'] = upload_id
+    return _call_upload_action('datapackage_upload_finalize', data_dict)
+
+
+def export_datapackage(package_id):
+    '''Return the given dataset as a Data Package JSON file.
+
+    The response has an ``ETag`` and a ``Last-Modified`` header, taken from
+    the dataset's ``metadata_modified``, and requests that send them back in
+    an ``If-None-Match`` or ``If-Modified-Since`` header get a ``304 Not
+    Modified`` without the dataset being converted, if it hasn't changed.
+
+    The JSON is streamed as it's encoded, compressed with gzip or brotli if
+    the client accepts it, and without indentation if the ``pretty``
+    parameter is false.
+
+    '''
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': toolkit.c.user,
+    }
+    pkg = _get_package_or_abort(context, package_id)
+
+    try:
+        pretty = toolkit.asbool(_request_params().get('pretty', True))
+    except ValueError:
+        return toolkit.abort(
+            400, toolkit._('Invalid value for the pretty parameter'))
+    encoding = _negotiate_encoding(
+        toolkit.request.headers.get('Accept-Encoding'))
+
+    headers = _export_validators(
+        pkg, variant=u'{0}|{1}'.format(pretty, encoding))
+    headers['Vary'] = 'Accept-Encoding'
+    if _not_modified(headers):
+        return _response('', 304, headers)
+
     try:
         datapackage_dict = toolkit.get_action(
             'package_show_as_datapackage')(
             context,
-            {'id': package_id}
+            {'id': pkg.id}
         )
     except toolkit.ObjectNotFound:
-        return toolkit.abort(404, 'Dataset not found')
+        return toolkit.abort(404, toolkit._('Dataset not found'))
+
+    headers['Content-Type'] = 'application/json'
+    headers['Content-Disposition'] = 'attachment; filename=datapackage.json'
+    body = util.iter_json(datapackage_dict, indent=2 if pretty else None)
+    if encoding:
+        headers['Content-Encoding'] = encoding
+        body = util.compress_chunks(body, encoding)
+    return _response(body, 200, headers)
+
+
+def export_datapackage_zip(package_id):
+    '''Return the given dataset as a zipped Data Package, with the files of
+    its uploaded resources.
+
+    The archive is generated as it's sent, reading the files straight from
+    the FileStore, and the resources' paths point to them inside it. It's
+    cached by clients like :py:func:`export_datapackage`.
+
+    If archives are cached on disk, the cached one is sent instead (and
+    built in the background if it isn't yet). It can be downloaded in
+    ``Range`` requests, or sent by the web server itself.
+
+    '''
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': toolkit.c.user,
+    }
+    pkg = _get_package_or_abort(context, package_id)
+
+    headers = _export_validators(pkg, variant=archive_cache.zip_variant())
+    if _not_modified(headers):
+        return _response('', 304, headers)
+    headers['Content-Type'] = 'application/zip'
+    headers['Content-Disposition'] = 'attachment; filename=datapackage.zip'
+
+    cache = archive_cache.get_cache()
+    if cache is not None and pkg.metadata_modified is not None:
+        version = archive_cache.zip_version(pkg)
+        path = cache.get(pkg.id, version)
+        if path:
+            return _send_file(path, headers, cache.directory)
+        if cache.claim(pkg.id, version) and \
+                not archive_cache.enqueue_build(pkg.id):
+            cache.release(pkg.id, version)
+
+    try:
+        body = archive_cache.stream_datapackage_zip(context, pkg)
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, toolkit._('Dataset not found'))
+    return _response(body, 200, headers)
+
+
+def _send_file(path, headers, directory):
+    '''Return a response with the file at ``path``, or the part of it asked
+    for in the request's ``Range`` header.
+
+    If ``ckanext.datapackager.archive_sendfile`` is set, the file is left for
+    the web server to send (which also deals with ranges), with an
+    ``X-Sendfile`` or an ``X-Accel-Redirect`` header (with its path
+    relative to ``directory``).
+
+    '''
+    headers['Accept-Ranges'] = 'bytes'
+
+    sendfile = (toolkit.config.get(
+        'ckanext.datapackager.archive_sendfile') or '').lower()
+    if sendfile == 'x-sendfile':
+        headers['X-Sendfile'] = path
+        return _response('', 200, headers)
+    elif sendfile == 'x-accel-redirect':
+        location = toolkit.config.get(
+            'ckanext.datapackager.archive_accel_redirect_location',
+            '/datapackager-archives/')
+        headers['X-Accel-Redirect'] = '{0}/{1}'.format(
+            location.rstrip('/'),
+            os.path.relpath(path, directory).replace(os.sep, '/'))
+        return _response('', 200, headers)
+
+    size = os.path.getsize(path)
+    try:
+        byte_range = _requested_range(size, headers)
+    except ValueError:
+        headers['Content-Range'] = 'bytes */{0}'.format(size)
+        return _response('', 416, headers)
+
+    if byte_range is None:
+        start, end, status = 0, size - 1, 200
+    else:
+        start, end = byte_range
+        status = 206
+        headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+            start, end, size)
+    headers['Content-Length'] = str(end - start + 1)
+    return _response(_read_range(path, start, end), status, headers)
+
+
+def _requested_range(size, headers):
+    '''Return the ``(first, last)`` bytes of a file of ``size`` bytes asked
+    for in the request's ``Range`` header, or ``None`` to send all of it.
+
+    Only single ranges are supported, requests for more than one get the
+    whole file.
+
+    :raises ValueError: if the range can't be satisfied
+
+    '''
+    match = re.match(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$',
+                     toolkit.request.headers.get('Range') or '')
+    if not match or not any(match.groups()):
+        return None
+
+    if_range = toolkit.request.headers.get('If-Range')
+    if if_range and if_range not in (headers.get('ETag'),
+                                     headers.get('Last-Modified')):
+        # The file changed since the client got the first part of it
+        return None
+
+    first, last = match.groups()
+    if not first:
+        # The last N bytes
+        first, last = max(size - int(last), 0), size - 1
+    else:
+        first = int(first)
+        last = min(int(last), size - 1) if last else size - 1
+    if first >= size or first > last:
+        raise ValueError('Unsatisfiable range')
+    return first, last
+
+
+def _read_range(path, start, end, chunk_size=util.DEFAULT_CHUNK_SIZE):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def export_organization_datapackages(id):
+    '''Return the Data Packages of an organization's datasets.
+
+    See :py:func:`export_group_datapackages`.
+
+    '''
+    return _export_group_datapackages(id, is_organization=True)
+
+
+def export_group_datapackages(id):
+    '''Return the Data Packages of a group's datasets, as newline-delimited
+    JSON, or as a tar archive of their descriptors if the ``format``
+    parameter is ``tar``.
+
+    The datasets are sent ``limit`` at a time, starting after the dataset
+    whose id is the ``cursor`` parameter, and a ``Link`` header points to the
+    next page, if there is one.
+
+    '''
+    return _export_group_datapackages(id, is_organization=False)
+
+
+def _export_group_datapackages(group_id, is_organization):
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': toolkit.c.user,
+        'auth_user_obj': toolkit.c.userobj,
+    }
+    action = 'organization_show' if is_organization else 'group_show'
+    try:
+        group_dict = toolkit.get_action(action)(dict(context), {
+            'id': group_id,
+            'include_datasets': False,
+            'include_users': False,
+            'include_groups': False,
+            'include_extras': False,
+            'include_tags': False,
+            'include_followers': False,
+        })
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, toolkit._('Group not found'))
+    except toolkit.NotAuthorized:
+        return toolkit.abort(401, toolkit._('Unauthorized to read this group'))
+
+    params = _request_params()
+    format_ = params.get('format') or 'ndjson'
+    if format_ not in ('ndjson', 'tar'):
+        return toolkit.abort(
+            400, toolkit._('The format must be ndjson or tar'))
+    max_limit = toolkit.asint(toolkit.config.get(
+        'ckanext.datapackager.bulk_export_page_size', 1000))
+    try:
+        limit = min(int(params.get('limit') or max_limit), max_limit)
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        return toolkit.abort(
+            400, toolkit._('The limit must be a positive integer'))
+
+    if is_organization:
+        fq = u'+owner_org:"{0}"'.format(group_dict['id'])
+    else:
+        fq = u'+groups:"{0}"'.format(group_dict['name'])
+    ids, next_cursor = bulk_export.page(
+        context, fq, cursor=params.get('cursor'), limit=limit)
+
+    headers = {}
+    if next_cursor:
+        next_params = dict(params, cursor=next_cursor)
+        headers['Link'] = '<{0}?{1}>; rel="next"'.format(
+            toolkit.request.path, six.moves.urllib.parse.urlencode(
+                sorted(next_params.items())))
+
+    datapackages = bulk_export.iter_datapackages(
+        context, ids, batch_size=toolkit.asint(toolkit.config.get(
+            'ckanext.datapackager.bulk_export_batch_size', 100)))
+    if format_ == 'tar':
+        headers['Content-Type'] = 'application/x-tar'
+        headers['Content-Disposition'] = \
+            'attachment; filename={0}-datapackages.tar'.format(
+                group_dict['name'])
+        body = bulk_export.iter_tar(datapackages)
+    else:
+        headers['Content-Type'] = 'application/x-ndjson'
+        body = bulk_export.iter_ndjson(datapackages)
+    if toolkit.check_ckan_version(min_version="2.9"):
+        # The datasets are looked up as the response is sent
+        body = stream_with_context(body)
+    return _response(body, 200, headers)
+
+
+def _get_package_or_abort(context, package_id):
+    pkg = model.Package.get(package_id)
+    if pkg is None:
+        return toolkit.abort(404, toolkit._('Dataset not found'))
+    try:
+        toolkit.check_access('package_show', context, {'id': pkg.id})
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, toolkit._('Dataset not found'))
+    except toolkit.NotAuthorized:
+        return toolkit.abort(
+            401, toolkit._('Unauthorized to read this dataset'))
+    return pkg
+
+
+def _export_validators(pkg, variant=u''):
+    '''Return the ``ETag``, ``Last-Modified`` and ``Cache-Control`` headers
+    of the Data Package of ``pkg``.
+
+    The ETag is the dataset's :py:func:`~ckanext.datapackager.lib.util.export_version`
+    for the ``variant`` (e.g. encoding) of the response.
+
+    '''
+    headers = {
+        'Cache-Control': 'private, no-cache' if pkg.private else 'no-cache',
+    }
+    if pkg.metadata_modified is None:
+        return headers
+    headers['ETag'] = '"{0}"'.format(
+        util.export_version(pkg.id, pkg.metadata_modified, variant))
+    headers['Last-Modified'] = email.utils.formatdate(
+        calendar.timegm(pkg.metadata_modified.utctimetuple()), usegmt=True)
+    return headers
+
+
+def _not_modified(headers):
+    '''Return whether the request's conditional headers match ``headers``,
+    so that a ``304 Not Modified`` can be sent instead of the response.
+
+    '''
+    if 'ETag' not in headers:
+        return False
+
+    if_none_match = toolkit.request.headers.get('If-None-Match')
+    if if_none_match:
+        # If-Modified-Since is ignored when If-None-Match is sent
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or headers['ETag'] in tags or \
+            'W/' + headers['ETag'] in tags
+
+    if_modified_since = email.utils.parsedate_tz(
+        toolkit.request.headers.get('If-Modified-Since') or '')
+    if if_modified_since is None:
+        return False
+    last_modified = email.utils.mktime_tz(
+        email.utils.parsedate_tz(headers['Last-Modified']))
+    return last_modified <= email.utils.mktime_tz(if_modified_since)
+
+
+def _negotiate_encoding(accept_encoding):
+    '''Return the best ``Content-Encoding`` for a response, given the
+    request's ``Accept-Encoding`` header, or ``None`` to not compress it.
+
+    '''
+    qualities = {}
+    for item in (accept_encoding or '').split(','):
+        parts = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if parts[0]:
+            qualities[parts[0].lower()] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in util.content_encodings():
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
 
+def _response(body, status=200, headers=None):
     if toolkit.check_ckan_version(min_version="2.9"):
-        r.data = json.dumps(datapackage_dict, indent=2)
+        r = Response(body, status)
+        for key, value in (headers or {}).items():
+            r.headers[key] = value
         return r
     else:
-        return json.dumps(datapackage_dict, indent=2)
+        toolkit.response.status_int = status
+        for key, value in (headers or {}).items():
+            toolkit.response.headers[key] = value
+        return body
 
 
 if not toolkit.check_ckan_version(u'2.9'):
@@ -107,7 +602,23 @@ if not toolkit.check_ckan_version(u'2.9'):
             return new(data, errors, error_summary)
         def import_datapackage(self):
             return import_datapackage()
+        def import_datapackage_status(self, job_id):
+            return import_datapackage_status(job_id)
+        def upload_init(self):
+            return upload_init()
+        def upload_show(self, upload_id):
+            return upload_show(upload_id)
+        def upload_chunk(self, upload_id):
+            return upload_chunk(upload_id)
+        def upload_finalize(self, upload_id):
+            return upload_finalize(upload_id)
         def export_datapackage(self, package_id):
             return export_datapackage(package_id)
+        def export_datapackage_zip(self, package_id):
+            return export_datapackage_zip(package_id)
+        def export_organization_datapackages(self, id):
+            return export_organization_datapackages(id)
+        def export_group_datapackages(self, id):
+            return export_group_datapackages(id)
 
 
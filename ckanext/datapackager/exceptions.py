@@ -25,3 +25,38 @@ class CouldNotReadCSVException(Exception):
 
     '''
     pass
+
+
+class InvalidZipArchiveException(Exception):
+    '''The exception that's raised when a zipped Data Package can't be read,
+    e.g. if it doesn't have exactly one datapackage.json file, if one of its
+    resources' files isn't in the archive or if its contents are too large.
+
+    '''
+    pass
+
+
+class CouldNotFetchException(Exception):
+    '''The exception that's raised when downloading a remote Data Package
+    fails, e.g. if the server can't be reached, it takes too long to answer
+    or the file is too large.
+
+    '''
+    pass
+
+
+class UploadNotFoundException(Exception):
+    '''The exception that's raised when a chunked upload doesn't exist, e.g.
+    because it has already been imported or it has expired.
+
+    '''
+    pass
+
+
+class InvalidUploadChunkException(Exception):
+    '''The exception that's raised when a chunk of a chunked upload can't be
+    written, e.g. because it doesn't start where the upload ends or it makes
+    the upload too large.
+
+    '''
+    pass
@@ -0,0 +1,143 @@
+'''Background jobs used by this extension.
+
+'''
+import os
+import shutil
+
+import rq
+
+import ckan.plugins.toolkit as toolkit
+
+
+def import_datapackage(user, data_dict):
+    '''Create a dataset from a Data Package, as a background job.
+
+    This is what ``package_create_from_datapackage`` enqueues when it's called
+    with ``background=True``. ``data_dict`` holds the same parameters, except
+    that an uploaded Data Package is passed as the ``upload_path`` where it was
+    spooled to disk. That file is deleted once the import is done.
+
+    :returns: the id of the new dataset
+    :rtype: string
+
+    '''
+    context = {
+        'user': user,
+        'datapackager_progress': _report_progress,
+    }
+    upload_path = data_dict.pop('upload_path', None)
+
+    _report_progress('loading')
+    try:
+        if upload_path:
+            with open(upload_path, 'rb') as f:
+                data_dict['upload'] = _as_upload(f)
+                dataset = toolkit.get_action(
+                    'package_create_from_datapackage')(context, data_dict)
+        else:
+            dataset = toolkit.get_action(
+                'package_create_from_datapackage')(context, data_dict)
+    except toolkit.ValidationError as e:
+        _update_meta(error=e.error_summary)
+        raise
+    finally:
+        if upload_path:
+            shutil.rmtree(os.path.dirname(upload_path), ignore_errors=True)
+
+    _update_meta(dataset_id=dataset['id'])
+    return dataset['id']
+
+
+def build_datapackage_archive(dataset_id):
+    '''Build and cache the zip archive of a dataset's Data Package, as a
+    background job.
+
+    This is enqueued when the dataset or its resources change, and when its
+    archive is downloaded but isn't cached. Nothing is done if the archive of
+    the dataset's current version is cached already.
+
+    :returns: the path of the archive, or ``None`` if it wasn't cached
+    :rtype: string
+
+    '''
+    import ckan.model as model
+    import ckanext.datapackager.lib.archive_cache as archive_cache
+
+    cache = archive_cache.get_cache()
+    if cache is None:
+        return None
+
+    pkg = model.Package.get(dataset_id)
+    if pkg is None or pkg.state == 'deleted':
+        cache.remove(dataset_id)
+        return None
+
+    version = archive_cache.zip_version(pkg)
+    path = cache.get(pkg.id, version)
+    if path:
+        return path
+
+    site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': site_user['name'],
+        'ignore_auth': True,
+    }
+    return cache.build(pkg.id, version,
+                       archive_cache.stream_datapackage_zip(context, pkg))
+
+
+def job_status(job):
+    '''Return the status of a Data Package import job as a dict.
+
+    :param job: the job, as enqueued by ``package_create_from_datapackage``
+    :type job: rq.job.Job
+
+    '''
+    # Newer versions of RQ return an enum instead of a string.
+    status = getattr(job.get_status(), 'value', job.get_status())
+    meta = job.meta or {}
+    result = {
+        'id': job.id,
+        'status': status,
+        'progress': meta.get('progress'),
+        'dataset_id': meta.get('dataset_id'),
+        'error': None,
+    }
+    if status == 'failed':
+        result['error'] = meta.get('error') or {
+            'datapackage': toolkit._('The import failed unexpectedly')}
+    return result
+
+
+def job_user(job):
+    '''Return the name of the user that enqueued a Data Package import job.
+
+    '''
+    return job.args[0] if job.args else None
+
+
+def _as_upload(f):
+    if toolkit.check_ckan_version(min_version='2.9'):
+        return f
+    else:
+        from ckanext.datapackager.logic.action.create import (
+            _UploadLocalFileStorage)
+        return _UploadLocalFileStorage(f)
+
+
+def _report_progress(stage, done=None, total=None):
+    _update_meta(progress={'stage': stage, 'done': done, 'total': total})
+
+
+def _update_meta(**kwargs):
+    job = rq.get_current_job()
+    if job is None:
+        return
+
+    job.meta.update(kwargs)
+    if hasattr(job, 'save_meta'):
+        job.save_meta()
+    else:
+        job.save()
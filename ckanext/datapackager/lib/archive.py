@@ -0,0 +1,432 @@
+'''Reading and writing Data Packages as zip archives.
+
+'''
+import copy
+import json
+import os
+import posixpath
+import re
+import struct
+import zipfile
+import zlib
+
+import six
+
+import ckanext.datapackager.exceptions as exceptions
+
+
+DESCRIPTOR_NAME = 'datapackage.json'
+
+# What zipfile and zlib raise when reading a corrupt or truncated archive
+_CORRUPT_ARCHIVE_ERRORS = (
+    zipfile.BadZipfile, zipfile.LargeZipFile, zlib.error, EOFError)
+
+
+def is_zip_archive(path):
+    '''Return whether ``path`` is the path to a zip archive on disk.
+
+    '''
+    return os.path.isfile(path) and zipfile.is_zipfile(path)
+
+
+class ZippedDataPackage(object):
+    '''A Data Package inside a zip archive on disk.
+
+    Nothing is extracted up front. The descriptor and the resources' files are
+    decompressed as they're read, straight from the archive.
+
+    The sizes of the archive's members are checked when it's opened, so that
+    it's rejected before anything is read from it if any member is bigger than
+    ``max_member_size`` bytes, or all of them together are bigger than
+    ``max_total_size`` bytes (either limit can be ``None``).
+
+    :raises ckanext.datapackager.exceptions.InvalidZipArchiveException:
+        If the archive doesn't have exactly one ``datapackage.json`` file, if
+        its contents are too large, or if it's corrupt (which may only be
+        found out once its members are read)
+
+    '''
+
+    def __init__(self, path, max_member_size=None, max_total_size=None):
+        self.path = path
+        try:
+            self._zip = zipfile.ZipFile(path)
+        except _CORRUPT_ARCHIVE_ERRORS as e:
+            raise _corrupt_archive(e)
+        try:
+            self._check_sizes(max_member_size, max_total_size)
+            self._descriptor_info = self._find_descriptor()
+        except Exception:
+            self._zip.close()
+            raise
+        self._base_path = posixpath.dirname(self._descriptor_info.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._zip.close()
+
+    def descriptor(self, max_size=None, object_pairs_hook=None):
+        '''Return the Data Package's descriptor as a dict.
+
+        Resources' ``schema`` and ``dialect`` properties that point to other
+        JSON files in the archive are replaced by those files' contents.
+
+        :param max_size: the maximum size in bytes of the descriptor
+            (optional)
+        :type max_size: int
+        :param object_pairs_hook: passed to ``json.loads`` when parsing the
+            descriptor (optional)
+
+        '''
+        if max_size is not None and \
+                self._descriptor_info.file_size > max_size:
+            raise exceptions.InvalidZipArchiveException(
+                '"{0}" is larger than the maximum of {1} bytes'.format(
+                    self._descriptor_info.filename, max_size))
+        descriptor = self._read_json(
+            self._descriptor_info, object_pairs_hook=object_pairs_hook)
+        for resource in descriptor.get('resources', []):
+            for property_ in ('schema', 'dialect'):
+                value = resource.get(property_)
+                if (isinstance(value, six.string_types)
+                        and not value.startswith(('#', 'http'))):
+                    resource[property_] = self._read_json(self._member(value))
+        return descriptor
+
+    def open_resource(self, path):
+        '''Return a file-like object to read a resource's file from.
+
+        :param path: the resource's ``path``, relative to the descriptor
+        :type path: string
+
+        :rtype: ZipMemberFile
+
+        '''
+        return ZipMemberFile(self._zip, self._member(path))
+
+    def _check_sizes(self, max_member_size, max_total_size):
+        total = 0
+        for info in self._zip.infolist():
+            if max_member_size is not None and info.file_size > max_member_size:
+                raise exceptions.InvalidZipArchiveException(
+                    '"{0}" is larger than the maximum of {1} bytes'.format(
+                        info.filename, max_member_size))
+            total += info.file_size
+        if max_total_size is not None and total > max_total_size:
+            raise exceptions.InvalidZipArchiveException(
+                'The archive contents are larger than the maximum of {0} '
+                'bytes'.format(max_total_size))
+
+    def _find_descriptor(self):
+        descriptors = [
+            info for info in self._zip.infolist()
+            if posixpath.basename(info.filename) == DESCRIPTOR_NAME
+        ]
+        if len(descriptors) != 1:
+            raise exceptions.InvalidZipArchiveException(
+                'The archive must have exactly one "{0}" file (had {1})'
+                .format(DESCRIPTOR_NAME, len(descriptors)))
+        return descriptors[0]
+
+    def _member(self, path):
+        if isinstance(path, list):
+            path = path[0]
+        name = posixpath.normpath(posixpath.join(self._base_path, path))
+        if posixpath.isabs(path) or name == '..' or name.startswith('../'):
+            raise exceptions.InvalidZipArchiveException(
+                'Unsafe path "{0}"'.format(path))
+        try:
+            return self._zip.getinfo(name)
+        except KeyError:
+            raise exceptions.InvalidZipArchiveException(
+                '"{0}" is not in the archive'.format(path))
+
+    def _read_json(self, info, object_pairs_hook=None):
+        try:
+            with self._zip.open(info) as f:
+                data = f.read()
+        except _CORRUPT_ARCHIVE_ERRORS as e:
+            raise _corrupt_archive(e)
+        try:
+            return json.loads(data.decode('utf-8'),
+                              object_pairs_hook=object_pairs_hook)
+        except ValueError as e:
+            raise exceptions.InvalidZipArchiveException(
+                'Unable to parse "{0}": {1}'.format(info.filename, e))
+
+
+def _corrupt_archive(error):
+    return exceptions.InvalidZipArchiveException(
+        'The zip archive is corrupt: {0}'.format(error))
+
+
+class ZipMemberFile(object):
+    '''A read-only file-like object for a member of a zip archive.
+
+    The member is decompressed as it's read. Only the seeks that CKAN's
+    uploaders do are supported: seeking to the end, which uses the size
+    recorded in the archive instead of reading it, and back to the start.
+    Enough of the ``io`` interface is implemented for it to be wrapped in an
+    ``io.TextIOWrapper``, as tabulator does.
+
+    '''
+
+    def __init__(self, zip_file, info):
+        self.name = posixpath.basename(info.filename)
+        self.size = info.file_size
+        self._zip = zip_file
+        self._info = info
+        self._stream = None
+        self._position = 0
+        self.closed = False
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def seekable(self):
+        # Only for rewinding, see seek()
+        return True
+
+    def read(self, size=-1):
+        if self._position >= self.size:
+            return b''
+        try:
+            if self._stream is None:
+                self._stream = self._zip.open(self._info)
+            data = self._stream.read(size)
+        except _CORRUPT_ARCHIVE_ERRORS as e:
+            raise _corrupt_archive(e)
+        self._position += len(data)
+        return data
+
+    read1 = read
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if offset != 0 or whence not in (os.SEEK_SET, os.SEEK_END):
+            raise IOError('Zip archive members can only be rewound or '
+                          'seeked to their end')
+        self._close_stream()
+        self._position = 0 if whence == os.SEEK_SET else self.size
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        self._close_stream()
+        self.closed = True
+
+    def flush(self):
+        pass
+
+    def _close_stream(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+
+def add_resource_files(datapackage, files, directory='data'):
+    '''Return a copy of a Data Package whose resources point to their files
+    inside a zip archive, and where to put those files in it.
+
+    :param datapackage: the Data Package's descriptor
+    :type datapackage: dictionary
+    :param files: the path on disk of the file of each resource that has one,
+        by the resource's position in the Data Package
+    :type files: dictionary
+    :param directory: the directory of the archive to put the files in
+
+    :returns: the new descriptor, and a list of ``(name, path)`` tuples of
+        the files, that can be passed to :py:func:`stream_zip`
+    :rtype: tuple
+
+    '''
+    datapackage = copy.deepcopy(datapackage)
+    members = []
+    used = set([DESCRIPTOR_NAME])
+    for index, resource in enumerate(datapackage.get('resources', [])):
+        path = files.get(index)
+        if path is None:
+            continue
+        filename = _filename(resource.get('path')) or \
+            os.path.basename(path)
+        name = posixpath.join(directory, filename)
+        prefix = index
+        while name in used:
+            name = posixpath.join(
+                directory, '{0}-{1}'.format(prefix, filename))
+            prefix += 1
+        used.add(name)
+        resource['path'] = name
+        members.append((name, path))
+    return datapackage, members
+
+
+def _filename(url):
+    '''Return the name of the file at the end of ``url``, or ``None``.
+
+    The path is unquoted before it's split, so that no encoded separator or
+    ``..`` makes it out of the archive's directory.
+
+    '''
+    if isinstance(url, list):
+        url = url[0] if url else None
+    if not url:
+        return None
+    path = six.moves.urllib.parse.unquote(
+        six.moves.urllib.parse.urlparse(url).path)
+    name = re.split(r'[/\\]', path)[-1]
+    if name in ('', '.', '..'):
+        return None
+    return name
+
+
+def stream_zip(members, date_time=(1980, 1, 1, 0, 0, 0), compress=True,
+               chunk_size=64 * 1024):
+    '''Generate a zip archive, yielding its bytes as they're written.
+
+    The files are read, compressed and written a chunk at a time, so the
+    memory used is the same however big they are, and the archive doesn't
+    need to be written to disk first. ZIP64 extensions are only used when
+    the archive needs them. The same members give the same bytes, so
+    archives can be rebuilt identically.
+
+    :param members: the archive's members, as ``(name, source)`` tuples
+        where ``source`` is the path to a file on disk, or an iterable of
+        bytes
+    :type members: iterable
+    :param date_time: the modification time of all the members
+    :type date_time: tuple
+    :param compress: deflate the members, or just store them
+    :type compress: bool
+
+    :rtype: iterator of bytes
+
+    '''
+    writer = _ZipWriter(date_time, compress)
+    for name, source in members:
+        if isinstance(source, six.string_types):
+            size = os.path.getsize(source)
+            chunks = _read_chunks(source, chunk_size)
+        else:
+            size, chunks = None, source
+        for chunk in writer.write(name, chunks, size):
+            yield chunk
+    yield writer.finish()
+
+
+def _read_chunks(path, chunk_size):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+_ZIP32_LIMIT = 0xFFFFFFFF
+# Sizes above this use ZIP64, leaving room for deflate's worst case growth
+_ZIP64_THRESHOLD = 0xF0000000
+_FLAGS = 0x08 | 0x800  # data descriptor, UTF-8 names
+
+
+class _ZipWriter(object):
+
+    def __init__(self, date_time, compress):
+        self._method = zipfile.ZIP_DEFLATED if compress else \
+            zipfile.ZIP_STORED
+        year, month, day, hour, minute, second = date_time[:6]
+        self._dos_time = (hour << 11) | (minute << 5) | (second // 2)
+        self._dos_date = ((max(year, 1980) - 1980) << 9) | (month << 5) | day
+        self._offset = 0
+        self._entries = []
+
+    def write(self, name, chunks, size=None):
+        name = name.encode('utf-8') if isinstance(name, six.text_type) \
+            else name
+        zip64 = size is not None and size > _ZIP64_THRESHOLD
+        header_offset = self._offset
+
+        extra = struct.pack('<HHQQ', 1, 16, 0, 0) if zip64 else b''
+        yield self._emit(struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, _FLAGS,
+            self._method, self._dos_time, self._dos_date, 0, 0, 0,
+            len(name), len(extra)) + name + extra)
+
+        crc = 0
+        file_size = 0
+        compress_size = 0
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS) \
+            if self._method == zipfile.ZIP_DEFLATED else None
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                compress_size += len(chunk)
+                yield self._emit(chunk)
+        if compressor:
+            chunk = compressor.flush()
+            compress_size += len(chunk)
+            yield self._emit(chunk)
+        crc &= 0xFFFFFFFF
+
+        if not zip64 and max(file_size, compress_size) > _ZIP32_LIMIT:
+            raise ValueError(
+                '"{0}" is larger than its size said'.format(name))
+        yield self._emit(struct.pack(
+            '<IIQQ' if zip64 else '<IIII', 0x08074b50, crc, compress_size,
+            file_size))
+
+        self._entries.append((name, crc, compress_size, file_size,
+                              header_offset, zip64))
+
+    def finish(self):
+        directory = []
+        for name, crc, compress_size, file_size, offset, zip64 in \
+                self._entries:
+            values = []
+            if zip64:
+                values += [file_size, compress_size]
+                file_size = compress_size = _ZIP32_LIMIT
+            if offset >= _ZIP32_LIMIT:
+                values.append(offset)
+                offset = _ZIP32_LIMIT
+            extra = struct.pack(
+                '<HH' + 'Q' * len(values), 1, 8 * len(values), *values
+            ) if values else b''
+            directory.append(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 45,
+                45 if values else 20, _FLAGS, self._method, self._dos_time,
+                self._dos_date, crc, compress_size, file_size, len(name),
+                len(extra), 0, 0, 0, 0o100644 << 16, offset) + name + extra)
+        directory = b''.join(directory)
+
+        start = self._offset
+        count = len(self._entries)
+        end = b''
+        if count >= 0xFFFF or start >= _ZIP32_LIMIT or \
+                len(directory) >= _ZIP32_LIMIT:
+            zip64_end = start + len(directory)
+            end += struct.pack(
+                '<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count,
+                len(directory), start)
+            end += struct.pack('<IIQI', 0x07064b50, 0, zip64_end, 1)
+        end += struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF),
+            min(count, 0xFFFF), min(len(directory), _ZIP32_LIMIT),
+            min(start, _ZIP32_LIMIT), 0)
+        return self._emit(directory + end)
+
+    def _emit(self, data):
+        self._offset += len(data)
+        return data
@@ -0,0 +1,347 @@
+'''Zip archives of exported Data Packages, with their uploaded files.
+
+The archives are generated as they're downloaded, but they can also be built
+in the background and cached on disk, so that large ones are read from a
+file that the web server can send by itself (and resume), instead of being
+zipped again for every download. Archives are cached by the dataset's
+:py:func:`~ckanext.datapackager.lib.util.export_version`, and the least
+recently downloaded ones are removed once they take more than a maximum
+size. The same dataset always gives the same bytes, so a cached archive is
+interchangeable with one generated on the fly.
+
+'''
+import datetime
+import logging
+import os
+import threading
+import time
+import uuid
+
+import ckan.plugins.toolkit as toolkit
+from sqlalchemy import event
+
+import ckanext.datapackager.exceptions as exceptions
+import ckanext.datapackager.lib.archive as archive
+import ckanext.datapackager.lib.util as util
+
+
+log = logging.getLogger(__name__)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+# Where the ids of the datasets to build the archives of once the session
+# commits are kept, in the session's info.
+_PENDING_BUILDS = 'datapackager_pending_archive_builds'
+
+
+def configure(**kwargs):
+    '''Replace the process-wide :py:class:`ArchiveCache` with a new one, or
+    with ``None`` if no ``directory`` is given.
+
+    The keyword arguments are passed to :py:class:`ArchiveCache`.
+
+    '''
+    global _cache
+    with _cache_lock:
+        _cache = ArchiveCache(**kwargs) if kwargs.get('directory') else None
+    return _cache
+
+
+def get_cache():
+    '''Return the process-wide :py:class:`ArchiveCache`, or ``None`` if
+    archives aren't cached.
+
+    '''
+    with _cache_lock:
+        return _cache
+
+
+def zip_variant():
+    '''Return the variant of the exports that are zip archives, for
+    :py:func:`~ckanext.datapackager.lib.util.export_version`.
+
+    '''
+    return u'zip|{0}'.format(_compress())
+
+
+def zip_version(pkg):
+    '''Return the version of the zip archive of a dataset, which changes
+    whenever its contents do.
+
+    :param pkg: the dataset
+    :type pkg: ckan.model.Package
+
+    '''
+    return util.export_version(pkg.id, pkg.metadata_modified, zip_variant())
+
+
+def enqueue_build(dataset_id):
+    '''Enqueue a background job to build and cache the archive of a dataset.
+
+    :returns: whether the job was enqueued
+    :rtype: bool
+
+    '''
+    import ckanext.datapackager.jobs as jobs
+
+    try:
+        toolkit.enqueue_job(
+            jobs.build_datapackage_archive,
+            [dataset_id],
+            title='Build Data Package archive',
+            queue=toolkit.config.get(
+                'ckanext.datapackager.jobs_queue', 'default'),
+        )
+    except Exception as e:
+        # Downloads still work without it, so don't fail whatever caused it
+        log.warning('Could not enqueue building the archive of dataset '
+                    '"%s": %s', dataset_id, e)
+        return False
+    return True
+
+
+def enqueue_build_after_commit(session, dataset_id):
+    '''Enqueue building the archive of a dataset once ``session`` commits.
+
+    Changes are only seen by the background job once they're committed, and
+    the IPackageController hooks are called before that, so a job enqueued
+    straight away could find the dataset as it was, or not at all. Nothing
+    is enqueued if the session is rolled back instead.
+
+    :param session: the SQLAlchemy session the dataset is being changed in
+    :type session: sqlalchemy.orm.Session
+
+    '''
+    session.info.setdefault(_PENDING_BUILDS, set()).add(dataset_id)
+    if not event.contains(session, 'after_commit', _enqueue_pending_builds):
+        event.listen(session, 'after_commit', _enqueue_pending_builds)
+        event.listen(session, 'after_rollback', _forget_pending_builds)
+
+
+def _enqueue_pending_builds(session):
+    # Releasing a savepoint doesn't commit anything yet
+    if _in_savepoint(session):
+        return
+    for dataset_id in sorted(session.info.pop(_PENDING_BUILDS, ())):
+        enqueue_build(dataset_id)
+
+
+def _forget_pending_builds(session):
+    if not _in_savepoint(session):
+        session.info.pop(_PENDING_BUILDS, None)
+
+
+def _in_savepoint(session):
+    if hasattr(session, 'in_nested_transaction'):
+        # SQLAlchemy >= 1.4
+        return session.in_nested_transaction()
+    transaction = session.transaction
+    return transaction is not None and transaction.nested
+
+
+def stream_datapackage_zip(context, pkg):
+    '''Return a dataset's Data Package as a zip archive with the files of its
+    uploaded resources, generated as it's read.
+
+    :param pkg: the dataset
+    :type pkg: ckan.model.Package
+
+    :rtype: iterator of bytes
+
+    '''
+    datapackage_dict = toolkit.get_action('package_show_as_datapackage')(
+        dict(context), {'id': pkg.id})
+    dataset_dict = toolkit.get_action('package_show')(
+        dict(context), {'id': pkg.id})
+
+    files = {}
+    for index, resource in enumerate(dataset_dict.get('resources', [])):
+        if resource.get('url_type') != 'upload':
+            continue
+        try:
+            files[index] = util.get_path_to_resource_file(dict(resource))
+        except exceptions.ResourceFileDoesNotExistException:
+            pass
+    descriptor, members = archive.add_resource_files(datapackage_dict, files)
+
+    return archive.stream_zip(
+        [(archive.DESCRIPTOR_NAME, util.iter_json(descriptor, indent=2))] +
+        members,
+        date_time=(pkg.metadata_modified or datetime.datetime.utcnow())
+        .timetuple()[:6],
+        compress=_compress(),
+    )
+
+
+def _compress():
+    return toolkit.asbool(toolkit.config.get(
+        'ckanext.datapackager.export_zip_compress', True))
+
+
+class ArchiveCache(object):
+    '''A directory of prebuilt Data Package archives.
+
+    The archives of each dataset are kept in a directory of their own, named
+    after its id, so they can be found without listing all the others.
+
+    :param directory: where to keep the archives
+    :type directory: string
+    :param max_size: the maximum size in bytes of all the archives together
+    :type max_size: int
+    :param build_timeout: the seconds after which a build that hasn't
+        finished is assumed to have died, and can be started again
+    :type build_timeout: int
+
+    '''
+
+    def __init__(self, directory, max_size=10 * 2 ** 30, build_timeout=3600):
+        self.directory = directory
+        self.max_size = max_size
+        self.build_timeout = build_timeout
+
+    def path(self, dataset_id, version):
+        return os.path.join(self._dataset_directory(dataset_id),
+                            '{0}.zip'.format(version))
+
+    def _dataset_directory(self, dataset_id):
+        return os.path.join(self.directory, dataset_id)
+
+    def get(self, dataset_id, version):
+        '''Return the path of the archive of that version of the dataset, or
+        ``None`` if it hasn't been built.
+
+        '''
+        path = self.path(dataset_id, version)
+        try:
+            # Keep track of when it was last used, for evicting old archives
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def claim(self, dataset_id, version):
+        '''Mark the archive of that version of the dataset as being built.
+
+        :returns: whether it was marked, i.e. it isn't built or being built
+            already
+        :rtype: bool
+
+        '''
+        if self.get(dataset_id, version):
+            return False
+        marker = self.path(dataset_id, version) + '.building'
+        _makedirs(self._dataset_directory(dataset_id))
+        try:
+            if time.time() - os.path.getmtime(marker) > self.build_timeout:
+                os.remove(marker)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            return False
+        return True
+
+    def release(self, dataset_id, version):
+        '''Undo :py:meth:`claim`, if the archive won't be built after all.
+
+        '''
+        _remove(self.path(dataset_id, version) + '.building')
+
+    def build(self, dataset_id, version, chunks):
+        '''Write the archive of that version of the dataset.
+
+        The archives of other versions of the dataset are removed, and so are
+        the least recently used archives of other datasets, if there's no
+        room for it.
+
+        :param chunks: the archive's contents
+        :type chunks: iterable of bytes
+
+        :returns: the path of the archive, or ``None`` if it's larger than
+            the maximum size
+        :rtype: string
+
+        '''
+        path = self.path(dataset_id, version)
+        # Write to a temporary file first, so that concurrent downloads never
+        # see half-written archives.
+        temp_path = '{0}.{1}.tmp'.format(path, uuid.uuid4().hex)
+        _makedirs(self._dataset_directory(dataset_id))
+        try:
+            size = 0
+            with open(temp_path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+                    if size > self.max_size:
+                        return None
+            os.rename(temp_path, path)
+        finally:
+            _remove(temp_path)
+            self.release(dataset_id, version)
+
+        self.remove(dataset_id, keep=path)
+        self.evict(keep=path)
+        return path
+
+    def remove(self, dataset_id, keep=None):
+        '''Remove all the archives of a dataset (except ``keep``).
+
+        '''
+        directory = self._dataset_directory(dataset_id)
+        for name in _listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.zip') and path != keep:
+                _remove(path)
+
+    def evict(self, keep=None):
+        '''Remove the least recently used archives (except ``keep``) until
+        they take at most the maximum size.
+
+        '''
+        entries = []
+        for dataset_id in _listdir(self.directory):
+            directory = self._dataset_directory(dataset_id)
+            for name in _listdir(directory):
+                if not name.endswith('.zip'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path != keep, stat.st_mtime, stat.st_size,
+                                path))
+
+        total = sum(entry[2] for entry in entries)
+        # The oldest ones go first, and the one to keep last
+        for evictable, _, size, path in sorted(
+                entries, key=lambda entry: (not entry[0], entry[1])):
+            if total <= self.max_size or not evictable:
+                break
+            _remove(path)
+            total -= size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _listdir(directory):
+    try:
+        return os.listdir(directory)
+    except OSError:
+        return []
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
@@ -0,0 +1,141 @@
+'''Exporting all the datasets of an organization or group as Data Packages.
+
+The datasets are exported a page at a time, in the order of their ids, so the
+id of the last dataset of a page is the cursor that the next page starts
+after, which stays valid while datasets are added or removed. The datasets of
+a page are looked up from the search index in batches, converted and written
+out one at a time, so memory use depends on the batch size, not on the number
+of datasets. They're converted from the search results rather than from
+``package_show``, so they're left out of the
+:py:mod:`~ckanext.datapackager.lib.export_cache`.
+
+'''
+import calendar
+import datetime
+import tarfile
+
+import ckan.plugins.toolkit as toolkit
+from frictionless_ckan_mapper import ckan_to_frictionless as converter
+
+import ckanext.datapackager.lib.util as util
+from ckanext.datapackager.logic.action.get import _without_content_hashes
+
+
+def page(context, fq, cursor=None, limit=1000):
+    '''Return the ids of a page of the datasets that match a search filter.
+
+    :param fq: the Solr filter query of the datasets, e.g.
+        ``+owner_org:"<id>"``
+    :type fq: string
+    :param cursor: the id of the dataset that the page starts after
+        (optional, the page starts at the beginning if it's not given)
+    :type cursor: string
+    :param limit: the maximum number of datasets in the page
+    :type limit: int
+
+    :returns: the ids of the page's datasets, and the cursor of the next
+        page, or ``None`` if it's the last one
+    :rtype: tuple
+
+    '''
+    if cursor:
+        fq = u'{0} +id:{{"{1}" TO *]'.format(fq, _escape(cursor))
+    result = toolkit.get_action('package_search')(dict(context), {
+        'fq': fq,
+        'fl': ['id'],
+        'sort': 'id asc',
+        'rows': limit,
+        'include_private': True,
+    })
+    ids = [dataset['id'] for dataset in result['results']]
+    # The page may have less rows than asked for if it's more than the
+    # ckan.search.rows_max, so the total count says if there are more.
+    if ids and result['count'] > len(ids):
+        return ids, ids[-1]
+    return ids, None
+
+
+def iter_datapackages(context, ids, batch_size=100):
+    '''Yield the Data Packages of the datasets with the given ids, looking
+    them up ``batch_size`` at a time.
+
+    :returns: ``(datapackage, metadata_modified)`` tuples, with the
+        ``metadata_modified`` of each Data Package's dataset
+    :rtype: iterator of tuples
+
+    '''
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        result = toolkit.get_action('package_search')(dict(context), {
+            'fq': u'id:({0})'.format(u' OR '.join(
+                u'"{0}"'.format(_escape(id_)) for id_ in batch)),
+            'sort': 'id asc',
+            'rows': len(batch),
+            'include_private': True,
+        })
+        for dataset_dict in result['results']:
+            datapackage = converter.dataset(
+                _without_content_hashes(dataset_dict))
+            yield datapackage, dataset_dict.get('metadata_modified')
+
+
+def iter_ndjson(datapackages):
+    '''Encode Data Packages as newline-delimited JSON, one at a time.
+
+    :param datapackages: ``(datapackage, metadata_modified)`` tuples, as
+        yielded by :py:func:`iter_datapackages`
+    :rtype: iterator of bytes
+
+    '''
+    for datapackage, _ in datapackages:
+        for chunk in util.iter_json(datapackage):
+            yield chunk
+        yield b'\n'
+
+
+def iter_tar(datapackages):
+    '''Encode Data Packages as a tar archive of their descriptors, one at a
+    time, each one as ``<name>/datapackage.json``.
+
+    Each file's modification time is its dataset's ``metadata_modified``, so
+    the same datasets always give the same archive.
+
+    :param datapackages: ``(datapackage, metadata_modified)`` tuples, as
+        yielded by :py:func:`iter_datapackages`
+    :rtype: iterator of bytes
+
+    '''
+    names = set()
+    for datapackage, modified in datapackages:
+        data = b''.join(util.iter_json(datapackage, indent=2))
+        name = datapackage.get('name') or datapackage.get('id')
+        if name in names:
+            name = datapackage.get('id') or name
+        names.add(name)
+
+        info = tarfile.TarInfo(u'{0}/datapackage.json'.format(name))
+        info.size = len(data)
+        info.mode = 0o644
+        info.mtime = _timestamp(modified)
+        yield info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8')
+        yield data
+        if len(data) % tarfile.BLOCKSIZE:
+            yield b'\0' * (tarfile.BLOCKSIZE - len(data) % tarfile.BLOCKSIZE)
+    # The end of the archive
+    yield b'\0' * (tarfile.BLOCKSIZE * 2)
+
+
+def _timestamp(metadata_modified):
+    '''Return a dataset's ``metadata_modified`` (an ISO 8601 date in UTC)
+    in seconds since the epoch, or 0 if it's missing.
+
+    '''
+    if not metadata_modified:
+        return 0
+    modified = datetime.datetime.strptime(
+        metadata_modified.split('.')[0], '%Y-%m-%dT%H:%M:%S')
+    return calendar.timegm(modified.timetuple())
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
@@ -0,0 +1,135 @@
+'''A process-wide cache of datasets exported as Data Packages.
+
+Converting a dataset to a Data Package means calling ``package_show`` and
+then running the converter on the result, which harvesters polling
+``datapackage.json`` URLs make us do over and over for datasets that don't
+change. The converted Data Packages are cached here, by the dataset's id and
+``metadata_modified``, so a dataset that changes is never served from the
+cache, even by processes that didn't see it change. The plugin also
+invalidates a dataset's entries when it's updated or deleted in this process,
+to free them straight away.
+
+They're also cached by the user they were exported for, as ``package_show``
+may show each user something different (e.g. plugins' ``after_show`` hooks
+can leave out what some users aren't allowed to see).
+
+'''
+import copy
+import threading
+from collections import OrderedDict
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def configure(max_size=1000):
+    '''Replace the process-wide :py:class:`DataPackageCache` with a new one.
+
+    :rtype: DataPackageCache
+
+    '''
+    global _cache
+    with _cache_lock:
+        _cache = DataPackageCache(max_size=max_size)
+    return _cache
+
+
+def get_cache():
+    '''Return the process-wide :py:class:`DataPackageCache`.
+
+    If :py:func:`configure` hasn't been called yet, one with the default
+    options is created.
+
+    '''
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = DataPackageCache()
+    return _cache
+
+
+class DataPackageCache(object):
+    '''A thread-safe LRU cache of exported Data Packages.
+
+    Only the ``max_size`` most recently used Data Packages are kept, and only
+    the latest version of each dataset (for each user). Set ``max_size`` to 0
+    to disable the cache.
+
+    '''
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # By (dataset id, user), and the users of each dataset, to
+        # invalidate all its entries without going through the others.
+        self._entries = OrderedDict()
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def get(self, dataset_id, metadata_modified, user=None):
+        '''Return a copy of the cached Data Package of the dataset for
+        ``user``, or ``None`` if it's not cached for that
+        ``metadata_modified``.
+
+        '''
+        with self._lock:
+            entry = self._entries.pop((dataset_id, user), None)
+            if entry is not None and entry[0] == metadata_modified:
+                # Put it back as the most recently used one
+                self._entries[(dataset_id, user)] = entry
+                self.hits += 1
+                datapackage = entry[1]
+            else:
+                if entry is not None:
+                    self._forget(dataset_id, user)
+                self.misses += 1
+                datapackage = None
+        # Callers may change what they get back
+        return copy.deepcopy(datapackage)
+
+    def set(self, dataset_id, metadata_modified, datapackage, user=None):
+        if self.max_size <= 0:
+            return
+        datapackage = copy.deepcopy(datapackage)
+        with self._lock:
+            self._entries.pop((dataset_id, user), None)
+            self._entries[(dataset_id, user)] = (metadata_modified,
+                                                 datapackage)
+            self._users.setdefault(dataset_id, set()).add(user)
+            while len(self._entries) > self.max_size:
+                key, _ = self._entries.popitem(last=False)
+                self._forget(*key)
+
+    def invalidate(self, dataset_id):
+        with self._lock:
+            for user in self._users.pop(dataset_id, ()):
+                self._entries.pop((dataset_id, user), None)
+
+    def _forget(self, dataset_id, user):
+        users = self._users.get(dataset_id)
+        if users is not None:
+            users.discard(user)
+            if not users:
+                del self._users[dataset_id]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._users.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        '''Return the number of ``hits`` and ``misses``, and the ``size`` and
+        ``max_size`` of the cache.
+
+        '''
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+            }
@@ -0,0 +1,223 @@
+'''Fetching remote Data Packages.
+
+All the downloads in a process share a pool of connections, have connect and
+read timeouts and a maximum size, which is enforced while the response is
+being downloaded. Responses with an ``ETag`` or a ``Last-Modified`` header are
+cached on disk, and revalidated with a conditional request the next time the
+same URL is fetched, so re-importing an unchanged Data Package doesn't
+download it again.
+
+'''
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+import uuid
+from contextlib import closing
+
+import requests
+import six
+
+import ckanext.datapackager.exceptions as exceptions
+import ckanext.datapackager.lib.util as util
+
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    '''Replace the process-wide :py:class:`Fetcher` with a new one.
+
+    The keyword arguments are passed to :py:class:`Fetcher`.
+
+    :rtype: Fetcher
+
+    '''
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is not None:
+            _fetcher.close()
+        _fetcher = Fetcher(**kwargs)
+    return _fetcher
+
+
+def get_fetcher():
+    '''Return the process-wide :py:class:`Fetcher`.
+
+    If :py:func:`configure` hasn't been called yet, a :py:class:`Fetcher` with
+    the default options is created.
+
+    '''
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = Fetcher()
+    return _fetcher
+
+
+class Fetcher(object):
+    '''Downloads files over HTTP, reusing connections and caching responses.
+
+    Instances are safe to share between threads.
+
+    :param max_size: the maximum size in bytes of a download (optional)
+    :type max_size: int
+    :param connect_timeout: seconds to wait for a connection
+    :type connect_timeout: float
+    :param read_timeout: seconds to wait between bytes from the server
+    :type read_timeout: float
+    :param pool_size: the number of connections kept open per host
+    :type pool_size: int
+    :param cache_dir: where to cache responses, or ``None`` to not cache them
+    :type cache_dir: string
+    :param cache_size: the maximum number of responses to cache
+    :type cache_size: int
+
+    '''
+
+    def __init__(self, max_size=None, connect_timeout=10, read_timeout=30,
+                 pool_size=10, cache_dir=None, cache_size=64):
+        self.max_size = max_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def fetch(self, url, directory):
+        '''Download ``url`` into ``directory`` and return the file's path.
+
+        If there's a cached copy of ``url`` and the server says it hasn't
+        changed, that copy is used instead of downloading it again.
+
+        :raises ckanext.datapackager.exceptions.CouldNotFetchException:
+            If the download fails, times out or is larger than ``max_size``
+
+        '''
+        path = os.path.join(directory, 'datapackage')
+        cached_path, cached_meta = self._get_cached(url)
+
+        headers = {}
+        if cached_meta.get('etag'):
+            headers['If-None-Match'] = cached_meta['etag']
+        if cached_meta.get('last_modified'):
+            headers['If-Modified-Since'] = cached_meta['last_modified']
+
+        try:
+            response = self.session.get(
+                url, headers=headers, stream=True, timeout=self.timeout)
+            with closing(response):
+                if response.status_code == 304 and cached_path:
+                    _link_or_copy(cached_path, path)
+                    return path
+                response.raise_for_status()
+                self._download(response, path)
+        except requests.exceptions.RequestException as e:
+            raise exceptions.CouldNotFetchException(
+                'Could not fetch "{0}": {1}'.format(url, e))
+
+        meta = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+        if meta['etag'] or meta['last_modified']:
+            self._cache(url, path, meta)
+
+        return path
+
+    def _download(self, response, path):
+        length = response.headers.get('Content-Length')
+        if self.max_size is not None and length and length.isdigit() \
+                and int(length) > self.max_size:
+            raise exceptions.CouldNotFetchException(
+                'The file is larger than the maximum of {0} bytes'.format(
+                    self.max_size))
+
+        size = 0
+        with open(path, 'wb') as f:
+            for chunk in response.iter_content(util.DEFAULT_CHUNK_SIZE):
+                size += len(chunk)
+                if self.max_size is not None and size > self.max_size:
+                    raise exceptions.CouldNotFetchException(
+                        'The file is larger than the maximum of {0} bytes'
+                        .format(self.max_size))
+                f.write(chunk)
+
+    def _cache_paths(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.cache_dir, key)
+        return base, base + '.json'
+
+    def _get_cached(self, url):
+        if not self.cache_dir or not self.cache_size:
+            return None, {}
+
+        data_path, meta_path = self._cache_paths(url)
+        try:
+            with io.open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None, {}
+        if meta.get('url') != url or not os.path.isfile(data_path):
+            return None, {}
+
+        # Keep track of when it was last used, for evicting old entries
+        try:
+            os.utime(meta_path, None)
+        except OSError:
+            pass
+        return data_path, meta
+
+    def _cache(self, url, path, meta):
+        if not self.cache_dir or not self.cache_size:
+            return
+
+        data_path, meta_path = self._cache_paths(url)
+
+        # Write to temporary files first, so that concurrent fetches of the
+        # same URL never see half-written entries.
+        suffix = '.{0}.tmp'.format(uuid.uuid4().hex)
+        _link_or_copy(path, data_path + suffix)
+        os.rename(data_path + suffix, data_path)
+
+        with io.open(meta_path + suffix, 'w', encoding='utf-8') as f:
+            f.write(six.text_type(json.dumps(meta)))
+        os.rename(meta_path + suffix, meta_path)
+
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.json'):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+
+        entries.sort()
+        for _, meta_path in entries[:max(len(entries) - self.cache_size, 0)]:
+            for path in (meta_path, meta_path[:-len('.json')]):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def _link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except (OSError, AttributeError):
+        shutil.copyfile(source, target)
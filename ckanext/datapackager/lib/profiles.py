@@ -0,0 +1,174 @@
+'''A process-wide registry of compiled Data Package profiles.
+
+Every time the datapackage library loads a Data Package, it builds a
+``datapackage.Profile`` for the package and for each of its resources, which
+loads the profile's JSON Schema (from the web, for custom profiles) and
+compiles a validator for it. Once :py:func:`install` has been called, the
+library gets its profiles from the registry here instead, until
+:py:func:`uninstall` is called.
+
+'''
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import six
+
+import datapackage.package
+import datapackage.registry
+import datapackage.resource
+from datapackage.profile import Profile
+
+
+log = logging.getLogger(__name__)
+
+_registry = None
+
+# The library's own Profile constructors, to put back on uninstall()
+_originals = (datapackage.package.Profile, datapackage.resource.Profile)
+
+
+def install(max_size=32, ttl=3600):
+    '''Make the datapackage library use a shared :py:class:`ProfileRegistry`.
+
+    The built-in profiles are loaded straight away. Calling this again
+    replaces the registry (and its cached profiles) with a new one.
+
+    :param max_size: the maximum number of custom profiles to cache
+    :type max_size: int
+    :param ttl: for how long, in seconds, custom profiles are cached
+    :type ttl: int
+
+    :rtype: ProfileRegistry
+
+    '''
+    global _registry
+    _registry = ProfileRegistry(max_size=max_size, ttl=ttl)
+    _registry.warm()
+
+    datapackage.package.Profile = _registry.get
+    datapackage.resource.Profile = _registry.get
+
+    return _registry
+
+
+def uninstall():
+    '''Make the datapackage library build its own profiles again, and drop
+    the installed registry.
+
+    '''
+    global _registry
+    datapackage.package.Profile, datapackage.resource.Profile = _originals
+    _registry = None
+
+
+def get_registry():
+    '''Return the installed :py:class:`ProfileRegistry`, if there's one.
+
+    '''
+    return _registry
+
+
+class ProfileRegistry(object):
+    '''A thread-safe cache of ``datapackage.Profile`` objects.
+
+    The built-in profiles (``data-package``, ``tabular-data-resource``, etc.)
+    are kept for as long as the process lives. Custom profiles (URLs) are kept
+    for ``ttl`` seconds, and only the ``max_size`` most recently used ones.
+
+    '''
+
+    def __init__(self, max_size=32, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        registry = datapackage.registry.Registry()
+        self._builtin_names = set(registry.available_profiles)
+        self._local_names = set(
+            name for name, profile in registry.available_profiles.items()
+            if os.path.isfile(
+                os.path.join(registry.base_path, profile['schema_path']))
+        )
+        self._builtin = {}
+        self._custom = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, profile):
+        '''Return the profile with the given name or URL.
+
+        This has the same signature as ``datapackage.Profile``, so it can be
+        used in its place.
+
+        '''
+        if not isinstance(profile, six.string_types):
+            return Profile(profile)
+        if profile in self._builtin_names:
+            return self._get_builtin(profile)
+        return self._get_custom(profile)
+
+    def warm(self):
+        '''Load all the built-in profiles that ship with the datapackage
+        library.
+
+        '''
+        for name in self._local_names:
+            try:
+                self.get(name)
+            except datapackage.exceptions.DataPackageException as e:
+                log.warning('Could not load profile "%s": %s', name, e)
+
+    def clear(self):
+        '''Forget all the cached profiles.
+
+        '''
+        with self._lock:
+            self._builtin.clear()
+            self._custom.clear()
+
+    def _get_builtin(self, name):
+        with self._lock:
+            cached = self._builtin.get(name)
+        if cached is None:
+            cached = _SharedProfile(Profile(name))
+            with self._lock:
+                cached = self._builtin.setdefault(name, cached)
+        return cached
+
+    def _get_custom(self, url):
+        now = time.time()
+        with self._lock:
+            entry = self._custom.pop(url, None)
+            if entry is not None and entry[0] > now:
+                # Put it back as the most recently used one
+                self._custom[url] = entry
+                return entry[1]
+
+        # Loading it might mean fetching it, so don't hold the lock meanwhile
+        loaded = _SharedProfile(Profile(url))
+        with self._lock:
+            self._custom.pop(url, None)
+            self._custom[url] = (now + self.ttl, loaded)
+            while len(self._custom) > self.max_size:
+                self._custom.popitem(last=False)
+        return loaded
+
+
+class _SharedProfile(object):
+    '''Wrap a ``datapackage.Profile`` so that it can be used from many threads.
+
+    The jsonschema validators keep some state while validating, so
+    validations with the same profile are done one at a time.
+
+    '''
+
+    def __init__(self, profile):
+        self._profile = profile
+        self._lock = threading.Lock()
+
+    def validate(self, data):
+        with self._lock:
+            return self._profile.validate(data)
+
+    def __getattr__(self, name):
+        return getattr(self._profile, name)
@@ -0,0 +1,236 @@
+'''Reading the tabular files of Data Package resources.
+
+'''
+import contextlib
+import io
+import multiprocessing
+
+import six
+import tableschema
+import tabulator
+
+import ckanext.datapackager.exceptions as exceptions
+import ckanext.datapackager.lib.archive as archive
+
+
+def is_csv(resource, filename=None):
+    '''Return whether ``resource`` (with a file called ``filename``) is a CSV
+    file.
+
+    '''
+    if (resource.get('format') or '').lower() == 'csv':
+        return True
+    for key in ('mimetype', 'mediatype'):
+        if (resource.get(key) or '').lower() == 'text/csv':
+            return True
+    return bool(filename) and filename.lower().endswith('.csv')
+
+
+def infer_schema(the_file, max_rows=100, max_bytes=2 ** 20, encoding=None,
+                 dialect=None):
+    '''Return a Table Schema inferred from the first rows of a CSV file.
+
+    At most ``max_bytes`` bytes of the file are read, and at most
+    ``max_rows`` rows of them are used, so inferring the schema of a file
+    takes the same time and memory however big it is. The file isn't
+    rewound afterwards.
+
+    :param the_file: the CSV file, opened in binary mode
+    :param encoding: the file's encoding (optional, it's detected if it's
+        not given)
+    :type encoding: string
+    :param dialect: the file's CSV dialect, as in the Data Package's
+        ``dialect`` (optional)
+    :type dialect: dictionary
+
+    :raises ckanext.datapackager.exceptions.CouldNotReadCSVException:
+        If the file can't be read as a CSV file
+
+    :rtype: dictionary
+
+    '''
+    sample = the_file.read(max_bytes)
+    truncated = len(sample) == max_bytes and bool(the_file.read(1))
+
+    try:
+        with tabulator.Stream(io.BytesIO(sample), format='csv', headers=1,
+                              encoding=encoding,
+                              **_dialect_options(dialect)) as stream:
+            headers = stream.headers
+            rows = stream.read(limit=max_rows + 1)
+    except (tabulator.exceptions.TabulatorException, UnicodeError) as e:
+        raise exceptions.CouldNotReadCSVException(e)
+
+    if not headers:
+        raise exceptions.CouldNotReadCSVException('The file has no header')
+
+    if len(rows) > max_rows:
+        rows = rows[:max_rows]
+    elif truncated:
+        # The last row was probably cut off by the end of the sample
+        rows = rows[:-1]
+
+    try:
+        return tableschema.Schema().infer(rows, headers=headers)
+    except tableschema.exceptions.TableSchemaException as e:
+        raise exceptions.CouldNotReadCSVException(e)
+
+
+def validate(source, schema, encoding=None, dialect=None, max_errors=100):
+    '''Check the rows of a CSV file against a Table Schema.
+
+    The rows are read one at a time, and reading stops at the
+    ``max_errors``-th error.
+
+    :param source: where to read the file from, one of ``('path', path)``,
+        ``('zip', archive_path, path)`` for a file in a zipped Data Package,
+        or ``('data', data)`` for inline data
+    :type source: tuple
+    :param schema: the Table Schema
+    :type schema: dictionary
+
+    :returns: the errors found, as dicts with the ``row`` number (counting
+        the header as row 1, or ``None`` for errors with the whole file) and
+        a ``message``
+    :rtype: list of dictionaries
+
+    '''
+    errors = []
+    options = dict(format='csv', headers=1, encoding=encoding,
+                   **_dialect_options(dialect))
+
+    def handle_error(exc, row_number=None, row_data=None, error_data=None):
+        messages = [six.text_type(e) for e in getattr(exc, 'errors', [])]
+        errors.append({
+            'row': row_number,
+            'message': '; '.join(messages) or six.text_type(exc),
+        })
+        if len(errors) >= max_errors:
+            raise _TooManyErrors()
+
+    try:
+        with _open_source(source) as f:
+            with tabulator.Stream(f, **options) as stream:
+                headers = stream.headers
+        field_names = tableschema.Schema(schema).field_names
+        if headers != field_names:
+            # Otherwise it would be reported for every row
+            return [{'row': 1, 'message': (
+                'The header ({0}) doesn\'t match the schema\'s field names '
+                '({1})'.format(', '.join(headers or []),
+                               ', '.join(field_names)))}]
+
+        with _open_source(source) as f:
+            table = tableschema.Table(f, schema=schema, **options)
+            for _ in table.iter(exc_handler=handle_error):
+                pass
+    except _TooManyErrors:
+        pass
+    except (tableschema.exceptions.TableSchemaException,
+            tabulator.exceptions.TabulatorException,
+            exceptions.InvalidZipArchiveException,
+            IOError, UnicodeError) as e:
+        errors.append({'row': None, 'message': six.text_type(e)})
+
+    return errors
+
+
+def validate_all(sources, max_workers=None, max_errors=100):
+    '''Check many CSV files against their Table Schemas at the same time,
+    in a pool of ``max_workers`` processes.
+
+    Once ``max_errors`` errors have been found in all the files, the ones
+    that haven't been started yet aren't checked, and the processes checking
+    the others are terminated. The processes are spawned rather than forked
+    where possible (i.e. not on Python 2), so they don't share the database
+    and Redis connections of the process that starts them.
+
+    :param sources: the files to check, as ``(name, kwargs)`` tuples where
+        ``kwargs`` are the arguments of :py:func:`validate` for each of them
+    :type sources: list
+
+    :returns: the errors found, like in :py:func:`validate`, with the
+        ``resource`` name added, in the order of ``sources``
+    :rtype: list of dictionaries
+
+    '''
+    tasks = [(index, kwargs, max_errors)
+             for index, (name, kwargs) in enumerate(sources)]
+    if max_workers == 1 or len(sources) < 2:
+        pool = None
+        results = six.moves.map(_validate_task, tasks)
+    else:
+        pool = _process_pool(max_workers)
+        results = pool.imap_unordered(_validate_task, tasks)
+
+    found = {}
+    total = 0
+    try:
+        for index, errors in results:
+            errors = errors[:max_errors - total]
+            found[index] = errors
+            total += len(errors)
+            if total >= max_errors:
+                break
+    finally:
+        if pool is not None:
+            # Stop the files that are still being checked, their errors
+            # wouldn't be reported anyway.
+            pool.terminate()
+            pool.join()
+
+    report = []
+    for index, (name, kwargs) in enumerate(sources):
+        for error in found.get(index, []):
+            report.append(dict(error, resource=name))
+    return report
+
+
+class _TooManyErrors(Exception):
+    pass
+
+
+def _process_pool(max_workers):
+    try:
+        context = multiprocessing.get_context('spawn')
+    except AttributeError:
+        # Python 2 can only fork
+        context = multiprocessing
+    return context.Pool(max_workers)
+
+
+def _validate_task(task):
+    index, kwargs, max_errors = task
+    return index, validate(max_errors=max_errors, **kwargs)
+
+
+@contextlib.contextmanager
+def _open_source(source):
+    kind = source[0]
+    if kind == 'data':
+        data = source[1]
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        yield io.BytesIO(data)
+    elif kind == 'zip':
+        with archive.ZippedDataPackage(source[1]) as zipped:
+            f = zipped.open_resource(source[2])
+            try:
+                yield f
+            finally:
+                f.close()
+    else:
+        with open(source[1], 'rb') as f:
+            yield f
+
+
+def _dialect_options(dialect):
+    options = {}
+    for key, option in (('delimiter', 'delimiter'),
+                        ('quoteChar', 'quotechar'),
+                        ('doubleQuote', 'doublequote'),
+                        ('escapeChar', 'escapechar'),
+                        ('skipInitialSpace', 'skipinitialspace')):
+        if (dialect or {}).get(key) is not None:
+            options[option] = dialect[key]
+    return options
@@ -0,0 +1,225 @@
+'''Resumable uploads of Data Packages, sent in chunks.
+
+An upload is started with :py:meth:`ChunkedUpload.create`, and its chunks are
+then written with :py:meth:`ChunkedUpload.write` one after the other, each at
+the offset where the previous one ended. If the connection drops, the client
+can ask for the upload's current ``offset`` and carry on from there.
+
+Each upload is kept in its own directory on disk, inside the extension's
+working directory, so any web process can receive any of its chunks. Chunks
+and the end of an upload are handled one at a time, under a lock on a file in
+that directory.
+
+'''
+import fcntl
+import io
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+import six
+
+import ckanext.datapackager.exceptions as exceptions
+import ckanext.datapackager.lib.util as util
+
+
+_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+def get_directory():
+    '''Return the directory where chunked uploads are kept.
+
+    '''
+    return util.get_working_directory('uploads')
+
+
+def expire(ttl):
+    '''Delete the uploads that haven't received a chunk in ``ttl`` seconds.
+
+    :returns: the number of uploads deleted
+    :rtype: int
+
+    '''
+    directory = get_directory()
+    deleted = 0
+    for upload_id in os.listdir(directory):
+        if not _ID_PATTERN.match(upload_id):
+            continue
+        upload = ChunkedUpload(os.path.join(directory, upload_id))
+        try:
+            expired = upload.last_modified + ttl < time.time()
+        except OSError:
+            continue
+        if expired:
+            upload.delete()
+            deleted += 1
+    return deleted
+
+
+class ChunkedUpload(object):
+    '''A Data Package being uploaded in chunks.
+
+    '''
+
+    def __init__(self, path):
+        self.id = os.path.basename(path)
+        self.path = path
+        self.data_path = os.path.join(path, 'data')
+        self._meta_path = os.path.join(path, 'meta.json')
+        self._lock_path = os.path.join(path, 'lock')
+
+    @classmethod
+    def create(cls, user, size=None):
+        '''Start a new upload and return it.
+
+        :param user: the name of the user that's uploading it
+        :type user: string
+        :param size: the size in bytes of the whole upload, if it's known
+        :type size: int
+
+        '''
+        upload = cls(os.path.join(get_directory(), uuid.uuid4().hex))
+        os.mkdir(upload.path)
+        open(upload.data_path, 'wb').close()
+        with io.open(upload._meta_path, 'w', encoding='utf-8') as f:
+            f.write(six.text_type(json.dumps({
+                'user': user,
+                'size': size,
+                'created': time.time(),
+            })))
+        return upload
+
+    @classmethod
+    def get(cls, upload_id, ttl=None):
+        '''Return an existing upload.
+
+        :raises ckanext.datapackager.exceptions.UploadNotFoundException:
+            If there's no upload with that id, or it hasn't received a chunk
+            in ``ttl`` seconds
+
+        '''
+        if not _ID_PATTERN.match(upload_id or ''):
+            raise exceptions.UploadNotFoundException(upload_id)
+        upload = cls(os.path.join(get_directory(), upload_id))
+        try:
+            expired = ttl is not None and \
+                upload.last_modified + ttl < time.time()
+            upload.meta['user']
+        except (IOError, OSError, ValueError, KeyError):
+            raise exceptions.UploadNotFoundException(upload_id)
+        if expired:
+            upload.delete()
+            raise exceptions.UploadNotFoundException(upload_id)
+        return upload
+
+    def lock(self):
+        '''Wait for an exclusive lock on the upload, and return the open lock
+        file, which releases it when it's closed.
+
+        It can be used in a ``with`` statement, and works across processes.
+
+        :raises ckanext.datapackager.exceptions.UploadNotFoundException:
+            If the upload doesn't exist, or was deleted while waiting
+
+        '''
+        try:
+            f = open(self._lock_path, 'a')
+        except (IOError, OSError):
+            raise exceptions.UploadNotFoundException(self.id)
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            if not os.path.exists(self._meta_path):
+                raise exceptions.UploadNotFoundException(self.id)
+        except Exception:
+            f.close()
+            raise
+        return f
+
+    @property
+    def meta(self):
+        with io.open(self._meta_path, encoding='utf-8') as f:
+            return json.load(f)
+
+    @property
+    def offset(self):
+        '''The number of bytes received so far.
+
+        '''
+        return os.path.getsize(self.data_path)
+
+    @property
+    def last_modified(self):
+        return os.path.getmtime(self.data_path)
+
+    @property
+    def complete(self):
+        '''Whether all the bytes of the upload have been received.
+
+        Uploads whose size wasn't given when they were created are always
+        complete.
+
+        '''
+        size = self.meta.get('size')
+        return size is None or self.offset == size
+
+    def write(self, offset, source, max_size=None,
+              chunk_size=util.DEFAULT_CHUNK_SIZE):
+        '''Write a chunk read from ``source`` at ``offset``.
+
+        The chunk must start at or before the end of what's been received so
+        far. Anything after the end of the chunk is discarded, so that a
+        chunk can be sent again if the client didn't get the response.
+
+        :raises ckanext.datapackager.exceptions.InvalidUploadChunkException:
+            If ``offset`` is after the end of the upload, or the chunk makes
+            the upload larger than its declared size or ``max_size``
+
+        :returns: the new offset
+        :rtype: int
+
+        '''
+        current = self.offset
+        if offset < 0 or offset > current:
+            raise exceptions.InvalidUploadChunkException(
+                'The chunk starts at byte {0}, but the upload is {1} bytes '
+                'long'.format(offset, current))
+
+        declared_size = self.meta.get('size')
+        limits = [size for size in (declared_size, max_size)
+                  if size is not None]
+        limit = min(limits) if limits else None
+
+        with open(self.data_path, 'r+b') as f:
+            f.seek(offset)
+            position = offset
+            try:
+                while True:
+                    chunk = source.read(chunk_size)
+                    if not chunk:
+                        break
+                    position += len(chunk)
+                    if limit is not None and position > limit:
+                        raise exceptions.InvalidUploadChunkException(
+                            'The upload is larger than the maximum of {0} '
+                            'bytes'.format(limit))
+                    f.write(chunk)
+            except Exception:
+                f.truncate(offset)
+                raise
+            f.truncate(position)
+
+        return position
+
+    def as_dict(self):
+        meta = self.meta
+        return {
+            'id': self.id,
+            'offset': self.offset,
+            'size': meta.get('size'),
+        }
+
+    def delete(self):
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -1,11 +1,37 @@
 '''Miscellaneous shared utility functions.
 
 '''
+import csv
+import hashlib
+import json
+import os
 import os.path
+import shutil
+import tempfile
+import zlib
+
+import six
+import ckan.plugins.toolkit as toolkit
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 import ckanext.datapackager.exceptions as exceptions
 
 
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# The key of the dataset extra (and of the resource field) where the hash of
+# the imported Data Package's contents is stored.
+CONTENT_HASH_KEY = 'datapackager_content_hash'
+
+# The key of the resource field where the checksum of an imported resource's
+# file is stored, so that files are only uploaded again when they change.
+FILE_CHECKSUM_KEY = 'datapackager_file_checksum'
+
+
 def get_path_to_resource_file(resource_dict):
     '''Return the local filesystem path to an uploaded resource file.
 
@@ -34,3 +60,430 @@ def get_path_to_resource_file(resource_dict):
         raise exceptions.ResourceFileDoesNotExistException
 
     return path
+
+
+def copy_in_chunks(source, target, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Copy the contents of one file-like object into another, in chunks.
+
+    At most ``chunk_size`` bytes of ``source`` are held in memory at any
+    time, however big it is. Text chunks are encoded as UTF-8.
+
+    :param source: the file to read from
+    :type source: file-like object
+    :param target: the file to write to, opened in binary mode
+    :type target: file-like object
+    :param chunk_size: the number of bytes to read at a time
+    :type chunk_size: int
+
+    :rtype: int
+    :returns: the number of bytes written to ``target``
+
+    '''
+    total = 0
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        if isinstance(chunk, six.text_type):
+            chunk = chunk.encode('utf-8')
+        target.write(chunk)
+        total += len(chunk)
+    return total
+
+
+def get_working_directory(name):
+    '''Return the path to a directory where this extension can keep files.
+
+    The directory is created inside ``ckan.storage_path``, so that it's shared
+    by all the web and background job processes using it, or inside the
+    system's temporary directory if there's no storage path.
+
+    :param name: the name of the directory, e.g. ``'uploads'``
+    :type name: string
+
+    :rtype: string
+    :returns: the absolute path to the directory
+
+    '''
+    base = toolkit.config.get('ckan.storage_path') or tempfile.gettempdir()
+    path = os.path.abspath(os.path.join(base, 'datapackager', name))
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    return path
+
+
+def write_json(data, target, indent=None):
+    '''Encode ``data`` as JSON into a file, a piece at a time.
+
+    The encoded document is never held in memory as a whole, it's written to
+    ``target`` as it's generated.
+
+    :param data: the data to encode
+    :param target: the file to write to, opened in binary mode
+    :type target: file-like object
+    :param indent: the number of spaces to indent the JSON with, or ``None``
+        (or 0) to write it as compactly as possible
+    :type indent: int
+
+    :rtype: int
+    :returns: the number of bytes written to ``target``
+
+    '''
+    total = 0
+    for chunk in iter_json(data, indent=indent):
+        target.write(chunk)
+        total += len(chunk)
+    return total
+
+
+def iter_json(data, indent=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Encode ``data`` as JSON, yielding it as UTF-8 chunks of about
+    ``chunk_size`` bytes as it's generated.
+
+    :param indent: like in :py:func:`write_json`
+    :type indent: int
+
+    :rtype: iterator of bytes
+
+    '''
+    encoder = json.JSONEncoder(
+        indent=indent or None,
+        separators=(',', ': ') if indent else (',', ':'),
+    )
+    pieces = []
+    size = 0
+    for piece in encoder.iterencode(data):
+        if isinstance(piece, six.text_type):
+            piece = piece.encode('utf-8')
+        pieces.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield b''.join(pieces)
+            pieces = []
+            size = 0
+    if pieces:
+        yield b''.join(pieces)
+
+
+def content_encodings():
+    '''Return the ``Content-Encoding`` values that
+    :py:func:`compress_chunks` supports, most compact first.
+
+    ``br`` needs the optional ``brotli`` package.
+
+    '''
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def compress_chunks(chunks, encoding):
+    '''Compress a stream of bytes with a ``Content-Encoding`` (``gzip`` or
+    ``br``), a chunk at a time.
+
+    :param chunks: the bytes to compress
+    :type chunks: iterable of bytes
+    :param encoding: one of :py:func:`content_encodings`
+    :type encoding: string
+
+    :rtype: iterator of bytes
+
+    '''
+    if encoding not in content_encodings():
+        raise ValueError('Unsupported encoding: {0}'.format(encoding))
+
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress, finish = compressor.compress, compressor.flush
+    else:
+        compressor = brotli.Compressor()
+        # Brotli calls it process, brotlipy calls it compress
+        compress = getattr(compressor, 'process', None) or \
+            compressor.compress
+        finish = compressor.finish
+
+    for chunk in chunks:
+        compressed = compress(chunk)
+        if compressed:
+            yield compressed
+    compressed = finish()
+    if compressed:
+        yield compressed
+
+
+def write_ndjson(rows, target):
+    '''Encode ``rows`` as newline-delimited JSON into a file, one row at a
+    time.
+
+    :param rows: the rows to encode, each one on a line of its own
+    :type rows: iterable
+    :param target: the file to write to, opened in binary mode
+    :type target: file-like object
+
+    :rtype: int
+    :returns: the number of bytes written to ``target``
+
+    '''
+    total = 0
+    for row in rows:
+        total += write_json(row, target)
+        target.write(b'\n')
+        total += 1
+    return total
+
+
+def write_csv(rows, target, headers=None):
+    '''Encode ``rows`` as UTF-8 CSV into a file, one row at a time.
+
+    Rows can be lists of values, or dicts, whose values are written in the
+    order of ``headers`` (which are then written first). Values that are
+    lists or dicts themselves are encoded as JSON.
+
+    :param rows: the rows to encode
+    :type rows: iterable
+    :param target: the file to write to, opened in binary mode
+    :type target: file-like object
+    :param headers: the names of the columns (optional)
+    :type headers: list of strings
+
+    :rtype: int
+    :returns: the number of bytes written to ``target``
+
+    '''
+    # The csv module writes text on Python 3 and bytes on Python 2, so each
+    # row goes through a small buffer and is then encoded if needed.
+    buffer_ = six.StringIO()
+    writer = csv.writer(buffer_, lineterminator='\n')
+    total = 0
+
+    def write(values):
+        writer.writerow([_csv_value(value) for value in values])
+        chunk = buffer_.getvalue()
+        buffer_.seek(0)
+        buffer_.truncate()
+        if isinstance(chunk, six.text_type):
+            chunk = chunk.encode('utf-8')
+        target.write(chunk)
+        return len(chunk)
+
+    if headers is not None:
+        total += write(headers)
+    for row in rows:
+        if isinstance(row, dict):
+            row = [row.get(header) for header in headers or []]
+        total += write(row)
+    return total
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        value = 'true' if value else 'false'
+    elif isinstance(value, (list, dict)):
+        value = json.dumps(value, separators=(',', ':'))
+    elif not isinstance(value, six.string_types):
+        value = six.text_type(value)
+    if six.PY2 and isinstance(value, six.text_type):
+        value = value.encode('utf-8')
+    return value
+
+
+# The ways util.place_file() puts a file in place by default, fastest first.
+# Hard links are left out: the target would be the source file itself, and
+# CKAN truncates and rewrites uploaded files in place, so replacing the file
+# of a resource would change the original as well.
+PLACE_FILE_METHODS = ('reflink', 'copy_file_range', 'sendfile')
+
+# From linux/fs.h
+_FICLONE = 0x40049409
+
+
+def place_file(source, target, methods=PLACE_FILE_METHODS,
+               chunk_size=DEFAULT_CHUNK_SIZE):
+    '''Put a copy of the file at ``source`` at ``target``, without reading it
+    into Python if possible.
+
+    Each of the ``methods`` is tried in turn until one works:
+
+    * ``reflink``: a copy-on-write clone (Btrfs, XFS...)
+    * ``hardlink``: a hard link, so the two paths are the same file, and
+      changing one changes the other (not used unless it's asked for)
+    * ``copy_file_range`` and ``sendfile``: a copy made by the kernel
+
+    If none of them does, the file is copied in chunks. It's written next to
+    ``target`` first, and then renamed, so ``target`` is never incomplete.
+
+    :returns: the name of the method that was used, or ``'copy'``
+    :rtype: string
+
+    '''
+    unknown = set(methods) - set(_PLACERS)
+    if unknown:
+        raise ValueError('Unknown ways to place files: {0}'.format(
+            ', '.join(sorted(unknown))))
+
+    temporary = target + '~'
+    for method in tuple(methods) + ('copy',):
+        _remove_if_exists(temporary)
+        try:
+            _PLACERS[method](source, temporary, chunk_size)
+        except (OSError, IOError, AttributeError, ImportError):
+            if method == 'copy':
+                _remove_if_exists(temporary)
+                raise
+            continue
+        os.rename(temporary, target)
+        return method
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _reflink(source, target, chunk_size):
+    import fcntl
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+
+
+def _hardlink(source, target, chunk_size):
+    os.link(source, target)
+
+
+def _copy_file_range(source, target, chunk_size):
+    _copy_with_kernel(os.copy_file_range, source, target)
+
+
+def _sendfile(source, target, chunk_size):
+    _copy_with_kernel(
+        lambda src, dst, count: os.sendfile(dst, src, None, count),
+        source, target)
+
+
+def _copy_with_kernel(copy, source, target):
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        while remaining > 0:
+            copied = copy(src.fileno(), dst.fileno(), remaining)
+            if not copied:
+                break
+            remaining -= copied
+
+
+def _copy(source, target, chunk_size):
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        shutil.copyfileobj(src, dst, chunk_size)
+
+
+_PLACERS = {
+    'reflink': _reflink,
+    'hardlink': _hardlink,
+    'copy_file_range': _copy_file_range,
+    'sendfile': _sendfile,
+    'copy': _copy,
+}
+
+
+def hash_json(data):
+    '''Return the SHA-256 hex digest of ``data`` encoded as canonical JSON.
+
+    Keys are sorted and there's no whitespace, so equal data always has the
+    same hash. The JSON is hashed as it's encoded, without keeping it all in
+    memory.
+
+    '''
+    digest = hashlib.sha256()
+    encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+    for chunk in encoder.iterencode(data):
+        if isinstance(chunk, six.text_type):
+            chunk = chunk.encode('utf-8')
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def export_version(dataset_id, metadata_modified, variant=u''):
+    '''Return a hex digest that changes whenever a dataset's export does.
+
+    It changes with the dataset's ``metadata_modified`` and with the version
+    of this extension, which may export it differently, and it's different
+    for each ``variant`` (e.g. format or encoding) of the export.
+
+    :param metadata_modified: the dataset's ``metadata_modified``
+    :type metadata_modified: datetime.datetime
+
+    :rtype: string
+
+    '''
+    return hashlib.sha1(u'{0}|{1}|{2}|{3}'.format(
+        dataset_id, metadata_modified.isoformat(), _plugin_version(), variant
+    ).encode('utf-8')).hexdigest()
+
+
+def _plugin_version():
+    import pkg_resources
+
+    try:
+        return pkg_resources.get_distribution('ckanext-datapackager').version
+    except pkg_resources.DistributionNotFound:
+        return ''
+
+
+class DigestingReader(object):
+    '''Wrap a file-like object, working out its size and hashes as it's
+    read.
+
+    Rewinding the file starts over. Once it's been read from the start to the
+    end, :py:attr:`complete` is ``True`` and :py:attr:`size` and
+    :py:meth:`hexdigest` describe the whole file, without it having been read
+    an extra time for them.
+
+    :param algorithms: the names of the ``hashlib`` algorithms to use
+    :type algorithms: iterable of strings
+
+    '''
+
+    def __init__(self, f, algorithms=('md5',)):
+        self._file = f
+        self._algorithms = tuple(algorithms)
+        self._reset()
+
+    def _reset(self):
+        self._digests = dict(
+            (algorithm, hashlib.new(algorithm))
+            for algorithm in self._algorithms
+        )
+        self.size = 0
+        self.complete = False
+        self._from_start = True
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        if data:
+            if isinstance(data, six.text_type):
+                data = data.encode('utf-8')
+            for digest in self._digests.values():
+                digest.update(data)
+            self.size += len(data)
+        if self._from_start and (not data and size != 0 or
+                                 size is None or size < 0):
+            self.complete = True
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        result = self._file.seek(offset, whence)
+        if offset == 0 and whence == os.SEEK_SET:
+            self._reset()
+        else:
+            self._from_start = False
+        return result
+
+    def hexdigest(self, algorithm):
+        return self._digests[algorithm].hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
@@ -1,9 +1,16 @@
-import random
+import os
 import cgi
+import collections
 import json
+import logging
+import shutil
 import tempfile
+import uuid
+from concurrent import futures
 
 import six
+import sqlalchemy
+from six.moves.urllib.parse import urlparse
 
 import ckan.plugins.toolkit as toolkit
 from frictionless_ckan_mapper import frictionless_to_ckan as converter
@@ -11,6 +18,22 @@ from werkzeug.datastructures import FileStorage
 
 import datapackage
 
+import ckanext.datapackager.exceptions as exceptions
+import ckanext.datapackager.lib.archive as archive
+import ckanext.datapackager.lib.fetch as fetch
+import ckanext.datapackager.lib.tabular as tabular
+import ckanext.datapackager.lib.uploads as chunked_uploads
+import ckanext.datapackager.lib.util as util
+
+log = logging.getLogger(__name__)
+
+# How many times to try creating a dataset with a free name, when concurrent
+# imports keep taking it first.
+MAX_NAME_ATTEMPTS = 5
+
+# The algorithms that resources' files can be hashed with.
+HASH_ALGORITHMS = ('md5', 'sha1', 'sha256', 'sha512')
+
 
 def package_create_from_datapackage(context, data_dict):
     '''Create a new dataset (package) from a Data Package file.
@@ -22,8 +45,8 @@ def package_create_from_datapackage(context, data_dict):
     :param name: the name of the new dataset, must be between 2 and 100
         characters long and contain only lowercase alphanumeric characters,
         ``-`` and ``_``, e.g. ``'warandpeace'`` (optional, default:
-        datapackage's name concatenated with a random string to avoid
-        name collisions)
+        datapackage's name, followed by the first free suffix of ``-1``,
+        ``-2``... if that name is already in use)
     :type name: string
     :param private: the visibility of the new dataset
     :type private: bool
@@ -32,16 +55,424 @@ def package_create_from_datapackage(context, data_dict):
         :py:func:`~ckan.logic.action.get.organization_list_for_user` for
         available values (optional)
    :type owner_org: string
+    :param background: import the Data Package in a background job instead,
+        and return the job's status as returned by
+        :py:func:`~ckanext.datapackager.logic.action.get.package_create_from_datapackage_status`
+        (optional, default: ``False``)
+    :type background: bool
+    :param deduplicate: if a dataset imported from a Data Package with the
+        same contents already exists (and is visible to the user, and in the
+        same ``owner_org`` if one was given), return it instead of creating a
+        new one (optional, default: ``False``)
+    :type deduplicate: bool
+    :param validate_data: check the rows of the Data Package's CSV files
+        against their schemas, and don't create the dataset if any of them
+        is invalid (optional, default:
+        ``ckanext.datapackager.validate_data``)
+    :type validate_data: bool
+    :param path: the path of a Data Package (or zip archive) on the server,
+        relative to ``ckanext.datapackager.local_import_dir``, instead of a
+        ``url`` or ``upload``. Only sysadmins can import them, and their
+        resources' files are placed in the FileStore with links or copies
+        made by the kernel when possible (optional)
+    :type path: string
     '''
     url = data_dict.get('url')
     upload = data_dict.get('upload')
 
-    if not url and not _upload_attribute_is_valid(upload):
+    if not url and not _upload_attribute_is_valid(upload) and \
+            not data_dict.get('path'):
         msg = {'url': ['you must define either a url or upload attribute']}
         raise toolkit.ValidationError(msg)
+    _local_datapackage_path(context, data_dict)
+
+    if toolkit.asbool(data_dict.get('background', False)):
+        return _enqueue_import(context, data_dict)
+
+    progress = context.get('datapackager_progress', _ignore_progress)
+
+    tempdir = tempfile.mkdtemp(prefix='datapackager-')
+    try:
+        dp, zipped = _load_datapackage(data_dict, tempdir)
+        try:
+            return _create_dataset(context, data_dict, dp, zipped, progress)
+        finally:
+            if zipped:
+                zipped.close()
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def datapackage_upload_init(context, data_dict):
+    '''Start a resumable upload of a Data Package, to be sent in chunks.
+
+    Send the chunks with
+    :py:func:`~ckanext.datapackager.logic.action.create.datapackage_upload_chunk`
+    and, once they've all been sent, import the Data Package with
+    :py:func:`~ckanext.datapackager.logic.action.create.datapackage_upload_finalize`.
+    Uploads that don't get a chunk for ``ckanext.datapackager.chunked_upload_ttl``
+    seconds are deleted.
+
+    :param size: the size in bytes of the whole Data Package file (optional)
+    :type size: int
+
+    :returns: the upload's ``id``, ``offset`` (the number of bytes received so
+        far) and ``size``
+    :rtype: dictionary
+
+    '''
+    toolkit.check_access('package_create', context)
+
+    size = data_dict.get('size')
+    if size in (None, ''):
+        size = None
+    else:
+        size = _non_negative_int(size, 'size')
+        if size > _chunked_upload_max_size():
+            raise toolkit.ValidationError({'size': [
+                'must be at most {0} bytes'.format(_chunked_upload_max_size())
+            ]})
+
+    chunked_uploads.expire(_chunked_upload_ttl())
+    chunked = chunked_uploads.ChunkedUpload.create(context['user'], size)
+    return chunked.as_dict()
+
+
+def datapackage_upload_chunk(context, data_dict):
+    '''Add a chunk to a resumable Data Package upload.
+
+    Chunks have to be sent in order, each one starting at the ``offset``
+    where the upload ends. If the connection drops, get the upload's current
+    ``offset`` with
+    :py:func:`~ckanext.datapackager.logic.action.get.datapackage_upload_show`
+    and carry on from there. Sending a chunk at an earlier offset overwrites
+    everything from there on.
+
+    :param id: the id of the upload
+    :type id: string
+    :param offset: the position of the chunk in the file, in bytes
+    :type offset: int
+    :param upload: the chunk
+    :type upload: cgi.FieldStorage
+
+    :returns: the upload's ``id``, new ``offset`` and ``size``
+    :rtype: dictionary
+
+    '''
+    chunked = _get_chunked_upload(context, data_dict)
+    offset = _non_negative_int(data_dict.get('offset'), 'offset')
+    upload = data_dict.get('upload')
+    if not _upload_attribute_is_valid(upload):
+        raise toolkit.ValidationError({'upload': ['Missing value']})
+
+    chunk_size = toolkit.asint(toolkit.config.get(
+        'ckanext.datapackager.upload_chunk_size', util.DEFAULT_CHUNK_SIZE))
+    with _lock_chunked_upload(chunked):
+        try:
+            chunked.write(offset, _upload_file(upload),
+                          max_size=_chunked_upload_max_size(),
+                          chunk_size=chunk_size)
+        except exceptions.InvalidUploadChunkException as e:
+            raise toolkit.ValidationError({'offset': [str(e)]})
+
+        return chunked.as_dict()
+
+
+def datapackage_upload_finalize(context, data_dict):
+    '''Import the Data Package sent in a resumable upload.
+
+    Takes the same parameters as
+    :py:func:`~ckanext.datapackager.logic.action.create.package_create_from_datapackage`
+    (except for ``url`` and ``upload``), and returns the same. The upload is
+    deleted once the dataset has been created, or the background job to
+    create it enqueued.
+
+    :param id: the id of the upload
+    :type id: string
+
+    '''
+    chunked = _get_chunked_upload(context, data_dict)
+    import_data_dict = dict(
+        (key, value) for key, value in data_dict.items()
+        if key not in ('id', 'url', 'upload')
+    )
+
+    with _lock_chunked_upload(chunked):
+        if not chunked.complete:
+            raise toolkit.ValidationError({'upload': [
+                'Only {offset} of the {size} bytes have been uploaded'.format(
+                    **chunked.as_dict())
+            ]})
+
+        if toolkit.asbool(import_data_dict.get('background', False)):
+            # Hand the file over to the job, instead of copying it.
+            directory = tempfile.mkdtemp(
+                dir=util.get_working_directory('jobs'))
+            path = os.path.join(directory, 'datapackage')
+            os.rename(chunked.data_path, path)
+            chunked.delete()
+            return _enqueue_import(
+                context, import_data_dict, upload_path=path)
+
+        progress = context.get('datapackager_progress', _ignore_progress)
+        result = _import_datapackage(
+            context, import_data_dict, chunked.data_path, progress=progress)
+        chunked.delete()
+        return result
+
+
+def package_create_from_datapackage_batch(context, data_dict):
+    '''Create many datasets from Data Packages in one call.
+
+    The Data Packages are fetched and validated by a pool of
+    ``ckanext.datapackager.batch_workers`` threads, sharing their HTTP
+    connections and compiled profiles, while the datasets are created one at
+    a time, in order. A Data Package that can't be imported doesn't stop the
+    others.
+
+    :param datapackages: the Data Packages to import, at most
+        ``ckanext.datapackager.batch_max_size`` of them. Each one is either
+        the url of a Data Package, or a dict with its ``url`` or its
+        ``descriptor`` (the contents of its ``datapackage.json``), and
+        optionally any of the ``name``, ``owner_org``, ``private``,
+        ``deduplicate`` and ``validate_data`` parameters of
+        :py:func:`~ckanext.datapackager.logic.action.create.package_create_from_datapackage`
+    :type datapackages: list
+    :param owner_org: the default ``owner_org`` of the datasets (optional)
+    :type owner_org: string
+    :param private: the default visibility of the datasets (optional)
+    :type private: bool
+    :param deduplicate: the default ``deduplicate`` setting (optional)
+    :type deduplicate: bool
+    :param validate_data: the default ``validate_data`` setting (optional)
+    :type validate_data: bool
+
+    :returns: one result for each Data Package, in the same order, with
+        either ``success: true`` and the dataset as its ``result``, or
+        ``success: false`` and the ``error``
+    :rtype: list of dictionaries
+
+    '''
+    toolkit.check_access('package_create', context)
+
+    items = data_dict.get('datapackages')
+    if not isinstance(items, list) or not items:
+        raise toolkit.ValidationError(
+            {'datapackages': ['must be a non-empty list']})
+    max_items = toolkit.asint(toolkit.config.get(
+        'ckanext.datapackager.batch_max_size', 100))
+    if len(items) > max_items:
+        raise toolkit.ValidationError({'datapackages': [
+            'must have at most {0} items'.format(max_items)]})
+
+    defaults = dict(
+        (key, data_dict[key])
+        for key in ('owner_org', 'private', 'deduplicate', 'validate_data')
+        if data_dict.get(key) is not None
+    )
+    item_data_dicts = []
+    for item in items:
+        item_data_dict = dict(defaults)
+        if isinstance(item, six.string_types):
+            item_data_dict['url'] = item
+        elif isinstance(item, dict):
+            item_data_dict.update(item)
+        item_data_dicts.append(item_data_dict)
+
+    max_workers = toolkit.asint(toolkit.config.get(
+        'ckanext.datapackager.batch_workers', 4))
+    max_workers = max(max_workers, 1)
+
+    # Datasets can only be created in this thread, which has the request's
+    # database session, so the threads just load the Data Packages. At most
+    # twice as many as there are threads are loaded ahead, so that they don't
+    # all pile up on disk and in memory.
+    results = []
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = collections.deque()
+        remaining = iter(item_data_dicts)
+
+        def load_next():
+            item_data_dict = next(remaining, None)
+            if item_data_dict is not None:
+                pending.append((item_data_dict, pool.submit(
+                    _load_batch_item, item_data_dict)))
+
+        for _ in range(max_workers * 2):
+            load_next()
+        try:
+            while pending:
+                item_data_dict, task = pending.popleft()
+                load_next()
+                results.append(
+                    _create_batch_item(context, item_data_dict, task))
+        except Exception:
+            for _, task in pending:
+                _discard_batch_item(task)
+            raise
+
+    return results
+
+
+def _load_batch_item(data_dict):
+    '''Fetch and validate one of the Data Packages of a batch import.
+
+    Returns a ``(tempdir, dp, zipped)`` tuple.
+
+    '''
+    tempdir = tempfile.mkdtemp(prefix='datapackager-')
+    try:
+        url = data_dict.get('url')
+        descriptor = data_dict.get('descriptor')
+        if isinstance(descriptor, dict):
+            dp = _load_and_validate_datapackage(descriptor, tempdir)
+            return tempdir, dp, None
+        elif url and isinstance(url, six.string_types):
+            path = _fetch_datapackage(url, tempdir)
+            dp, zipped = _load_datapackage_file(
+                path, base_path=os.path.dirname(url))
+            return tempdir, dp, zipped
+        else:
+            raise toolkit.ValidationError({'url': [
+                'you must define either a url or descriptor attribute']})
+    except Exception:
+        shutil.rmtree(tempdir, ignore_errors=True)
+        raise
+
+
+def _create_batch_item(context, data_dict, task):
+    '''Create the dataset of one of the Data Packages of a batch import, and
+    return its result.
+
+    Whatever goes wrong with it is reported in its result, and the datasets
+    of the other Data Packages are still created.
+
+    '''
+    try:
+        tempdir, dp, zipped = task.result()
+    except toolkit.ValidationError as e:
+        return {'success': False, 'error': _serializable_errors(e)}
+    except Exception:
+        return _unexpected_batch_error(data_dict)
+
+    try:
+        dataset = _create_dataset(
+            dict(context), data_dict, dp, zipped, _ignore_progress)
+    except toolkit.ValidationError as e:
+        return {'success': False, 'error': _serializable_errors(e)}
+    except toolkit.NotAuthorized as e:
+        return {'success': False, 'error': {'message': str(e)}}
+    except Exception:
+        return _unexpected_batch_error(data_dict)
+    finally:
+        if zipped:
+            zipped.close()
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+    return {'success': True, 'result': dataset}
+
+
+def _unexpected_batch_error(data_dict):
+    log.exception('Could not import the Data Package at %s',
+                  data_dict.get('url') or 'the given descriptor')
+    return {'success': False, 'error': {
+        'message': 'The Data Package could not be imported'}}
+
+
+def _serializable_errors(error):
+    # Some errors hold the exceptions raised by the datapackage library,
+    # which can't be returned as JSON.
+    errors = {}
+    for key, value in error.error_dict.items():
+        if isinstance(value, (list, dict)):
+            errors[key] = value
+        elif getattr(value, 'errors', None):
+            errors[key] = [six.text_type(e) for e in value.errors]
+        else:
+            errors[key] = [six.text_type(value)]
+    return errors
+
+
+def _discard_batch_item(task):
+    if task.cancel():
+        return
+    try:
+        tempdir, dp, zipped = task.result()
+    except Exception:
+        return
+    if zipped:
+        zipped.close()
+    shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def _load_datapackage(data_dict, directory):
+    '''Load and validate the Data Package at the ``url``, in the ``upload``
+    or at the local ``path`` of ``data_dict``, using ``directory`` for its
+    files.
+
+    Whether the user can import a local ``path`` must have been checked with
+    :py:func:`_local_datapackage_path` already.
+
+    Returns a ``(dp, zipped)`` tuple, like :py:func:`_load_datapackage_file`.
+
+    '''
+    upload = data_dict.get('upload')
+    if data_dict.get('path'):
+        return _load_datapackage_file(
+            _resolve_local_path(data_dict['path']))
+    elif _upload_attribute_is_valid(upload):
+        # Spool the upload to disk so it's read from a file instead of from
+        # memory.
+        path = _spool_upload(upload, directory)
+        return _load_datapackage_file(path)
+    else:
+        url = data_dict['url']
+        path = _fetch_datapackage(url, directory)
+        # Resolve relative paths in the descriptor against its url, as if it
+        # had been loaded from there.
+        return _load_datapackage_file(path, base_path=os.path.dirname(url))
+
+
+def _import_datapackage(context, data_dict, path, base_path=None,
+                        progress=None):
+    '''Create a dataset from the Data Package file (or zip archive) at
+    ``path``.
+
+    '''
+    dp, zipped = _load_datapackage_file(path, base_path)
+    try:
+        return _create_dataset(context, data_dict, dp, zipped,
+                               progress or _ignore_progress)
+    finally:
+        if zipped:
+            zipped.close()
+
+
+def _load_datapackage_file(path, base_path=None):
+    '''Load and validate the Data Package file (or zip archive) at ``path``.
+
+    Returns a ``(dp, zipped)`` tuple, where ``zipped`` is the
+    ``ZippedDataPackage`` if it's a zip archive (and has to be closed once the
+    dataset has been created) or ``None``.
+
+    '''
+    zipped = _open_zipped_datapackage(path)
+    try:
+        if zipped:
+            return _load_and_validate_datapackage(zipped), zipped
+        return _load_and_validate_datapackage(path, base_path), None
+    except Exception:
+        if zipped:
+            zipped.close()
+        raise
+
+
+def _create_dataset(context, data_dict, dp, zipped, progress):
+    _validate_data(data_dict, dp, zipped, progress)
 
-    dp = _load_and_validate_datapackage(url=url, upload=upload)
     dataset_dict = converter.package(dp.to_dict())
+    _restore_inline_data(dp, dataset_dict.get('resources', []))
+    metadata_hash = _metadata_hash(dataset_dict)
 
     owner_org = data_dict.get('owner_org')
     if owner_org:
@@ -55,51 +486,283 @@ def package_create_from_datapackage(context, data_dict):
     if name:
         dataset_dict['name'] = name
 
-    resources = dataset_dict.get('resources', [])
-    if resources:
-        del dataset_dict['resources']
+    # The files of the uploaded resources are written to the FileStore first,
+    # under resource ids picked up front, while nothing refers to them yet.
+    # The dataset is then created along with all its resources in a single
+    # package_create call and a single transaction, so it's indexed once.
+    # If anything fails, the transaction is rolled back and the files that
+    # were written are removed, so nothing is left behind.
+    local_dir = _local_files_directory(context, data_dict, zipped)
+    files = []
+    uploads = []
+    try:
+        resources = dataset_dict.get('resources', [])
+        uploads = _prepare_resources(resources, files, zipped, local_dir)
 
-    # Create as draft by default so if there's any issue on creating the
-    # resources and we're unable to purge the dataset, at least it's not shown.
-    dataset_dict['state'] = 'draft'
-    res = _package_create_with_unique_name(context, dataset_dict, name)
+        content_hash = _content_hash(metadata_hash, resources)
+        if toolkit.asbool(data_dict.get('deduplicate', False)):
+            existing = _find_imported_dataset(context, content_hash, owner_org)
+            if existing:
+                return existing
+        dataset_dict.setdefault('extras', []).append(
+            {'key': util.CONTENT_HASH_KEY, 'value': content_hash})
 
-    dataset_id = res['id']
+        for index, upload in uploads:
+            resources[index]['id'] = str(uuid.uuid4())
+        _upload_files([
+            (upload, resources[index]['id']) for index, upload in uploads
+        ], progress)
 
-    if resources:
-        try:
-            _create_resources(dataset_id, context, resources)
-            res = toolkit.get_action('package_show')(
-                context, {'id': dataset_id})
-        except Exception as e:
+        progress('creating')
+        return _package_create_in_transaction(context, dataset_dict, name)
+    except Exception:
+        _discard_files([
+            (upload, resources[index]['id'])
+            for index, upload in uploads if 'id' in resources[index]
+        ])
+        raise
+    finally:
+        for the_file in files:
+            the_file.close()
+
+
+def _validate_data(data_dict, dp, zipped, progress):
+    '''Check the rows of the Data Package's CSV files against their
+    schemas, if ``validate_data`` (or
+    ``ckanext.datapackager.validate_data``) is set.
+
+    The files are checked at the same time by a pool of
+    ``ckanext.datapackager.validation_workers`` processes (one per CPU by
+    default), and checking stops once
+    ``ckanext.datapackager.validation_max_errors`` errors have been found.
+    Only the files that would be uploaded are checked, not linked ones.
+
+    :raises ckan.plugins.toolkit.ValidationError: listing the resource and
+        row of each error
+
+    '''
+    validate_data = data_dict.get('validate_data')
+    if validate_data is None:
+        validate_data = toolkit.config.get(
+            'ckanext.datapackager.validate_data', False)
+    if not toolkit.asbool(validate_data):
+        return
+
+    sources = []
+    for index, resource in enumerate(dp.descriptor.get('resources', [])):
+        schema = resource.get('schema')
+        path = resource.get('path')
+        if isinstance(path, list):
+            path = path[0] if len(path) == 1 else None
+        if not isinstance(schema, dict) or \
+                not tabular.is_csv(resource, path):
+            continue
+
+        if isinstance(resource.get('data'), six.string_types):
+            source = ('data', resource['data'])
+        elif zipped and _is_relative_path(path):
+            source = ('zip', zipped.path, path)
+        elif path and dp.resources[index].local:
+            source = ('path', dp.resources[index].source)
+        else:
+            continue
+        sources.append((resource.get('name') or six.text_type(index), {
+            'source': source,
+            'schema': schema,
+            'encoding': resource.get('encoding'),
+            'dialect': resource.get('dialect'),
+        }))
+
+    if not sources:
+        return
+
+    progress('validating')
+    max_workers = toolkit.asint(toolkit.config.get(
+        'ckanext.datapackager.validation_workers', 0)) or None
+    errors = tabular.validate_all(
+        sources, max_workers=max_workers,
+        max_errors=toolkit.asint(toolkit.config.get(
+            'ckanext.datapackager.validation_max_errors', 100)))
+    if errors:
+        raise toolkit.ValidationError({'data': [
+            u'Resource "{0}", row {1}: {2}'.format(
+                error['resource'], error['row'], error['message'])
+            if error['row'] else
+            u'Resource "{0}": {1}'.format(error['resource'], error['message'])
+            for error in errors
+        ]})
+
+
+def _metadata_hash(dataset_dict):
+    return util.hash_json(dict(
+        (key, value) for key, value in dataset_dict.items()
+        if key != 'resources'
+    ))
+
+
+def _content_hash(metadata_hash, resources):
+    '''Return the hash of a Data Package's contents.
+
+    ``resources`` are the dataset's resources, after
+    :py:func:`_prepare_resources` has added their hashes.
+
+    '''
+    return util.hash_json([
+        metadata_hash,
+        [resource[util.CONTENT_HASH_KEY] for resource in resources],
+    ])
+
+
+def _package_create_in_transaction(context, dataset_dict, name=None):
+    '''Create the dataset, committing only once it's all been created.
+
+    '''
+    model = context['model']
+    try:
+        res = _package_create_with_unique_name(
+            dict(context, defer_commit=True), dataset_dict, name)
+        model.repo.commit()
+    except Exception:
+        model.Session.rollback()
+        raise
+    return res
+
+
+def _discard_files(uploads):
+    '''Remove the files written to the FileStore for an import that failed.
+
+    ``uploads`` is a list of ``(uploader, resource_id)`` tuples. Only files
+    written by uploaders that keep them on the local filesystem can be
+    removed.
+
+    '''
+    for upload, resource_id in uploads:
+        if not hasattr(upload, 'get_path'):
+            continue
+        path = upload.get_path(resource_id)
+        for leftover in (path, path + '~'):
             try:
-                toolkit.get_action('package_delete')(
-                    context, {'id': dataset_id})
-            except Exception as e2:
-                six.raise_from(e, e2)
-            else:
-                raise e
+                os.remove(leftover)
+            except OSError:
+                pass
+
+
+def _find_imported_dataset(context, content_hash, owner_org=None):
+    '''Return an active dataset imported from a Data Package with the given
+    content hash, if the user can see one.
+
+    '''
+    model = context['model']
+
+    dataset_ids = [
+        row[0] for row in model.Session.query(model.Package.id)
+        .join(model.PackageExtra,
+              model.PackageExtra.package_id == model.Package.id)
+        .filter(model.PackageExtra.key == util.CONTENT_HASH_KEY)
+        .filter(model.PackageExtra.value == content_hash)
+        .filter(model.Package.state == 'active')
+        .order_by(model.Package.metadata_created)
+    ]
+
+    for dataset_id in dataset_ids:
+        try:
+            dataset = toolkit.get_action('package_show')(
+                dict(context), {'id': dataset_id})
+        except (toolkit.NotAuthorized, toolkit.ObjectNotFound):
+            continue
+        if owner_org and owner_org not in (
+                dataset.get('owner_org'),
+                (dataset.get('organization') or {}).get('name')):
+            continue
+        return dataset
+
+    return None
+
+
+def _ignore_progress(stage, done=None, total=None):
+    pass
+
+
+def _enqueue_import(context, data_dict, upload_path=None):
+    '''Enqueue a background job to import the Data Package in ``data_dict``.
 
-    res['state'] = 'active'
-    return toolkit.get_action('package_update')(context, res)
+    If ``upload_path`` is given, it's the path to the Data Package's file in a
+    directory of its own inside the ``jobs`` working directory, which the job
+    will remove.
 
+    '''
+    import ckanext.datapackager.jobs as jobs
+
+    toolkit.check_access('package_create', context)
+
+    job_data_dict = dict(
+        (key, data_dict[key])
+        for key in ('url', 'path', 'name', 'private', 'owner_org',
+                    'deduplicate', 'validate_data')
+        if data_dict.get(key) is not None
+    )
+
+    # The upload only lives as long as this request does, so it's spooled to
+    # a directory that the job (which will remove it) can get to.
+    upload = data_dict.get('upload')
+    if upload_path:
+        job_data_dict['upload_path'] = upload_path
+    elif _upload_attribute_is_valid(upload):
+        directory = tempfile.mkdtemp(
+            dir=util.get_working_directory('jobs'))
+        job_data_dict['upload_path'] = _spool_upload(upload, directory)
 
-def _load_and_validate_datapackage(url=None, upload=None):
     try:
+        job = toolkit.enqueue_job(
+            jobs.import_datapackage,
+            [context['user'], job_data_dict],
+            title='Import Data Package',
+            queue=toolkit.config.get(
+                'ckanext.datapackager.jobs_queue', 'default'),
+        )
+    except Exception:
+        # No job will ever remove the file
+        if job_data_dict.get('upload_path'):
+            shutil.rmtree(os.path.dirname(job_data_dict['upload_path']),
+                          ignore_errors=True)
+        raise
 
-        if _upload_attribute_is_valid(upload):
-            if toolkit.check_ckan_version(min_version="2.9"):
-                dp = datapackage.DataPackage(upload)
-            else:
-                dp = datapackage.DataPackage(upload.file)
-        else:
+    return jobs.job_status(job)
+
+
+def _load_and_validate_datapackage(source, base_path=None):
+    '''Load the Data Package in ``source`` (the path to its descriptor, the
+    descriptor itself, or a ``ZippedDataPackage``) and validate it.
 
-            dp = datapackage.DataPackage(url)
+    Descriptors larger than ``ckanext.datapackager.inline_data_max_size``
+    megabytes aren't parsed, which is what bounds the memory used by their
+    inline data, and the ones whose resources have more than
+    ``ckanext.datapackager.inline_data_max_rows`` rows of inline data in
+    total are rejected once parsed. The inline data is then taken out of the
+    descriptor before it's given to ``datapackage``, which would copy it
+    several times, and put back in the dataset's resources by
+    :py:func:`_restore_inline_data`.
 
+    '''
+    max_rows = toolkit.asint(toolkit.config.get(
+        'ckanext.datapackager.inline_data_max_rows', 1000000))
+    max_size = toolkit.asint(toolkit.config.get(
+        'ckanext.datapackager.inline_data_max_size', 100)) * 1024 * 1024
+    try:
+        if isinstance(source, archive.ZippedDataPackage):
+            source = source.descriptor(max_size=max_size)
+        elif not isinstance(source, dict):
+            if base_path is None:
+                base_path = os.path.dirname(os.path.abspath(source))
+            source = _read_descriptor(source, max_size)
+        _check_inline_data_rows(source, max_rows)
+        source, inline_data = _extract_inline_data(source)
+        dp = datapackage.DataPackage(source, base_path=base_path)
         dp.validate()
     except (datapackage.exceptions.DataPackageException,
             datapackage.exceptions.SchemaError,
-            datapackage.exceptions.ValidationError) as e:
+            datapackage.exceptions.ValidationError,
+            exceptions.InvalidZipArchiveException) as e:
 
         msg = {'datapackage': e}
         raise toolkit.ValidationError(msg)
@@ -108,71 +771,532 @@ def _load_and_validate_datapackage(url=None, upload=None):
         msg = {'datapackage': ['the Data Package has unsafe attributes']}
         raise toolkit.ValidationError(msg)
 
+    dp.datapackager_inline_data = inline_data
     return dp
 
 
+def _check_inline_data_rows(descriptor, max_rows):
+    '''Raise a ``ValidationError`` if the resources of ``descriptor`` have
+    more than ``max_rows`` rows of inline data in total.
+
+    Only the ``data`` of the objects in the descriptor's ``resources`` is
+    counted, not any objects inside that data.
+
+    '''
+    rows = 0
+    resources = descriptor.get('resources') \
+        if isinstance(descriptor, dict) else None
+    for resource in resources if isinstance(resources, list) else []:
+        if isinstance(resource, dict) and \
+                isinstance(resource.get('data'), list):
+            rows += len(resource['data'])
+    if rows > max_rows:
+        raise toolkit.ValidationError({'datapackage': [
+            'The Data Package has more than the maximum of {0} rows of '
+            'inline data'.format(max_rows)]})
+
+
+def _read_descriptor(path, max_size):
+    if os.path.getsize(path) > max_size:
+        raise toolkit.ValidationError({'datapackage': [
+            'The Data Package is larger than the maximum of {0} '
+            'bytes'.format(max_size)]})
+    with open(path, 'rb') as f:
+        try:
+            return json.loads(f.read().decode('utf-8'))
+        except ValueError as e:
+            raise toolkit.ValidationError({'datapackage': [
+                'Unable to parse the Data Package: {0}'.format(e)]})
+
+
+def _extract_inline_data(descriptor):
+    '''Return a copy of ``descriptor`` without its resources' inline data,
+    and that data, by the index of its resource.
+
+    The data is replaced by an empty value of the same type, so the
+    descriptor is still valid. Only the descriptor and its resources are
+    copied, not the data.
+
+    '''
+    resources = descriptor.get('resources')
+    if not isinstance(resources, list):
+        return descriptor, {}
+
+    inline_data = {}
+    descriptor = dict(descriptor, resources=list(resources))
+    for index, resource in enumerate(resources):
+        if isinstance(resource, dict) and \
+                isinstance(resource.get('data'), (list, dict)):
+            inline_data[index] = resource['data']
+            descriptor['resources'][index] = dict(
+                resource, data=type(resource['data'])())
+    return descriptor, inline_data
+
+
+def _restore_inline_data(dp, resources):
+    '''Put the inline data taken out of ``dp``'s descriptor back in
+    ``resources``, the dataset's resources converted from it.
+
+    '''
+    inline_data = getattr(dp, 'datapackager_inline_data', {})
+    for index, data in inline_data.items():
+        resources[index]['data'] = data
+
+
+def _spool_upload(upload, directory):
+    '''Copy the uploaded datapackage into ``directory`` and return its path.
+
+    The upload is copied in chunks of ``ckanext.datapackager.upload_chunk_size``
+    bytes, so memory usage doesn't grow with the size of the upload.
+
+    '''
+    chunk_size = toolkit.asint(toolkit.config.get(
+        'ckanext.datapackager.upload_chunk_size', util.DEFAULT_CHUNK_SIZE))
+
+    path = os.path.join(directory, 'datapackage')
+    with open(path, 'wb') as f:
+        util.copy_in_chunks(_upload_file(upload), f, chunk_size)
+
+    return path
+
+
+def _upload_file(upload):
+    if toolkit.check_ckan_version(min_version="2.9"):
+        return upload
+    else:
+        return upload.file
+
+
+def _local_datapackage_path(context, data_dict):
+    '''Return the real path of the Data Package at the ``path`` in
+    ``data_dict``, on the server's filesystem, or ``None`` if there's none.
+
+    Only sysadmins can import local Data Packages, and only the ones inside
+    ``ckanext.datapackager.local_import_dir``.
+
+    '''
+    # We need to do a direct import here, there's no nicer way yet.
+    import ckan.authz as authz
+
+    path = data_dict.get('path')
+    if not path:
+        return None
+
+    if not (context.get('ignore_auth') or
+            authz.is_sysadmin(context.get('user'))):
+        raise toolkit.NotAuthorized(
+            'Only sysadmins can import local Data Packages')
+    return _resolve_local_path(path)
+
+
+def _resolve_local_path(path):
+    root = toolkit.config.get('ckanext.datapackager.local_import_dir')
+    if not root:
+        raise toolkit.ValidationError(
+            {'path': ['Importing local Data Packages is disabled']})
+
+    real_path = os.path.realpath(os.path.join(root, path))
+    if not _is_inside(real_path, root) or not os.path.isfile(real_path):
+        raise toolkit.ValidationError({'path': ['File not found']})
+    return real_path
+
+
+def _local_files_directory(context, data_dict, zipped):
+    '''Return the directory that the resources' files of a local Data
+    Package are in, or ``None`` if it's not a local one.
+
+    '''
+    path = _local_datapackage_path(context, data_dict)
+    if not path or zipped:
+        return None
+    return os.path.dirname(path)
+
+
+def _is_inside(path, directory):
+    directory = os.path.realpath(directory)
+    return os.path.realpath(path).startswith(directory.rstrip(os.sep) + os.sep)
+
+
+def _get_chunked_upload(context, data_dict):
+    '''Return the chunked upload with the ``id`` in ``data_dict``.
+
+    Only the user who started the upload, or a sysadmin, can get it.
+
+    '''
+    # We need to do a direct import here, there's no nicer way yet.
+    import ckan.authz as authz
+
+    upload_id = data_dict.get('id')
+    if not upload_id:
+        raise toolkit.ValidationError({'id': ['Missing value']})
+
+    try:
+        chunked = chunked_uploads.ChunkedUpload.get(
+            upload_id, _chunked_upload_ttl())
+    except exceptions.UploadNotFoundException:
+        raise toolkit.ObjectNotFound('Upload not found')
+
+    user = context.get('user')
+    if not (context.get('ignore_auth') or authz.is_sysadmin(user)
+            or chunked.meta['user'] == user):
+        raise toolkit.NotAuthorized('Unauthorized to use this upload')
+
+    return chunked
+
+
+def _lock_chunked_upload(chunked):
+    '''Wait for the lock of a chunked upload, so that its chunks and its
+    import aren't handled by several requests at once.
+
+    '''
+    try:
+        return chunked.lock()
+    except exceptions.UploadNotFoundException:
+        raise toolkit.ObjectNotFound('Upload not found')
+
+
+def _chunked_upload_max_size():
+    return toolkit.asint(toolkit.config.get(
+        'ckanext.datapackager.chunked_upload_max_size', 10240)) * 2 ** 20
+
+
+def _chunked_upload_ttl():
+    return toolkit.asint(toolkit.config.get(
+        'ckanext.datapackager.chunked_upload_ttl', 86400))
+
+
+def _non_negative_int(value, key):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        value = -1
+    if value < 0:
+        raise toolkit.ValidationError(
+            {key: ['must be a non-negative integer']})
+    return value
+
+
+def _fetch_datapackage(url, directory):
+    '''Download the datapackage at ``url`` into ``directory`` and return its
+    path.
+
+    '''
+    try:
+        return fetch.get_fetcher().fetch(url, directory)
+    except exceptions.CouldNotFetchException as e:
+        raise toolkit.ValidationError({'url': [str(e)]})
+
+
+def _open_zipped_datapackage(path):
+    '''Return the ``ZippedDataPackage`` at ``path``, if it's a zip archive.
+
+    The sizes of its files are limited by
+    ``ckanext.datapackager.zip_max_member_size`` and
+    ``ckanext.datapackager.zip_max_total_size`` (both in megabytes).
+
+    '''
+    if not archive.is_zip_archive(path):
+        return None
+
+    max_member_size = toolkit.asint(toolkit.config.get(
+        'ckanext.datapackager.zip_max_member_size',
+        toolkit.config.get('ckan.max_resource_size', 10)))
+    max_total_size = toolkit.asint(toolkit.config.get(
+        'ckanext.datapackager.zip_max_total_size', 10240))
+
+    try:
+        return archive.ZippedDataPackage(
+            path,
+            max_member_size=max_member_size * 2 ** 20,
+            max_total_size=max_total_size * 2 ** 20,
+        )
+    except exceptions.InvalidZipArchiveException as e:
+        raise toolkit.ValidationError({'datapackage': [str(e)]})
+
+
 def _package_create_with_unique_name(context, dataset_dict, name=None):
-    res = None
     if name:
         dataset_dict['name'] = name
+        return toolkit.get_action('package_create')(context, dataset_dict)
 
-    try:
-        res = toolkit.get_action('package_create')(context, dataset_dict)
-    except toolkit.ValidationError as e:
-        if not name and \
-           'That URL is already in use.' in e.error_dict.get('name', []):
-            random_num = random.randint(0, 9999999999)
-            name = '{name}-{rand}'.format(name=dataset_dict.get('name', 'dp'),
-                                          rand=random_num)
-            dataset_dict['name'] = name
+    # Another import could take the name we picked before we create the
+    # dataset, in which case we pick the next free one and try again. If it
+    # does so after the name was validated, inserting the dataset fails, so
+    # each attempt is made in a savepoint that can be rolled back on its own.
+    model = context['model']
+    base_name = dataset_dict.get('name') or 'dp'
+    for attempt in range(MAX_NAME_ATTEMPTS):
+        dataset_dict['name'] = _free_dataset_name(context, base_name)
+        savepoint = model.Session.begin_nested()
+        try:
             res = toolkit.get_action('package_create')(context, dataset_dict)
+        except toolkit.ValidationError as e:
+            savepoint.rollback()
+            if 'That URL is already in use.' not in \
+                    e.error_dict.get('name', []) or \
+                    attempt == MAX_NAME_ATTEMPTS - 1:
+                raise
+        except sqlalchemy.exc.IntegrityError:
+            savepoint.rollback()
+            if attempt == MAX_NAME_ATTEMPTS - 1 or \
+                    _free_dataset_name(context, base_name) == \
+                    dataset_dict['name']:
+                # It wasn't the name that clashed
+                raise
         else:
-            raise
+            savepoint.commit()
+            return res
+
+
+def _free_dataset_name(context, base_name):
+    '''Return ``base_name``, or ``base_name`` followed by the lowest numeric
+    suffix (``-1``, ``-2``...) that no other dataset is using.
+
+    The names in use are found with a single query, so no dataset is created
+    just to find out that its name is taken. The ``LIKE`` only uses the index
+    on the name column if the database's collation is ``C`` (or the index is
+    built with ``text_pattern_ops``), as range queries on the other
+    collations don't match prefixes.
+
+    '''
+    model = context['model']
+
+    pattern = base_name.replace('\\', '\\\\').replace('%', '\\%') \
+        .replace('_', '\\_') + '-%'
+    taken = set(
+        row[0] for row in model.Session.query(model.Package.name).filter(
+            sqlalchemy.or_(
+                model.Package.name == base_name,
+                model.Package.name.like(pattern, escape='\\'),
+            )
+        )
+    )
+
+    if base_name not in taken:
+        return base_name
+    suffixes = set()
+    for taken_name in taken:
+        suffix = taken_name[len(base_name) + 1:]
+        if suffix.isdigit():
+            suffixes.add(int(suffix))
+    suffix = 1
+    while suffix in suffixes:
+        suffix += 1
+    return '{0}-{1}'.format(base_name, suffix)
 
-    return res
 
+def _prepare_resources(resources, files, zipped=None, local_dir=None):
+    '''Get the resources ready to be created along with their dataset.
+
+    The files of the resources with inline data or a local path are opened
+    (from the ``zipped`` Data Package's archive, or from ``local_dir`` for
+    trusted local imports) and appended to ``files``. Returns a list of
+    ``(index, uploader)`` tuples, one for each of those resources, where
+    ``uploader.upload(resource_id)`` writes the file to the FileStore once
+    the resource has been created.
+
+    The hash of each resource's contents is stored in its
+    ``util.CONTENT_HASH_KEY`` field, the checksum of its file (if it has one)
+    in its ``util.FILE_CHECKSUM_KEY`` field, and CSV files without a
+    ``schema`` get one inferred from their first rows.
+
+    '''
+    uploads = []
+    for index, resource in enumerate(resources):
+        # TODO: Investigate why in test_controller the resource['url'] is a list
+        if type(resource.get('url')) is list:
+            resource['url'] = resource['url'][0]
+
+        # Links are covered by the descriptor itself, inline data and local
+        # files by the checksum of their contents.
+        descriptor_hash = util.hash_json(dict(
+            (key, value) for key, value in resource.items() if key != 'data'))
+        checksum = None
+        digested = None
+        tabular_file = True
 
-def _create_resources(dataset_id, context, resources):
-    for resource in resources:
-        resource['package_id'] = dataset_id
         if resource.get('data'):
-            _create_and_upload_resource_with_inline_data(context, resource)
+            checksum = 'json:' + util.hash_json(resource['data'])
+            tabular_file = isinstance(resource['data'], six.string_types)
+            the_file, filename = _inline_data_file(resource)
+            tabular_file = tabular_file or filename.endswith('.csv')
         elif resource.get('path'):
-            _create_and_upload_local_resource(context, resource)
+            the_file = _open_local_resource_file(
+                resource.pop('path'), zipped, local_dir)
+            filename = the_file.name
+            checksum, digested = _file_checksum(
+                the_file, _upload_hash_algorithms(resource))
+        elif (zipped or local_dir) and \
+                _is_relative_path(resource.get('url')):
+            # The converter maps the resource's path to its url, so this is
+            # the path of its file inside the archive (or the directory).
+            the_file = _open_local_resource_file(
+                resource['url'], zipped, local_dir)
+            filename = the_file.name
+            checksum, digested = _file_checksum(
+                the_file, _upload_hash_algorithms(resource))
         else:
-            # TODO: Investigate why in test_controller the resource['url'] is a list
-            if type(resource['url']) is list:
-                resource['url'] = resource['url'][0]
-            toolkit.get_action('resource_create')(context, resource)
+            resource[util.CONTENT_HASH_KEY] = descriptor_hash
+            continue
 
+        resource[util.CONTENT_HASH_KEY] = util.hash_json(
+            [descriptor_hash, checksum])
+        resource[util.FILE_CHECKSUM_KEY] = checksum
+        files.append(the_file)
+        if tabular_file and not resource.get('schema') and \
+                tabular.is_csv(resource, filename):
+            _infer_schema(resource, the_file)
+        # Trusted local files can be placed in the FileStore directly
+        source_path = the_file.name if local_dir and \
+            not isinstance(the_file, archive.ZipMemberFile) else None
+        uploads.append((index, _resource_uploader(
+            resource, the_file, os.path.basename(filename), digested,
+            source_path)))
 
-def _create_and_upload_resource_with_inline_data(context, resource):
-    prefix = resource.get('name', 'tmp')
-    data = resource['data']
+    return uploads
+
+
+def _infer_schema(resource, the_file):
+    '''Set the ``schema`` of a CSV resource to one inferred from the first
+    rows of its file, and rewind the file.
+
+    Up to ``ckanext.datapackager.infer_schema_max_rows`` rows (0 to not infer
+    schemas) in the first ``ckanext.datapackager.infer_schema_max_bytes``
+    bytes of the file are used. Files that can't be read as CSV are left
+    without a schema.
+
+    '''
+    max_rows = toolkit.asint(toolkit.config.get(
+        'ckanext.datapackager.infer_schema_max_rows', 100))
+    max_bytes = toolkit.asint(toolkit.config.get(
+        'ckanext.datapackager.infer_schema_max_bytes', 2 ** 20))
+    if max_rows <= 0 or max_bytes <= 0:
+        return
+
+    try:
+        resource['schema'] = tabular.infer_schema(
+            the_file, max_rows=max_rows, max_bytes=max_bytes,
+            encoding=resource.get('encoding'),
+            dialect=resource.get('dialect'))
+    except exceptions.CouldNotReadCSVException:
+        pass
+    finally:
+        the_file.seek(0)
+
+
+def _file_checksum(the_file, algorithms=()):
+    '''Return a checksum of the contents of a resource's file, and the
+    ``util.DigestingReader`` that read it (or ``None``).
+
+    The file is hashed with SHA-256 in chunks, with the other ``algorithms``
+    as well so it doesn't have to be read again for those, and then rewound.
+    Files in a zip archive are hashed too, rather than trusting the CRC-32
+    recorded in the archive, which is easy to collide.
+
+    '''
+    reader = util.DigestingReader(
+        the_file, set(algorithms) | set(['sha256']))
+    for chunk in iter(lambda: reader.read(util.DEFAULT_CHUNK_SIZE), b''):
+        pass
+    # Rewind the file itself, so the reader keeps its digests
+    the_file.seek(0)
+    return 'sha256:' + reader.hexdigest('sha256'), reader
+
+
+def _inline_data_file(resource):
+    '''Return a file with the resource's inline data, and its file name.
+
+    Data that isn't a string is encoded in the
+    ``ckanext.datapackager.inline_data_format``: ``json`` (the default),
+    indented by ``ckanext.datapackager.inline_data_indent`` spaces (0 for
+    compact JSON), ``ndjson`` for arrays, or ``csv`` for arrays of rows
+    (which are arrays, or objects). Data that can't be encoded in that
+    format is encoded as JSON. The data is written to the file as it's
+    encoded, and the file is only moved to disk once it's bigger than
+    ``ckanext.datapackager.inline_data_max_memory`` bytes.
 
+    '''
+    name = resource.get('name', 'data')
+    data = resource['data']
     del resource['data']
-    if not isinstance(data, six.string_types):
-        data = json.dumps(data, indent=2)
 
-    with tempfile.NamedTemporaryFile(prefix=prefix) as f:
-        if six.PY3:
-            f.write(six.binary_type(data, 'utf-8'))
-        else:
-            f.write(six.binary_type(data))
-        f.seek(0)
+    data_format = toolkit.config.get(
+        'ckanext.datapackager.inline_data_format', 'json').lower()
+
+    f = tempfile.SpooledTemporaryFile(
+        max_size=toolkit.asint(toolkit.config.get(
+            'ckanext.datapackager.inline_data_max_memory', 2 ** 20)))
+    if isinstance(data, six.string_types):
+        f.write(data.encode('utf-8') if isinstance(data, six.text_type)
+                else data)
+        filename = name
+    elif data_format == 'csv' and _is_table(data):
+        util.write_csv(data, f, headers=_table_headers(resource, data))
+        filename = name + '.csv'
+    elif data_format == 'ndjson' and isinstance(data, list):
+        util.write_ndjson(data, f)
+        filename = name + '.ndjson'
+    else:
+        util.write_json(data, f, indent=toolkit.asint(toolkit.config.get(
+            'ckanext.datapackager.inline_data_indent', 2)))
+        filename = name + '.json'
+    f.seek(0)
+
+    return f, filename
+
+
+def _is_table(data):
+    '''Return whether ``data`` is a list of rows that are all lists, or all
+    dicts.
+
+    '''
+    if not isinstance(data, list) or not data:
+        return False
+    row_type = list if isinstance(data[0], list) else dict
+    return all(isinstance(row, row_type) for row in data)
+
 
-        _create_and_upload_resource(context, resource, f)
+def _table_headers(resource, data):
+    '''Return the headers to write the rows in ``data`` with, or ``None``
+    if they're lists, whose first row is the header.
 
+    The headers of rows that are dicts are the names of the fields in the
+    resource's schema, or otherwise all the rows' keys.
 
-def _create_and_upload_local_resource(context, resource):
-    path = resource['path']
-    del resource['path']
+    '''
+    if not isinstance(data[0], dict):
+        return None
+
+    schema = resource.get('schema')
+    if isinstance(schema, dict) and schema.get('fields'):
+        return [field.get('name') for field in schema['fields']]
+
+    headers = []
+    seen = set()
+    for row in data:
+        for key in row:
+            if key not in seen:
+                seen.add(key)
+                headers.append(key)
+    return headers
+
+
+def _is_relative_path(url):
+    return bool(url) and not urlparse(url).scheme and not url.startswith('/')
+
+
+def _open_local_resource_file(path, zipped=None, local_dir=None):
     if isinstance(path, list):
         path = path[0]
     try:
-        with open(path, 'r') as f:
-            _create_and_upload_resource(context, resource, f)
-    except IOError:
+        if zipped:
+            return zipped.open_resource(path)
+        if local_dir:
+            path = os.path.realpath(os.path.join(local_dir, path))
+            if not _is_inside(path, local_dir):
+                raise IOError('Not in the local directory: ' + path)
+        return open(path, 'rb')
+    except (IOError, exceptions.InvalidZipArchiveException):
         msg = {'datapackage': [(
             "Couldn't create some of the resources."
             " Please make sure that all resources' files are accessible."
@@ -180,16 +1304,222 @@ def _create_and_upload_local_resource(context, resource):
         raise toolkit.ValidationError(msg)
 
 
-def _create_and_upload_resource(context, resource, the_file):
+def _resource_uploader(resource, the_file, filename, digested=None,
+                       source_path=None):
+    '''Return the uploader that will write ``the_file`` for ``resource``.
+
+    The uploader sets the resource's ``url``, ``url_type``, ``size`` and
+    ``mimetype``, so it can be created without the file itself. The file's
+    size and hash are worked out while it's being written (unless it's
+    already been read through by the ``digested`` ``util.DigestingReader``),
+    and stored in the resource's ``size`` and ``hash`` when it's uploaded.
+
+    If ``source_path`` is given and the FileStore is on the local filesystem,
+    the file at that path is placed in the FileStore with
+    :py:func:`ckanext.datapackager.lib.util.place_file` instead of being
+    copied through Python.
+
+    '''
+    # We need to do a direct import here, there's no nicer way yet.
+    import ckan.lib.uploader as uploader
+
+    declared_size = resource.get('size')
+    declared_hash = resource.get('hash')
+    if digested is None:
+        reader = util.DigestingReader(
+            the_file, _upload_hash_algorithms(resource))
+    else:
+        reader = digested
+
     resource['url'] = 'url'
     resource['url_type'] = 'upload'
 
+    source = the_file if digested else reader
     if toolkit.check_ckan_version(min_version="2.9"):
-        resource['upload'] = FileStorage(the_file, the_file.name, the_file.name)
+        resource['upload'] = FileStorage(source, filename, filename)
     else:
-        resource['upload'] = _UploadLocalFileStorage(the_file)
+        resource['upload'] = _UploadLocalFileStorage(source, filename)
+
+    upload = uploader.get_resource_uploader(resource)
+    resource.pop('upload', None)
+    if 'size' not in resource and hasattr(upload, 'filesize'):
+        resource['size'] = upload.filesize
+    if 'mimetype' not in resource and getattr(upload, 'mimetype', None):
+        resource['mimetype'] = upload.mimetype
+
+    if source_path and hasattr(uploader, 'ResourceUpload') and \
+            type(upload).upload == uploader.ResourceUpload.upload:
+        upload = _PlacedUpload(upload, source_path)
+
+    return _DigestingUpload(
+        upload, reader, resource, declared_size, declared_hash)
+
+
+def _upload_hash_algorithms(resource):
+    '''Return the algorithms that the file of ``resource`` has to be hashed
+    with: the configured one, and the one of its declared ``hash``.
+
+    '''
+    algorithms = set([_hash_algorithm()])
+    if resource.get('hash'):
+        algorithms.add(_parse_hash(resource['hash'])[0])
+    return [a for a in algorithms if a in HASH_ALGORITHMS]
 
-    toolkit.get_action('resource_create')(context, resource)
+
+class _PlacedUpload(object):
+    '''A local FileStore uploader that places the file at ``source_path``
+    in the FileStore, with a clone or a copy made by the kernel, instead of
+    writing it out again. It's still read once beforehand, by
+    :py:func:`_file_checksum`, since its hash is needed before it's uploaded.
+
+    '''
+
+    def __init__(self, upload, source_path):
+        self._upload = upload
+        self._source_path = source_path
+
+    def upload(self, resource_id, max_size):
+        if os.path.getsize(self._source_path) > max_size * 1024 * 1024:
+            raise toolkit.ValidationError(
+                {'upload': ['File upload too large']})
+
+        target = self._upload.get_path(resource_id)
+        try:
+            os.makedirs(os.path.dirname(target))
+        except OSError:
+            pass
+        methods = toolkit.config.get(
+            'ckanext.datapackager.local_import_methods',
+            ' '.join(util.PLACE_FILE_METHODS)).split()
+        util.place_file(self._source_path, target, methods)
+
+    def __getattr__(self, name):
+        return getattr(self._upload, name)
+
+
+def _hash_algorithm():
+    algorithm = toolkit.config.get(
+        'ckanext.datapackager.hash_algorithm', 'md5').lower()
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(
+            'Unsupported ckanext.datapackager.hash_algorithm: {0}'.format(
+                algorithm))
+    return algorithm
+
+
+def _parse_hash(value):
+    '''Return the algorithm and the hex digest of a Data Package ``hash``.
+
+    Hashes without an ``algorithm:`` prefix are MD5 ones.
+
+    '''
+    algorithm, _, digest = value.rpartition(':')
+    return (algorithm.lower() or 'md5'), digest.lower()
+
+
+def _format_hash(algorithm, digest):
+    if algorithm == 'md5':
+        return digest
+    return '{0}:{1}'.format(algorithm, digest)
+
+
+class _DigestingUpload(object):
+    '''A resource's uploader, that records the size and hash of the file it
+    writes in the resource.
+
+    If the Data Package declared the resource's ``bytes`` or ``hash``, the
+    file is checked against them once it's been written.
+
+    '''
+
+    def __init__(self, upload, reader, resource, declared_size=None,
+                 declared_hash=None):
+        self._upload = upload
+        self._reader = reader
+        self._resource = resource
+        self._declared_size = declared_size
+        self._declared_hash = declared_hash
+
+    def upload(self, resource_id, max_size):
+        self._upload.upload(resource_id, max_size)
+
+        # Uploaders that didn't read the file through (e.g. because it's
+        # stored somewhere else) leave the resource as it is.
+        if not self._reader.complete:
+            return
+
+        size = self._reader.size
+        if self._declared_size not in (None, '') and \
+                _as_int(self._declared_size) != size:
+            raise toolkit.ValidationError({'datapackage': [
+                'Resource "{0}" is {1} bytes long, not the {2} declared in '
+                'the Data Package'.format(
+                    self._name(), size, self._declared_size)]})
+
+        if self._declared_hash:
+            algorithm, expected = _parse_hash(self._declared_hash)
+            if algorithm in HASH_ALGORITHMS and \
+                    self._reader.hexdigest(algorithm) != expected:
+                raise toolkit.ValidationError({'datapackage': [
+                    'Resource "{0}" doesn\'t match the hash declared in the '
+                    'Data Package'.format(self._name())]})
+        else:
+            algorithm = _hash_algorithm()
+            self._resource['hash'] = _format_hash(
+                algorithm, self._reader.hexdigest(algorithm))
+        self._resource['size'] = size
+
+    def _name(self):
+        return self._resource.get('name') or self._resource.get('id')
+
+    def __getattr__(self, name):
+        return getattr(self._upload, name)
+
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _upload_files(uploads, progress=_ignore_progress):
+    '''Write files to the FileStore, using a pool of threads.
+
+    ``uploads`` is a list of ``(uploader, resource_id)`` tuples. Up to
+    ``ckanext.datapackager.upload_workers`` files are written at a time, and
+    ``progress`` is called after each of them.
+
+    '''
+    # We need to do a direct import here, there's no nicer way yet.
+    import ckan.lib.uploader as uploader
+
+    if not uploads:
+        return
+
+    max_size = uploader.get_max_resource_size()
+    max_workers = toolkit.asint(toolkit.config.get(
+        'ckanext.datapackager.upload_workers', 1))
+
+    with futures.ThreadPoolExecutor(max_workers=max(max_workers, 1)) as pool:
+        tasks = [
+            pool.submit(upload.upload, resource_id, max_size)
+            for upload, resource_id in uploads
+        ]
+        try:
+            for done, task in enumerate(futures.as_completed(tasks), 1):
+                try:
+                    task.result()
+                except exceptions.InvalidZipArchiveException as e:
+                    # Files in corrupt archives fail as they're uploaded
+                    raise toolkit.ValidationError({'datapackage': [str(e)]})
+                progress('uploading', done, len(tasks))
+        except Exception:
+            # Don't start uploads that are still waiting for a worker, the
+            # whole import is going to be rolled back anyway.
+            for task in tasks:
+                task.cancel()
+            raise
 
 
 def _upload_attribute_is_valid(upload):
@@ -197,7 +1527,7 @@ def _upload_attribute_is_valid(upload):
 
 # Used only in CKAN < 2.9
 class _UploadLocalFileStorage(cgi.FieldStorage):
-    def __init__(self, fp, *args, **kwargs):
-        self.name = fp.name
-        self.filename = fp.name
+    def __init__(self, fp, filename=None, *args, **kwargs):
+        self.name = filename or fp.name
+        self.filename = filename or fp.name
         self.file = fp
@@ -1,6 +1,9 @@
 import ckan.plugins.toolkit as toolkit
 from frictionless_ckan_mapper import ckan_to_frictionless as converter
 
+import ckanext.datapackager.lib.export_cache as export_cache
+import ckanext.datapackager.lib.util as util
+
 
 @toolkit.side_effect_free
 def package_show_as_datapackage(context, data_dict):
@@ -9,7 +12,10 @@ def package_show_as_datapackage(context, data_dict):
     This returns just the data package metadata in JSON format (what would be
     the contents of the datapackage.json file), it does not return the whole
     multi-file package including datapackage.json file and additional data
-    files.
+    files. That's available at ``/dataset/<id>/datapackage.zip``.
+
+    The Data Packages are cached for each user (see
+    ``ckanext.datapackager.export_cache_size``) until their datasets change.
 
     :param id: the ID of the dataset
     :type id: string
@@ -23,7 +29,125 @@ def package_show_as_datapackage(context, data_dict):
     except KeyError:
         raise toolkit.ValidationError({'id': 'missing id'})
 
+    model = context['model']
+    pkg = model.Package.get(dataset_id)
+    if pkg is None or pkg.metadata_modified is None:
+        # Let package_show deal with it
+        return _dataset_as_datapackage(context, dataset_id)
+
+    toolkit.check_access('package_show', context, {'id': pkg.id})
+
+    cache = export_cache.get_cache()
+    modified = pkg.metadata_modified.isoformat()
+    user = context.get('user')
+    datapackage = cache.get(pkg.id, modified, user)
+    if datapackage is None:
+        datapackage = _dataset_as_datapackage(context, pkg.id)
+        cache.set(pkg.id, modified, datapackage, user)
+    return datapackage
+
+
+def _dataset_as_datapackage(context, dataset_id):
     dataset_dict = toolkit.get_action('package_show')(context,
                                                       {'id': dataset_id})
+    return converter.dataset(_without_content_hashes(dataset_dict))
+
+
+@toolkit.side_effect_free
+def package_show_as_datapackage_cache_stats(context, data_dict):
+    '''Return how well the cache of exported Data Packages is doing.
+
+    Only sysadmins can see it.
+
+    :returns: the number of ``hits`` and ``misses`` of this process's cache
+        since it was started, and its current ``size`` and ``max_size``
+    :rtype: dictionary
+
+    '''
+    # We need to do a direct import here, there's no nicer way yet.
+    import ckan.authz as authz
+
+    user = context.get('user')
+    if not context.get('ignore_auth') and not authz.is_sysadmin(user):
+        raise toolkit.NotAuthorized(
+            'User {0} not authorized to see the cache stats'.format(user))
+
+    return export_cache.get_cache().stats()
+
+
+def _without_content_hashes(dataset_dict):
+    '''Return a copy of ``dataset_dict`` without the content hashes stored by
+    ``package_create_from_datapackage``, which aren't part of the Data Package.
+
+    '''
+    dataset_dict = dict(dataset_dict)
+    dataset_dict['extras'] = [
+        extra for extra in dataset_dict.get('extras', [])
+        if extra.get('key') != util.CONTENT_HASH_KEY
+    ]
+    dataset_dict['resources'] = [
+        dict((key, value) for key, value in resource.items()
+             if key not in (util.CONTENT_HASH_KEY, util.FILE_CHECKSUM_KEY))
+        for resource in dataset_dict.get('resources', [])
+    ]
+    return dataset_dict
+
+
+@toolkit.side_effect_free
+def package_create_from_datapackage_status(context, data_dict):
+    '''Return the status of a background Data Package import.
+
+    Only the user who started the import, or a sysadmin, can see it.
+
+    :param id: the id of the import job, as returned by
+        :py:func:`~ckanext.datapackager.logic.action.create.package_create_from_datapackage`
+        when called with ``background=True``
+    :type id: string
+
+    :returns: the job's ``id``, its ``status`` (``queued``, ``started``,
+        ``finished`` or ``failed``), its ``progress``, the ``dataset_id`` of
+        the created dataset once it's finished and the validation ``error``
+        if it failed
+    :rtype: dictionary
+
+    '''
+    # We need to do a direct import here, there's no nicer way yet.
+    import ckan.lib.jobs as jobs_lib
+    import ckanext.datapackager.jobs as jobs
+
+    try:
+        job_id = data_dict['id']
+    except KeyError:
+        raise toolkit.ValidationError({'id': 'missing id'})
+
+    try:
+        job = jobs_lib.job_from_id(job_id)
+    except KeyError:
+        raise toolkit.ObjectNotFound('Import job not found')
+    if job.func_name != jobs.import_datapackage.__module__ + '.import_datapackage':
+        raise toolkit.ObjectNotFound('Import job not found')
+
+    toolkit.check_access(
+        'package_create_from_datapackage_status', context, {'id': job_id})
+
+    return jobs.job_status(job)
+
+
+@toolkit.side_effect_free
+def datapackage_upload_show(context, data_dict):
+    '''Return the state of a resumable Data Package upload.
+
+    Only the user who started the upload, or a sysadmin, can see it.
+
+    :param id: the id of the upload, as returned by
+        :py:func:`~ckanext.datapackager.logic.action.create.datapackage_upload_init`
+    :type id: string
+
+    :returns: the upload's ``id``, ``offset`` (the number of bytes received so
+        far, i.e. where the next chunk starts) and ``size``
+    :rtype: dictionary
+
+    '''
+    from ckanext.datapackager.logic.action.create import _get_chunked_upload
 
-    return converter.dataset(dataset_dict)
+    return _get_chunked_upload(context, data_dict).as_dict()
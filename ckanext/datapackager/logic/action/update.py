@@ -0,0 +1,317 @@
+import os
+import posixpath
+import shutil
+import tempfile
+import uuid
+
+import ckan.plugins.toolkit as toolkit
+from frictionless_ckan_mapper import frictionless_to_ckan as converter
+
+import ckanext.datapackager.lib.util as util
+from ckanext.datapackager.logic.action import create
+
+
+def package_update_from_datapackage(context, data_dict):
+    '''Update a dataset from a new version of its Data Package.
+
+    The Data Package's resources are matched to the dataset's by their
+    ``name`` (or, failing that, their ``path``), and their contents compared
+    using the hashes stored when they were imported. Only the resources that
+    changed are updated, and only their files that changed are uploaded
+    again. New resources are created, and the ones that aren't in the Data
+    Package anymore are deleted, along with their files. Nothing is done if
+    the Data Package hasn't changed at all.
+
+    The dataset keeps its name, organization and visibility, unless they're
+    given.
+
+    :param id: the id or name of the dataset to update
+    :type id: string
+    :param url: url of the datapackage (optional if `upload` is defined)
+    :type url: string
+    :param upload: the uploaded datapackage (optional if `url` is defined)
+    :type upload: cgi.FieldStorage
+    :param path: the path of a Data Package on the server, like in
+        :py:func:`~ckanext.datapackager.logic.action.create.package_create_from_datapackage`
+        (optional)
+    :type path: string
+    :param name: the new name of the dataset (optional)
+    :type name: string
+    :param private: the new visibility of the dataset (optional)
+    :type private: bool
+    :param owner_org: the id of the dataset's new owning organization
+        (optional)
+    :type owner_org: string
+    :param validate_data: check the rows of the Data Package's CSV files
+        against their schemas first (optional, default:
+        ``ckanext.datapackager.validate_data``)
+    :type validate_data: bool
+
+    :returns: the updated dataset
+    :rtype: dictionary
+
+    '''
+    dataset_id = data_dict.get('id')
+    if not dataset_id:
+        raise toolkit.ValidationError({'id': ['Missing value']})
+
+    if not data_dict.get('url') and \
+            not create._upload_attribute_is_valid(data_dict.get('upload')) \
+            and not data_dict.get('path'):
+        msg = {'url': ['you must define either a url or upload attribute']}
+        raise toolkit.ValidationError(msg)
+    create._local_datapackage_path(context, data_dict)
+
+    toolkit.check_access('package_update', context, {'id': dataset_id})
+    existing = toolkit.get_action('package_show')(
+        dict(context), {'id': dataset_id})
+
+    progress = context.get('datapackager_progress', create._ignore_progress)
+
+    tempdir = tempfile.mkdtemp(prefix='datapackager-')
+    try:
+        dp, zipped = create._load_datapackage(data_dict, tempdir)
+        try:
+            return _update_dataset(
+                context, data_dict, existing, dp, zipped, progress)
+        finally:
+            if zipped:
+                zipped.close()
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+def _update_dataset(context, data_dict, existing, dp, zipped, progress):
+    create._validate_data(data_dict, dp, zipped, progress)
+
+    dataset_dict = converter.package(dp.to_dict())
+    create._restore_inline_data(dp, dataset_dict.get('resources', []))
+    metadata_hash = create._metadata_hash(dataset_dict)
+
+    dataset_dict['id'] = existing['id']
+    for key in ('name', 'owner_org', 'private'):
+        value = data_dict.get(key)
+        if key == 'private' and value is not None:
+            value = toolkit.asbool(value)
+        dataset_dict[key] = existing.get(key) if value in (None, '') \
+            else value
+    dataset_dict['groups'] = [
+        {'id': group['id']} for group in existing.get('groups', [])]
+
+    resources = dataset_dict.get('resources', [])
+    matches = _match_resources(resources, existing.get('resources', []))
+
+    files = []
+    new_uploads = []
+    staged_uploads = []
+    direct_uploads = []
+    # The current resources whose files won't be used anymore
+    obsolete = [
+        current for current in existing.get('resources', [])
+        if current not in matches
+    ]
+    try:
+        local_dir = create._local_files_directory(context, data_dict, zipped)
+        uploads = dict(create._prepare_resources(
+            resources, files, zipped, local_dir))
+
+        content_hash = create._content_hash(metadata_hash, resources)
+        if content_hash == _extra(existing, util.CONTENT_HASH_KEY) and \
+                all(dataset_dict[key] == existing.get(key)
+                    for key in ('name', 'owner_org', 'private')):
+            return existing
+        dataset_dict['extras'] = [
+            extra for extra in dataset_dict.get('extras', [])
+            if extra['key'] != util.CONTENT_HASH_KEY
+        ] + [{'key': util.CONTENT_HASH_KEY, 'value': content_hash}]
+
+        for index, resource in enumerate(resources):
+            current = matches[index]
+            upload = uploads.get(index)
+            if current and current.get(util.CONTENT_HASH_KEY) == \
+                    resource[util.CONTENT_HASH_KEY]:
+                # Unchanged, so it's kept exactly as it is, file included
+                resources[index] = current
+            elif current:
+                resource['id'] = current['id']
+                if upload and _same_file(current, resource):
+                    # Only its metadata changed, so it keeps its file
+                    _keep_file(resource, current)
+                elif upload and hasattr(upload, 'get_path'):
+                    # Write the new file next to the current one, and only
+                    # put it in its place once the dataset's been updated.
+                    staged_uploads.append(
+                        (upload, str(uuid.uuid4()), current['id']))
+                elif upload:
+                    # Other uploaders can't stage files, so the new file is
+                    # only written over the current one once the dataset's
+                    # been updated, and its size and hash saved afterwards.
+                    direct_uploads.append((upload, current['id'], resource))
+            elif upload:
+                resource['id'] = str(uuid.uuid4())
+                new_uploads.append((upload, resource['id']))
+
+            if current and current.get('url_type') == 'upload' and \
+                    resource.get('url_type') != 'upload':
+                obsolete.append(current)
+
+        create._upload_files(
+            new_uploads + [
+                (upload, staging_id)
+                for upload, staging_id, _ in staged_uploads
+            ], progress)
+
+        progress('updating')
+        res = _package_update_in_transaction(context, dataset_dict)
+    except Exception:
+        create._discard_files(new_uploads + [
+            (upload, staging_id) for upload, staging_id, _ in staged_uploads
+        ])
+        raise
+    finally:
+        for the_file in files:
+            the_file.close()
+
+    for upload, staging_id, resource_id in staged_uploads:
+        target = upload.get_path(resource_id)
+        try:
+            os.makedirs(os.path.dirname(target))
+        except OSError:
+            pass
+        os.rename(upload.get_path(staging_id), target)
+
+    if direct_uploads:
+        create._upload_files([
+            (upload, resource_id) for upload, resource_id, _ in direct_uploads
+        ], progress)
+        _save_file_details(
+            context, res, [resource for _, _, resource in direct_uploads])
+
+    _delete_files(obsolete)
+
+    return res
+
+
+def _same_file(current, resource):
+    '''Return whether the file of ``resource`` is the one ``current``
+    already has in the FileStore.
+
+    '''
+    checksum = current.get(util.FILE_CHECKSUM_KEY)
+    return current.get('url_type') == 'upload' and checksum is not None \
+        and checksum == resource.get(util.FILE_CHECKSUM_KEY)
+
+
+def _keep_file(resource, current):
+    '''Point ``resource`` at the file of ``current``, instead of the one it
+    would have uploaded.
+
+    '''
+    for key in ('url', 'url_type'):
+        resource[key] = current.get(key)
+    # The size and mimetype worked out from the file are the same, but the
+    # hash is only recorded as it's uploaded.
+    if not resource.get('hash') and current.get('hash'):
+        resource['hash'] = current['hash']
+
+
+def _delete_files(resources):
+    '''Delete the FileStore files of uploaded ``resources`` that the dataset
+    doesn't use anymore.
+
+    Files are only deleted if the uploader can tell where they are.
+
+    '''
+    # We need to do a direct import here, there's no nicer way yet.
+    import ckan.lib.uploader as uploader
+
+    for resource in resources:
+        if resource.get('url_type') != 'upload':
+            continue
+        upload = uploader.get_resource_uploader(dict(resource))
+        if not hasattr(upload, 'get_path'):
+            continue
+        try:
+            os.remove(upload.get_path(resource['id']))
+        except OSError:
+            pass
+
+
+def _save_file_details(context, dataset_dict, resources):
+    '''Save the ``size`` and ``hash`` of files written after ``dataset_dict``
+    was updated, in its resources and in ``dataset_dict`` itself.
+
+    '''
+    updated = dict((r['id'], r) for r in dataset_dict.get('resources', []))
+    for resource in resources:
+        details = dict(
+            (key, resource[key]) for key in ('size', 'hash')
+            if key in resource and
+            resource[key] != updated[resource['id']].get(key))
+        if not details:
+            continue
+        details['id'] = resource['id']
+        updated[resource['id']].update(
+            toolkit.get_action('resource_patch')(dict(context), details))
+
+
+def _package_update_in_transaction(context, dataset_dict):
+    model = context['model']
+    try:
+        res = toolkit.get_action('package_update')(
+            dict(context, defer_commit=True), dataset_dict)
+        model.repo.commit()
+    except Exception:
+        model.Session.rollback()
+        raise
+    return res
+
+
+def _match_resources(resources, current_resources):
+    '''Return the current resource that matches each of ``resources`` (or
+    ``None``), in the same order.
+
+    Resources are matched by name first, and then by path, which for uploaded
+    files is the name of the file at the end of their url.
+
+    '''
+    available = list(current_resources)
+    matches = []
+    for resource in resources:
+        match = None
+        for key in (_name_key, _path_key):
+            wanted = key(resource)
+            if wanted is None:
+                continue
+            for current in available:
+                if key(current) == wanted:
+                    match = current
+                    break
+            if match:
+                break
+        if match:
+            available.remove(match)
+        matches.append(match)
+    return matches
+
+
+def _name_key(resource):
+    return resource.get('name') or None
+
+
+def _path_key(resource):
+    url = resource.get('url')
+    if isinstance(url, list):
+        url = url[0] if url else None
+    if not url:
+        return None
+    if resource.get('url_type') == 'upload' or create._is_relative_path(url):
+        return posixpath.basename(url)
+    return url
+
+
+def _extra(dataset_dict, key):
+    for extra in dataset_dict.get('extras', []):
+        if extra.get('key') == key:
+            return extra.get('value')
+    return None
@@ -0,0 +1,22 @@
+def package_create_from_datapackage_status(context, data_dict):
+    '''Only the user who started a background import can see its status
+    (sysadmins can see any).
+
+    '''
+    # We need to do a direct import here, there's no nicer way yet.
+    import ckan.lib.jobs as jobs_lib
+    import ckanext.datapackager.jobs as jobs
+
+    user = context.get('user')
+    try:
+        job = jobs_lib.job_from_id(data_dict.get('id'))
+    except KeyError:
+        job = None
+
+    if not user or job is None or jobs.job_user(job) != user:
+        return {
+            'success': False,
+            'msg': 'User {0} not authorized to see this import job'.format(
+                user),
+        }
+    return {'success': True}
@@ -1,7 +1,28 @@
+import ckan.model as model
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
-from ckanext.datapackager.logic.action.create import package_create_from_datapackage
-from ckanext.datapackager.logic.action.get import package_show_as_datapackage
+import ckanext.datapackager.lib.archive_cache as archive_cache
+import ckanext.datapackager.lib.export_cache as export_cache
+import ckanext.datapackager.lib.fetch as fetch
+import ckanext.datapackager.lib.profiles as profiles
+import ckanext.datapackager.lib.util as util
+from ckanext.datapackager.logic.action.create import (
+    package_create_from_datapackage,
+    package_create_from_datapackage_batch,
+    datapackage_upload_init,
+    datapackage_upload_chunk,
+    datapackage_upload_finalize,
+)
+from ckanext.datapackager.logic.action.update import (
+    package_update_from_datapackage,
+)
+from ckanext.datapackager.logic.action.get import (
+    package_show_as_datapackage,
+    package_show_as_datapackage_cache_stats,
+    package_create_from_datapackage_status,
+    datapackage_upload_show,
+)
+import ckanext.datapackager.logic.auth.get as auth_get
 
 if toolkit.check_ckan_version(u'2.9'):
     from ckanext.datapackager.plugin.flask_plugin import MixinPlugin
@@ -15,13 +36,132 @@ class DataPackagerPlugin(MixinPlugin, plugins.SingletonPlugin):
     '''Plugin that adds importing/exporting datasets as Data Packages.
     '''
     plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
+    plugins.implements(plugins.IPackageController, inherit=True)
+    plugins.implements(plugins.IResourceController, inherit=True)
 
     def update_config(self, config):
         toolkit.add_template_directory(config, '../templates')
 
+    def configure(self, config):
+        # Load the Data Package profiles once per process, instead of on
+        # every import.
+        profiles.install(
+            max_size=toolkit.asint(config.get(
+                'ckanext.datapackager.profile_cache_size', 32)),
+            ttl=toolkit.asint(config.get(
+                'ckanext.datapackager.profile_cache_ttl', 3600)),
+        )
+
+        # Share a pool of connections (and a cache of the responses) between
+        # all the imports from a url in this process.
+        fetch.configure(
+            max_size=toolkit.asint(config.get(
+                'ckanext.datapackager.fetch_max_size', 1024)) * 2 ** 20,
+            connect_timeout=toolkit.asint(config.get(
+                'ckanext.datapackager.fetch_connect_timeout', 10)),
+            read_timeout=toolkit.asint(config.get(
+                'ckanext.datapackager.fetch_read_timeout', 30)),
+            pool_size=toolkit.asint(config.get(
+                'ckanext.datapackager.fetch_pool_size', 10)),
+            cache_dir=util.get_working_directory('fetch-cache'),
+            cache_size=toolkit.asint(config.get(
+                'ckanext.datapackager.fetch_cache_size', 64)),
+        )
+
+        export_cache.configure(
+            max_size=toolkit.asint(config.get(
+                'ckanext.datapackager.export_cache_size', 1000)),
+        )
+
+        # Zip archives of datasets are only cached if it's turned on, as
+        # they can take a lot of space.
+        archive_cache.configure(
+            directory=util.get_working_directory('archives') if toolkit.asbool(
+                config.get('ckanext.datapackager.archive_cache', False))
+            else None,
+            max_size=toolkit.asint(config.get(
+                'ckanext.datapackager.archive_cache_max_size', 10240)) * 2 ** 20,
+        )
+
     def get_actions(self):
         return {
             'package_create_from_datapackage': package_create_from_datapackage,
+            'package_create_from_datapackage_batch':
+                package_create_from_datapackage_batch,
+            'package_update_from_datapackage': package_update_from_datapackage,
             'package_show_as_datapackage': package_show_as_datapackage,
+            'package_show_as_datapackage_cache_stats':
+                package_show_as_datapackage_cache_stats,
+            'package_create_from_datapackage_status':
+                package_create_from_datapackage_status,
+            'datapackage_upload_init': datapackage_upload_init,
+            'datapackage_upload_chunk': datapackage_upload_chunk,
+            'datapackage_upload_show': datapackage_upload_show,
+            'datapackage_upload_finalize': datapackage_upload_finalize,
         }
+
+    def get_auth_functions(self):
+        return {
+            'package_create_from_datapackage_status':
+                auth_get.package_create_from_datapackage_status,
+        }
+
+    # Exported Data Packages are cached by their dataset's metadata_modified,
+    # so they never go stale, but the ones of datasets changed or deleted in
+    # this process are dropped straight away instead of waiting to be evicted.
+    # The cached zip archives of datasets that change are removed, and rebuilt
+    # once the changes are committed.
+    #
+    # Before CKAN 2.10 the IPackageController and IResourceController hooks
+    # have the same names, so these get called with datasets and resources.
+
+    def after_create(self, context, data_dict):
+        self._dataset_changed(data_dict)
+
+    def after_update(self, context, data_dict):
+        self._dataset_changed(data_dict)
+
+    def after_delete(self, context, data_dict):
+        if isinstance(data_dict, list):
+            # IResourceController gives the dataset's remaining resources
+            for resource in data_dict:
+                self._dataset_changed(resource)
+        else:
+            self._dataset_changed(data_dict, deleted=True)
+
+    def after_dataset_update(self, context, pkg_dict):
+        self._dataset_changed(pkg_dict)
+
+    def after_dataset_delete(self, context, pkg_dict):
+        self._dataset_changed(pkg_dict, deleted=True)
+
+    def after_resource_create(self, context, resource):
+        self._dataset_changed(resource)
+
+    def after_resource_update(self, context, resource):
+        self._dataset_changed(resource)
+
+    def after_resource_delete(self, context, resources):
+        for resource in resources:
+            self._dataset_changed(resource)
+
+    def _dataset_changed(self, data_dict, deleted=False):
+        if not isinstance(data_dict, dict):
+            return
+        # Resources have a package_id, datasets don't
+        dataset_id = data_dict.get('package_id') or data_dict.get('id')
+        if not dataset_id:
+            return
+        export_cache.get_cache().invalidate(dataset_id)
+
+        cache = archive_cache.get_cache()
+        if cache is None:
+            return
+        # The archives of the previous versions won't be sent anymore
+        cache.remove(dataset_id)
+        if not deleted:
+            archive_cache.enqueue_build_after_commit(
+                model.Session(), dataset_id)
@@ -11,5 +11,13 @@ class MixinPlugin(plugins.SingletonPlugin):
         # As long as the URL for import_datapackage_view and import_datapackage are the same, reverse lookups from import_datapackage will work
         blueprint.add_url_rule("/import_datapackage", view_func=datapackage.new, endpoint='import_datapackage', methods=['GET'])
         blueprint.add_url_rule("/import_datapackage", view_func=datapackage.import_datapackage, endpoint='import_datapackage_post', methods=['POST'])
-        blueprint.add_url_rule("/dataset/<package_id>/datapackage.json", view_func=datapackage.export_datapackage, endpoint='export_datapackage', methods=['GET'])
+        blueprint.add_url_rule("/import_datapackage/uploads", view_func=datapackage.upload_init, endpoint='upload_init', methods=['POST'])
+        blueprint.add_url_rule("/import_datapackage/uploads/<upload_id>", view_func=datapackage.upload_show, endpoint='upload_show', methods=['GET'])
+        blueprint.add_url_rule("/import_datapackage/uploads/<upload_id>", view_func=datapackage.upload_chunk, endpoint='upload_chunk', methods=['PUT'])
+        blueprint.add_url_rule("/import_datapackage/uploads/<upload_id>", view_func=datapackage.upload_finalize, endpoint='upload_finalize', methods=['POST'])
+        blueprint.add_url_rule("/import_datapackage/<job_id>", view_func=datapackage.import_datapackage_status, endpoint='import_datapackage_status', methods=['GET'])
+        blueprint.add_url_rule("/dataset/<package_id>/datapackage.json", view_func=datapackage.export_datapackage, endpoint='export_datapackage', methods=['GET', 'HEAD'])
+        blueprint.add_url_rule("/dataset/<package_id>/datapackage.zip", view_func=datapackage.export_datapackage_zip, endpoint='export_datapackage_zip', methods=['GET', 'HEAD'])
+        blueprint.add_url_rule("/organization/<id>/datapackages", view_func=datapackage.export_organization_datapackages, endpoint='export_organization_datapackages', methods=['GET'])
+        blueprint.add_url_rule("/group/<id>/datapackages", view_func=datapackage.export_group_datapackages, endpoint='export_group_datapackages', methods=['GET'])
         return blueprint
\ No newline at end of file
@@ -18,10 +18,67 @@ class MixinPlugin(plugins.SingletonPlugin):
             action='import_datapackage',
             conditions=dict(method=['POST']),
         )
+        map_.connect(
+            'datapackage_upload_init',
+            '/import_datapackage/uploads',
+            controller='ckanext.datapackager.controllers.datapackage:DataPackageController',
+            action='upload_init',
+            conditions=dict(method=['POST']),
+        )
+        map_.connect(
+            'datapackage_upload_show',
+            '/import_datapackage/uploads/{upload_id}',
+            controller='ckanext.datapackager.controllers.datapackage:DataPackageController',
+            action='upload_show',
+            conditions=dict(method=['GET']),
+        )
+        map_.connect(
+            'datapackage_upload_chunk',
+            '/import_datapackage/uploads/{upload_id}',
+            controller='ckanext.datapackager.controllers.datapackage:DataPackageController',
+            action='upload_chunk',
+            conditions=dict(method=['PUT']),
+        )
+        map_.connect(
+            'datapackage_upload_finalize',
+            '/import_datapackage/uploads/{upload_id}',
+            controller='ckanext.datapackager.controllers.datapackage:DataPackageController',
+            action='upload_finalize',
+            conditions=dict(method=['POST']),
+        )
+        map_.connect(
+            'import_datapackage_status',
+            '/import_datapackage/{job_id}',
+            controller='ckanext.datapackager.controllers.datapackage:DataPackageController',
+            action='import_datapackage_status',
+            conditions=dict(method=['GET']),
+        )
         map_.connect(
             'export_datapackage',
             '/dataset/{package_id}/datapackage.json',
             controller='ckanext.datapackager.controllers.datapackage:DataPackageController',
-            action='export_datapackage'
+            action='export_datapackage',
+            conditions=dict(method=['GET', 'HEAD']),
+        )
+        map_.connect(
+            'export_datapackage_zip',
+            '/dataset/{package_id}/datapackage.zip',
+            controller='ckanext.datapackager.controllers.datapackage:DataPackageController',
+            action='export_datapackage_zip',
+            conditions=dict(method=['GET', 'HEAD']),
+        )
+        map_.connect(
+            'export_organization_datapackages',
+            '/organization/{id}/datapackages',
+            controller='ckanext.datapackager.controllers.datapackage:DataPackageController',
+            action='export_organization_datapackages',
+            conditions=dict(method=['GET']),
+        )
+        map_.connect(
+            'export_group_datapackages',
+            '/group/{id}/datapackages',
+            controller='ckanext.datapackager.controllers.datapackage:DataPackageController',
+            action='export_group_datapackages',
+            conditions=dict(method=['GET']),
         )
         return map_
@@ -1,15 +1,26 @@
 '''Functional tests for controllers/package.py.'''
+import gzip
 import json
+import os
 import pytest
 import responses
 from bs4 import BeautifulSoup
 import re
+import six
+import tarfile
+import zipfile
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 import ckanapi
 import datapackage
 import ckan.tests.factories as factories
 import ckan.tests.helpers as helpers
 import ckan.plugins.toolkit as toolkit
+import ckanext.datapackager.jobs as jobs
+import ckanext.datapackager.lib.archive_cache as archive_cache
 import ckanext.datapackager.tests.helpers as custom_helpers
 
 responses.add_passthru(toolkit.config['solr_url'])
@@ -19,6 +30,8 @@ def _url_for(*args, **kwargs):
     if toolkit.check_ckan_version(max_version="2.9"):
         if args[0] == "datapackager.export_datapackage":
             args = ("export_datapackage", )
+        elif args[0].startswith("datapackager.export_"):
+            args = (args[0][len("datapackager."):], )
         elif args[0] == "datapackager.import_datapackage":
             args = ("import_datapackage", )
 
@@ -82,6 +95,165 @@ class TestDataPackageController():
 
         assert uploaded_resource['url'] == resources[1].descriptor['path']
 
+    def test_download_datapackage_is_conditional(self, app):
+        dataset = factories.Dataset()
+        url = _url_for('datapackager.export_datapackage',
+                       package_id=dataset['name'])
+
+        response = app.get(url)
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+
+        response = app.get(url, headers={'If-None-Match': etag}, status=304)
+        assert response.headers['ETag'] == etag
+        assert not response.body
+        app.get(url, headers={'If-Modified-Since': last_modified},
+                status=304)
+
+        helpers.call_action('package_patch', id=dataset['id'],
+                            title='New title')
+        response = app.get(url, headers={'If-None-Match': etag}, status=200)
+        assert response.headers['ETag'] != etag
+        assert json.loads(response.body)['title'] == 'New title'
+
+    def test_download_datapackage_compact_and_gzipped(self, app):
+        dataset = factories.Dataset()
+        url = _url_for('datapackager.export_datapackage',
+                       package_id=dataset['name'])
+        pretty = app.get(url)
+
+        response = app.get(url + '?pretty=0',
+                           headers={'Accept-Encoding': 'gzip'})
+
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['ETag'] != pretty.headers['ETag']
+        body = gzip.GzipFile(
+            fileobj=six.BytesIO(getattr(response, 'data', None) or
+                                response.body)).read()
+        assert b'\n' not in body
+        assert json.loads(body.decode('utf-8')) == json.loads(pretty.body)
+
+    def test_download_datapackage_with_invalid_pretty(self, app):
+        dataset = factories.Dataset()
+        url = _url_for('datapackager.export_datapackage',
+                       package_id=dataset['name'])
+
+        app.get(url + '?pretty=foo', status=400)
+
+    @pytest.mark.skipif(not toolkit.check_ckan_version(min_version="2.9"),
+                        reason="Uses the Flask test client")
+    def test_download_datapackage_head(self, app):
+        dataset = factories.Dataset()
+        url = _url_for('datapackager.export_datapackage',
+                       package_id=dataset['name'])
+
+        response = app.head(url)
+
+        assert response.headers['ETag'] == app.get(url).headers['ETag']
+        assert not response.body
+
+    def test_download_datapackage_zip(self, app):
+        dataset = factories.Dataset()
+        factories.Resource(package_id=dataset['id'],
+                           url='http://www.foo.com/data.csv')
+        csv_path = 'lahmans-baseball-database/AllstarFull.csv'
+        helpers.call_action('resource_create', {},
+                            package_id=dataset['id'],
+                            name='AllstarFull',
+                            url='_needed_for_ckan<2.6',
+                            upload=custom_helpers.get_csv_file(csv_path))
+        url = _url_for('datapackager.export_datapackage_zip',
+                       package_id=dataset['name'])
+
+        response = app.get(url)
+
+        assert response.headers['Content-Type'] == 'application/zip'
+        body = getattr(response, 'data', None) or response.body
+        with zipfile.ZipFile(six.BytesIO(body)) as z:
+            descriptor = json.loads(z.read('datapackage.json').decode('utf-8'))
+            resources = descriptor['resources']
+            assert resources[0]['path'] == 'http://www.foo.com/data.csv'
+            assert resources[1]['path'] == 'data/AllstarFull.csv'
+            with open(custom_helpers.fixture_path(csv_path), 'rb') as f:
+                assert z.read('data/AllstarFull.csv') == f.read()
+
+    def test_download_cached_datapackage_zip_in_ranges(self, app, tmpdir):
+        dataset = factories.Dataset()
+        helpers.call_action('resource_create', {},
+                            package_id=dataset['id'],
+                            name='AllstarFull',
+                            url='_needed_for_ckan<2.6',
+                            upload=custom_helpers.get_csv_file(
+                                'lahmans-baseball-database/AllstarFull.csv'))
+        url = _url_for('datapackager.export_datapackage_zip',
+                       package_id=dataset['name'])
+        streamed = app.get(url)
+        streamed_body = getattr(streamed, 'data', None) or streamed.body
+
+        archive_cache.configure(directory=str(tmpdir))
+        try:
+            path = jobs.build_datapackage_archive(dataset['id'])
+            response = app.get(url, headers={'Range': 'bytes=10-19'},
+                               status=206)
+            full = app.get(url)
+        finally:
+            archive_cache.configure()
+
+        with open(path, 'rb') as f:
+            assert f.read() == streamed_body
+        assert full.headers['ETag'] == streamed.headers['ETag']
+        assert full.headers['Accept-Ranges'] == 'bytes'
+        assert response.headers['Content-Range'] == \
+            'bytes 10-19/{0}'.format(len(streamed_body))
+        assert (getattr(response, 'data', None) or response.body) == \
+            streamed_body[10:20]
+
+    def test_dataset_updates_replace_the_cached_archive(self, tmpdir):
+        dataset = factories.Dataset()
+
+        archive_cache.configure(directory=str(tmpdir))
+        try:
+            path = jobs.build_datapackage_archive(dataset['id'])
+            with mock.patch.object(archive_cache, 'enqueue_build') as build:
+                helpers.call_action('package_patch', id=dataset['id'],
+                                    title='New title')
+        finally:
+            archive_cache.configure()
+
+        assert not os.path.exists(path)
+        build.assert_called_with(dataset['id'])
+
+    def test_export_organization_datapackages_in_pages(self, app):
+        org = factories.Organization()
+        datasets = [factories.Dataset(owner_org=org['id']) for _ in range(3)]
+        factories.Dataset()
+        url = _url_for('datapackager.export_organization_datapackages',
+                       id=org['name'])
+
+        first = app.get(url + '?limit=2')
+        link = first.headers['Link']
+        next_url = link[link.index('<') + 1:link.index('>')]
+        second = app.get(next_url)
+
+        names = [json.loads(line)['name']
+                 for response in (first, second)
+                 for line in response.body.splitlines()]
+        assert sorted(names) == sorted(d['name'] for d in datasets)
+        assert 'Link' not in second.headers
+
+    def test_export_group_datapackages_as_tar(self, app):
+        group = factories.Group()
+        dataset = factories.Dataset(groups=[{'id': group['id']}])
+        url = _url_for('datapackager.export_group_datapackages',
+                       id=group['name'])
+
+        response = app.get(url + '?format=tar')
+
+        body = getattr(response, 'data', None) or response.body
+        with tarfile.open(fileobj=six.BytesIO(body)) as tar:
+            assert tar.getnames() == [
+                '{0}/datapackage.json'.format(dataset['name'])]
+
     def test_that_download_button_is_on_page(self, app):
         '''Tests that the download button is shown on the dataset pages.'''
 
@@ -153,3 +325,35 @@ class TestDataPackageController():
         assert len(dataset.get('resources', [])) == 1
         assert dataset['resources'][0].get('name') == 'the-resource'
         assert (dataset['resources'][0].get('url') == datapackage['resources'][0]['url'])
+
+    @pytest.mark.skipif(not toolkit.check_ckan_version(min_version="2.9"),
+                        reason="Uses the Flask test client")
+    def test_import_datapackage_in_chunks(self, app):
+        user = factories.User()
+        env = {'REMOTE_USER': user['name'].encode('ascii')}
+        data = json.dumps({
+            'name': 'foo',
+            'resources': [
+                {'name': 'bar', 'path': 'http://www.somewhere.com/data.csv'},
+            ],
+        }).encode('utf-8')
+
+        response = app.post('/import_datapackage/uploads',
+                            data={'size': len(data)},
+                            extra_environ=env, status=201)
+        upload_url = '/import_datapackage/uploads/{0}'.format(
+            json.loads(response.body)['id'])
+
+        app.put(upload_url, data=data[:10], extra_environ=env,
+                headers={'Content-Range': 'bytes 0-9/{0}'.format(len(data)),
+                         'Content-Type': 'application/octet-stream'})
+        response = app.get(upload_url, extra_environ=env)
+        assert json.loads(response.body)['offset'] == 10
+
+        app.put(upload_url + '?offset=10', data=data[10:],
+                extra_environ=env,
+                headers={'Content-Type': 'application/octet-stream'})
+        response = app.post(upload_url, extra_environ=env)
+
+        assert json.loads(response.body)['name'] == 'foo'
+        app.get(upload_url, extra_environ=env, status=404)
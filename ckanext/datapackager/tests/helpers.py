@@ -1,6 +1,11 @@
 '''Test helper functions and classes.'''
 
+import contextlib
 import os
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 
 def get_csv_file(relative_path):
@@ -11,3 +16,35 @@ def get_csv_file(relative_path):
 def fixture_path(path):
     path = os.path.join(os.path.split(__file__)[0], 'test-data', path)
     return os.path.abspath(path)
+
+
+class UploadFile(object):
+    '''Mock the parts from cgi.FieldStorage we use (CKAN < 2.9).'''
+
+    def __init__(self, fp):
+        self.file = fp
+
+
+@contextlib.contextmanager
+def in_process_job_queue():
+    '''Run background jobs right away, in this process, without Redis.
+
+    Jobs are enqueued in a synchronous RQ queue backed by an in-memory fake
+    Redis, which is also what CKAN uses to look jobs up while this is active.
+
+    '''
+    import fakeredis
+    import rq
+
+    connection = fakeredis.FakeStrictRedis()
+    try:
+        queue = rq.Queue('datapackager-tests', connection=connection,
+                         is_async=False)
+    except TypeError:
+        # Older RQ versions call this argument "async"
+        queue = rq.Queue('datapackager-tests', connection=connection,
+                         **{'async': False})
+
+    with mock.patch('ckan.lib.jobs.get_queue', return_value=queue), \
+            mock.patch('ckan.lib.jobs._connect', return_value=connection):
+        yield queue
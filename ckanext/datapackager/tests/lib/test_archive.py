@@ -0,0 +1,237 @@
+import json
+import zipfile
+
+import pytest
+
+import ckanext.datapackager.exceptions as exceptions
+import ckanext.datapackager.lib.archive as archive
+import ckanext.datapackager.tests.helpers as custom_helpers
+
+
+def _make_zip(path, members):
+    with zipfile.ZipFile(str(path), 'w', zipfile.ZIP_DEFLATED) as z:
+        for name, contents in members.items():
+            z.writestr(name, contents)
+    return str(path)
+
+
+class TestZippedDataPackage(object):
+
+    def test_is_zip_archive(self):
+        assert archive.is_zip_archive(
+            custom_helpers.fixture_path('datetimes-datapackage.zip'))
+        assert not archive.is_zip_archive(
+            custom_helpers.fixture_path('datetimes.csv'))
+
+    def test_descriptor(self):
+        path = custom_helpers.fixture_path('datetimes-datapackage.zip')
+        with archive.ZippedDataPackage(path) as zipped:
+            descriptor = zipped.descriptor()
+
+        assert descriptor['name'] == 'datetimes'
+        assert descriptor['resources'][0]['path'] == 'data/datetimes.csv'
+
+    def test_descriptor_resolves_schemas_in_the_archive(self, tmpdir):
+        schema = {'fields': [{'name': 'date', 'type': 'date'}]}
+        path = _make_zip(tmpdir.join('dp.zip'), {
+            'dp/datapackage.json': json.dumps({
+                'name': 'foo',
+                'resources': [{
+                    'name': 'bar',
+                    'path': 'data/bar.csv',
+                    'schema': 'schemas/bar.json',
+                }],
+            }),
+            'dp/data/bar.csv': 'date\n2016-01-01\n',
+            'dp/schemas/bar.json': json.dumps(schema),
+        })
+
+        with archive.ZippedDataPackage(path) as zipped:
+            descriptor = zipped.descriptor()
+
+        assert descriptor['resources'][0]['schema'] == schema
+
+    def test_open_resource_streams_the_member(self):
+        path = custom_helpers.fixture_path('datetimes-datapackage.zip')
+        with open(custom_helpers.fixture_path('datetimes.csv'), 'rb') as f:
+            expected = f.read()
+
+        with archive.ZippedDataPackage(path) as zipped:
+            the_file = zipped.open_resource('data/datetimes.csv')
+
+            assert the_file.name == 'datetimes.csv'
+            the_file.seek(0, 2)
+            assert the_file.tell() == len(expected)
+            the_file.seek(0)
+            contents = b''
+            while True:
+                chunk = the_file.read(10)
+                if not chunk:
+                    break
+                contents += chunk
+            the_file.close()
+
+        assert contents == expected
+
+    def test_open_resource_rejects_paths_outside_the_archive(self, tmpdir):
+        path = _make_zip(tmpdir.join('dp.zip'), {
+            'datapackage.json': json.dumps({'name': 'foo', 'resources': []}),
+        })
+
+        with archive.ZippedDataPackage(path) as zipped:
+            with pytest.raises(exceptions.InvalidZipArchiveException):
+                zipped.open_resource('../etc/passwd')
+            with pytest.raises(exceptions.InvalidZipArchiveException):
+                zipped.open_resource('inexistent.csv')
+
+    def test_it_requires_exactly_one_descriptor(self, tmpdir):
+        path = _make_zip(tmpdir.join('dp.zip'), {
+            'a/datapackage.json': '{}',
+            'b/datapackage.json': '{}',
+        })
+
+        with pytest.raises(exceptions.InvalidZipArchiveException):
+            archive.ZippedDataPackage(path)
+
+    def test_it_limits_the_size_of_each_member(self, tmpdir):
+        path = _make_zip(tmpdir.join('dp.zip'), {
+            'datapackage.json': '{}',
+            'data.csv': 'a' * 1000,
+        })
+
+        with pytest.raises(exceptions.InvalidZipArchiveException):
+            archive.ZippedDataPackage(path, max_member_size=999)
+        archive.ZippedDataPackage(path, max_member_size=1000).close()
+
+    def test_it_limits_the_total_size_of_the_contents(self, tmpdir):
+        path = _make_zip(tmpdir.join('dp.zip'), {
+            'datapackage.json': '{}',
+            'data-1.csv': 'a' * 600,
+            'data-2.csv': 'a' * 600,
+        })
+
+        with pytest.raises(exceptions.InvalidZipArchiveException):
+            archive.ZippedDataPackage(path, max_total_size=1000)
+
+    def test_it_rejects_corrupt_headers(self, tmpdir):
+        path = _make_zip(tmpdir.join('dp.zip'), {
+            'datapackage.json': '{"name": "foo", "resources": []}'})
+        with open(path, 'r+b') as f:
+            # The local file header, the central directory is left intact
+            f.write(b'XXXX')
+
+        assert archive.is_zip_archive(path)
+        with pytest.raises(exceptions.InvalidZipArchiveException):
+            with archive.ZippedDataPackage(path) as zipped:
+                zipped.descriptor()
+
+    def test_it_rejects_corrupt_members_as_theyre_read(self, tmpdir):
+        path = _make_zip(tmpdir.join('dp.zip'), {
+            'datapackage.json': '{"name": "foo", "resources": []}',
+            'data.csv': 'a,b\n' * 1000})
+        with zipfile.ZipFile(path) as z:
+            info = z.getinfo('data.csv')
+        with open(path, 'r+b') as f:
+            # Flip a byte of the member's compressed data
+            f.seek(info.header_offset + 30 + len(info.filename) + 10)
+            byte = f.read(1)
+            f.seek(-1, 1)
+            f.write(bytes(bytearray([ord(byte) ^ 0xff])))
+
+        with archive.ZippedDataPackage(path) as zipped:
+            f = zipped.open_resource('data.csv')
+            with pytest.raises(exceptions.InvalidZipArchiveException):
+                while f.read(100):
+                    pass
+
+
+class TestStreamZip(object):
+
+    def _write(self, path, chunks):
+        with open(str(path), 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        return str(path)
+
+    @pytest.mark.parametrize('compress', [True, False])
+    def test_stream_zip(self, tmpdir, compress):
+        data = self._write(tmpdir.join('data.csv'), [b'a,b\n1,2\n' * 10000])
+        path = self._write(tmpdir.join('dp.zip'), archive.stream_zip(
+            [('datapackage.json', iter([b'{"name": ', b'"foo"}'])),
+             ('data/data.csv', data)],
+            date_time=(2020, 1, 2, 3, 4, 6), compress=compress))
+
+        with zipfile.ZipFile(path) as z:
+            assert z.testzip() is None
+            assert z.read('datapackage.json') == b'{"name": "foo"}'
+            assert z.read('data/data.csv') == b'a,b\n1,2\n' * 10000
+            assert z.getinfo('data/data.csv').date_time == \
+                (2020, 1, 2, 3, 4, 6)
+
+    def test_stream_zip_is_reproducible(self, tmpdir):
+        data = self._write(tmpdir.join('data.csv'), [b'a,b\n1,2\n'])
+
+        def build():
+            return b''.join(archive.stream_zip(
+                [('datapackage.json', [b'{}']), ('data.csv', data)]))
+
+        assert build() == build()
+
+    def test_stream_zip_uses_zip64_for_large_files(self, tmpdir,
+                                                   monkeypatch):
+        monkeypatch.setattr(archive, '_ZIP64_THRESHOLD', 0)
+        data = self._write(tmpdir.join('data.csv'), [b'a,b\n1,2\n'])
+        path = self._write(tmpdir.join('dp.zip'), archive.stream_zip(
+            [('data.csv', data)]))
+
+        with zipfile.ZipFile(path) as z:
+            assert z.read('data.csv') == b'a,b\n1,2\n'
+
+
+class TestAddResourceFiles(object):
+
+    def test_add_resource_files(self):
+        datapackage = {'name': 'foo', 'resources': [
+            {'name': 'a', 'path': 'http://ckan/download/data%20file.csv'},
+            {'name': 'b', 'path': 'http://example.com/remote.csv'},
+            {'name': 'c', 'path': 'http://ckan/download/data%20file.csv'},
+        ]}
+
+        descriptor, members = archive.add_resource_files(
+            datapackage, {0: '/files/a', 2: '/files/c'})
+
+        assert [r['path'] for r in descriptor['resources']] == [
+            'data/data file.csv', 'http://example.com/remote.csv',
+            'data/2-data file.csv']
+        assert members == [('data/data file.csv', '/files/a'),
+                           ('data/2-data file.csv', '/files/c')]
+        assert datapackage['resources'][0]['path'] == \
+            'http://ckan/download/data%20file.csv'
+
+    def test_add_resource_files_keeps_files_inside_the_directory(self):
+        datapackage = {'name': 'foo', 'resources': [
+            {'name': 'a', 'path': 'http://ckan/x/..%2F..%2Ftmp%2Fevil.sh'},
+            {'name': 'b', 'path': 'http://ckan/x/..%5C..%5Cevil.bat'},
+            {'name': 'c', 'path': 'http://ckan/x/%2E%2E'},
+        ]}
+
+        descriptor, members = archive.add_resource_files(
+            datapackage, {0: '/files/a', 1: '/files/b', 2: '/files/c'})
+
+        assert [name for name, _ in members] == [
+            'data/evil.sh', 'data/evil.bat', 'data/c']
+        assert [r['path'] for r in descriptor['resources']] == [
+            'data/evil.sh', 'data/evil.bat', 'data/c']
+
+    def test_add_resource_files_gives_every_file_a_unique_name(self):
+        datapackage = {'name': 'foo', 'resources': [
+            {'name': 'a', 'path': 'http://ckan/download/data.csv'},
+            {'name': 'b', 'path': 'http://ckan/download/2-data.csv'},
+            {'name': 'c', 'path': 'http://ckan/download/data.csv'},
+        ]}
+
+        _, members = archive.add_resource_files(
+            datapackage, {0: '/files/a', 1: '/files/b', 2: '/files/c'})
+
+        assert [name for name, _ in members] == [
+            'data/data.csv', 'data/2-data.csv', 'data/3-data.csv']
@@ -0,0 +1,115 @@
+import os
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import sqlalchemy
+from sqlalchemy import orm
+
+import ckanext.datapackager.lib.archive_cache as archive_cache
+
+
+class TestArchiveCache(object):
+
+    def test_build_and_get(self, tmpdir):
+        cache = archive_cache.ArchiveCache(str(tmpdir))
+
+        path = cache.build('dataset', 'v1', iter([b'PK', b'...']))
+
+        assert cache.get('dataset', 'v1') == path
+        assert cache.get('dataset', 'v2') is None
+        with open(path, 'rb') as f:
+            assert f.read() == b'PK...'
+
+    def test_build_removes_other_versions(self, tmpdir):
+        cache = archive_cache.ArchiveCache(str(tmpdir))
+        cache.build('dataset', 'v1', [b'old'])
+
+        cache.build('dataset', 'v2', [b'new'])
+
+        assert cache.get('dataset', 'v1') is None
+        assert cache.get('dataset', 'v2')
+
+    def test_build_evicts_the_least_recently_used_archives(self, tmpdir):
+        cache = archive_cache.ArchiveCache(str(tmpdir), max_size=25)
+        first = cache.build('first', 'v1', [b'x' * 10])
+        second = cache.build('second', 'v1', [b'x' * 10])
+        os.utime(second, (1, 1))
+        os.utime(first, (2, 2))
+
+        cache.build('third', 'v1', [b'x' * 10])
+
+        assert cache.get('first', 'v1')
+        assert cache.get('second', 'v1') is None
+        assert cache.get('third', 'v1')
+
+    def test_build_doesnt_cache_archives_larger_than_the_maximum(self, tmpdir):
+        cache = archive_cache.ArchiveCache(str(tmpdir), max_size=5)
+
+        assert cache.build('dataset', 'v1', [b'x' * 10]) is None
+        assert os.listdir(str(tmpdir.join('dataset'))) == []
+
+    def test_claim(self, tmpdir):
+        cache = archive_cache.ArchiveCache(str(tmpdir))
+
+        assert cache.claim('dataset', 'v1')
+        assert not cache.claim('dataset', 'v1')
+        cache.release('dataset', 'v1')
+        assert cache.claim('dataset', 'v1')
+        cache.build('dataset', 'v1', [b'PK'])
+        assert not cache.claim('dataset', 'v1')
+
+    def test_remove(self, tmpdir):
+        cache = archive_cache.ArchiveCache(str(tmpdir))
+        cache.build('dataset', 'v1', [b'PK'])
+        cache.build('other', 'v1', [b'PK'])
+
+        cache.remove('dataset')
+
+        assert cache.get('dataset', 'v1') is None
+        assert cache.get('other', 'v1')
+
+    def test_archives_are_kept_by_dataset(self, tmpdir):
+        cache = archive_cache.ArchiveCache(str(tmpdir))
+
+        path = cache.build('dataset', 'v1', [b'PK'])
+
+        assert path == str(tmpdir.join('dataset', 'v1.zip'))
+
+
+class TestEnqueueBuildAfterCommit(object):
+
+    def _session(self):
+        return orm.Session(sqlalchemy.create_engine('sqlite://'))
+
+    def test_it_enqueues_the_build_once_the_session_commits(self):
+        session = self._session()
+        with mock.patch.object(archive_cache, 'enqueue_build') as build:
+            archive_cache.enqueue_build_after_commit(session, 'dataset')
+            build.assert_not_called()
+            session.commit()
+            session.commit()
+
+        build.assert_called_once_with('dataset')
+
+    def test_it_waits_for_the_outer_transaction(self):
+        session = self._session()
+        with mock.patch.object(archive_cache, 'enqueue_build') as build:
+            savepoint = session.begin_nested()
+            archive_cache.enqueue_build_after_commit(session, 'dataset')
+            savepoint.commit()
+            build.assert_not_called()
+            session.commit()
+
+        build.assert_called_once_with('dataset')
+
+    def test_it_doesnt_enqueue_the_build_if_the_session_rolls_back(self):
+        session = self._session()
+        with mock.patch.object(archive_cache, 'enqueue_build') as build:
+            session.execute(sqlalchemy.text('SELECT 1'))
+            archive_cache.enqueue_build_after_commit(session, 'dataset')
+            session.rollback()
+            session.commit()
+
+        build.assert_not_called()
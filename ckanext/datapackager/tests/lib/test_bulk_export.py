@@ -0,0 +1,33 @@
+import io
+import json
+import tarfile
+
+import ckanext.datapackager.lib.bulk_export as bulk_export
+
+
+class TestEncoding(object):
+
+    def test_iter_ndjson(self):
+        body = b''.join(bulk_export.iter_ndjson(
+            iter([({'name': 'foo'}, None), ({'name': 'bar'}, None)])))
+
+        assert [json.loads(line.decode('utf-8'))
+                for line in body.splitlines()] == \
+            [{'name': 'foo'}, {'name': 'bar'}]
+
+    def test_iter_tar(self):
+        body = b''.join(bulk_export.iter_tar(iter([
+            ({'id': '1', 'name': 'foo'}, '2020-01-02T03:04:05.678901'),
+            ({'id': '2', 'name': u'b\xe1r'}, '2020-01-02T03:04:05'),
+            ({'id': '3', 'name': 'foo'}, None),
+        ])))
+
+        with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+            assert tar.getnames() == [
+                'foo/datapackage.json', u'b\xe1r/datapackage.json',
+                '3/datapackage.json']
+            assert json.loads(tar.extractfile(
+                'foo/datapackage.json').read().decode('utf-8')) == \
+                {'id': '1', 'name': 'foo'}
+            assert [member.mtime for member in tar.getmembers()] == [
+                1577934245, 1577934245, 0]
@@ -0,0 +1,83 @@
+import ckanext.datapackager.lib.export_cache as export_cache
+
+
+class TestDataPackageCache(object):
+
+    def test_it_returns_the_cached_datapackage(self):
+        cache = export_cache.DataPackageCache(max_size=2)
+        cache.set('id', '2020-01-01T00:00:00', {'name': 'foo'})
+
+        assert cache.get('id', '2020-01-01T00:00:00') == {'name': 'foo'}
+
+    def test_it_misses_if_the_dataset_was_modified(self):
+        cache = export_cache.DataPackageCache(max_size=2)
+        cache.set('id', '2020-01-01T00:00:00', {'name': 'foo'})
+
+        assert cache.get('id', '2020-01-02T00:00:00') is None
+        assert cache.get('id', '2020-01-01T00:00:00') is None
+
+    def test_it_returns_copies(self):
+        cache = export_cache.DataPackageCache(max_size=2)
+        datapackage = {'name': 'foo', 'resources': [{'name': 'bar'}]}
+        cache.set('id', 'modified', datapackage)
+        datapackage['resources'][0]['name'] = 'baz'
+
+        cache.get('id', 'modified')['resources'].append({})
+
+        assert cache.get('id', 'modified') == \
+            {'name': 'foo', 'resources': [{'name': 'bar'}]}
+
+    def test_it_evicts_the_least_recently_used_datapackages(self):
+        cache = export_cache.DataPackageCache(max_size=2)
+        cache.set('a', 'modified', {'name': 'a'})
+        cache.set('b', 'modified', {'name': 'b'})
+        cache.get('a', 'modified')
+        cache.set('c', 'modified', {'name': 'c'})
+
+        assert cache.get('a', 'modified') == {'name': 'a'}
+        assert cache.get('b', 'modified') is None
+        assert cache.get('c', 'modified') == {'name': 'c'}
+
+    def test_it_invalidates_datasets(self):
+        cache = export_cache.DataPackageCache(max_size=2)
+        cache.set('id', 'modified', {'name': 'foo'})
+
+        cache.invalidate('id')
+
+        assert cache.get('id', 'modified') is None
+
+    def test_it_keeps_a_datapackage_for_each_user(self):
+        cache = export_cache.DataPackageCache(max_size=2)
+        cache.set('id', 'modified', {'name': 'foo'}, user='admin')
+        cache.set('id', 'modified', {'name': 'bar'})
+
+        assert cache.get('id', 'modified', user='admin') == {'name': 'foo'}
+        assert cache.get('id', 'modified') == {'name': 'bar'}
+        assert cache.get('id', 'modified', user='someone') is None
+
+    def test_it_invalidates_the_datapackages_of_all_users(self):
+        cache = export_cache.DataPackageCache(max_size=2)
+        cache.set('id', 'modified', {'name': 'foo'}, user='admin')
+        cache.set('id', 'modified', {'name': 'foo'})
+
+        cache.invalidate('id')
+
+        assert cache.get('id', 'modified', user='admin') is None
+        assert cache.get('id', 'modified') is None
+        assert cache.stats()['size'] == 0
+
+    def test_it_can_be_disabled(self):
+        cache = export_cache.DataPackageCache(max_size=0)
+        cache.set('id', 'modified', {'name': 'foo'})
+
+        assert cache.get('id', 'modified') is None
+
+    def test_it_counts_hits_and_misses(self):
+        cache = export_cache.DataPackageCache(max_size=2)
+        cache.get('id', 'modified')
+        cache.set('id', 'modified', {'name': 'foo'})
+        cache.get('id', 'modified')
+        cache.get('id', 'modified')
+
+        assert cache.stats() == {
+            'hits': 2, 'misses': 1, 'size': 1, 'max_size': 2}
@@ -0,0 +1,112 @@
+import io
+import os
+import shutil
+import tempfile
+
+import pytest
+import requests
+import responses
+
+import ckanext.datapackager.exceptions as exceptions
+import ckanext.datapackager.lib.fetch as fetch
+
+URL = 'http://www.example.com/datapackage.json'
+
+
+class TestFetcher(object):
+
+    def setup_method(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def teardown_method(self):
+        shutil.rmtree(self.directory)
+        shutil.rmtree(self.cache_dir)
+
+    def _read(self, path):
+        with io.open(path, 'rb') as f:
+            return f.read()
+
+    @responses.activate
+    def test_it_downloads_the_file(self):
+        responses.add(responses.GET, URL, body=b'{"name": "foo"}')
+        fetcher = fetch.Fetcher()
+
+        path = fetcher.fetch(URL, self.directory)
+
+        assert os.path.dirname(path) == self.directory
+        assert self._read(path) == b'{"name": "foo"}'
+
+    @responses.activate
+    def test_it_uses_the_cached_file_if_it_didnt_change(self):
+        responses.add(responses.GET, URL, body=b'{"name": "foo"}',
+                      headers={'ETag': '"v1"'})
+        responses.add(responses.GET, URL, status=304)
+        fetcher = fetch.Fetcher(cache_dir=self.cache_dir)
+
+        fetcher.fetch(URL, tempfile.mkdtemp(dir=self.directory))
+        path = fetcher.fetch(URL, tempfile.mkdtemp(dir=self.directory))
+
+        assert self._read(path) == b'{"name": "foo"}'
+        assert len(responses.calls) == 2
+        assert responses.calls[1].request.headers['If-None-Match'] == '"v1"'
+
+    @responses.activate
+    def test_it_doesnt_cache_responses_without_validators(self):
+        responses.add(responses.GET, URL, body=b'{"name": "foo"}')
+        fetcher = fetch.Fetcher(cache_dir=self.cache_dir)
+
+        fetcher.fetch(URL, tempfile.mkdtemp(dir=self.directory))
+        fetcher.fetch(URL, tempfile.mkdtemp(dir=self.directory))
+
+        assert 'If-None-Match' not in responses.calls[1].request.headers
+        assert 'If-Modified-Since' not in responses.calls[1].request.headers
+        assert os.listdir(self.cache_dir) == []
+
+    @responses.activate
+    def test_it_evicts_the_least_recently_used_responses(self):
+        for name in ('a', 'b', 'c'):
+            responses.add(responses.GET, 'http://www.example.com/' + name,
+                          body=name, headers={'ETag': '"v1"'})
+        fetcher = fetch.Fetcher(cache_dir=self.cache_dir, cache_size=2)
+
+        for name in ('a', 'b', 'c'):
+            fetcher.fetch('http://www.example.com/' + name,
+                          tempfile.mkdtemp(dir=self.directory))
+
+        assert len(os.listdir(self.cache_dir)) == 4
+        assert fetcher._get_cached('http://www.example.com/a') == (None, {})
+
+    @responses.activate
+    def test_it_raises_if_the_declared_size_is_too_large(self):
+        responses.add(responses.GET, URL, body=b'x' * 100,
+                      headers={'Content-Length': '100'})
+        fetcher = fetch.Fetcher(max_size=10)
+
+        with pytest.raises(exceptions.CouldNotFetchException):
+            fetcher.fetch(URL, self.directory)
+
+    @responses.activate
+    def test_it_raises_if_the_download_is_too_large(self):
+        responses.add(responses.GET, URL, body=b'x' * 100)
+        fetcher = fetch.Fetcher(max_size=10)
+
+        with pytest.raises(exceptions.CouldNotFetchException):
+            fetcher.fetch(URL, self.directory)
+
+    @responses.activate
+    def test_it_raises_if_the_server_is_too_slow(self):
+        responses.add(responses.GET, URL,
+                      body=requests.exceptions.ReadTimeout())
+        fetcher = fetch.Fetcher(read_timeout=1)
+
+        with pytest.raises(exceptions.CouldNotFetchException):
+            fetcher.fetch(URL, self.directory)
+
+    @responses.activate
+    def test_it_raises_on_http_errors(self):
+        responses.add(responses.GET, URL, status=404)
+        fetcher = fetch.Fetcher()
+
+        with pytest.raises(exceptions.CouldNotFetchException):
+            fetcher.fetch(URL, self.directory)
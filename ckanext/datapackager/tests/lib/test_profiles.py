@@ -0,0 +1,111 @@
+import json
+
+import pytest
+import responses
+
+import datapackage
+import ckanext.datapackager.lib.profiles as profiles
+
+PROFILE_URL = 'http://www.example.com/profile.json'
+PROFILE = {
+    '$schema': 'http://json-schema.org/draft-04/schema#',
+    'type': 'object',
+    'required': ['name'],
+}
+
+
+class TestProfileRegistry(object):
+
+    def test_builtin_profiles_are_loaded_once(self):
+        registry = profiles.ProfileRegistry()
+        registry.warm()
+
+        profile = registry.get('data-package')
+
+        assert registry.get('data-package') is profile
+        assert profile.name == 'data-package'
+
+    @responses.activate
+    def test_custom_profiles_are_fetched_once(self):
+        responses.add(responses.GET, PROFILE_URL, json=PROFILE)
+        registry = profiles.ProfileRegistry()
+
+        profile = registry.get(PROFILE_URL)
+
+        assert registry.get(PROFILE_URL) is profile
+        assert len(responses.calls) == 1
+        assert profile.validate({'name': 'foo'})
+
+    @responses.activate
+    def test_custom_profiles_expire(self):
+        responses.add(responses.GET, PROFILE_URL, json=PROFILE)
+        registry = profiles.ProfileRegistry(ttl=0)
+
+        registry.get(PROFILE_URL)
+        registry.get(PROFILE_URL)
+
+        assert len(responses.calls) == 2
+
+    @responses.activate
+    def test_least_recently_used_custom_profiles_are_evicted(self):
+        other_url = 'http://www.example.com/other-profile.json'
+        responses.add(responses.GET, PROFILE_URL, json=PROFILE)
+        responses.add(responses.GET, other_url, json=PROFILE)
+        registry = profiles.ProfileRegistry(max_size=1)
+
+        registry.get(PROFILE_URL)
+        registry.get(other_url)
+        registry.get(PROFILE_URL)
+
+        assert [call.request.url for call in responses.calls] == [
+            PROFILE_URL, other_url, PROFILE_URL]
+
+    @responses.activate
+    def test_profiles_that_fail_to_load_are_not_cached(self):
+        responses.add(responses.GET, PROFILE_URL, status=500)
+        responses.add(responses.GET, PROFILE_URL, json=PROFILE)
+        registry = profiles.ProfileRegistry()
+
+        with pytest.raises(datapackage.exceptions.DataPackageException):
+            registry.get(PROFILE_URL)
+        profile = registry.get(PROFILE_URL)
+
+        assert len(responses.calls) == 2
+        assert profile.validate({'name': 'foo'})
+
+
+@pytest.fixture
+def installed_registry():
+    registry = profiles.install()
+    yield registry
+    profiles.uninstall()
+
+
+class TestInstall(object):
+
+    @responses.activate
+    def test_datapackages_use_the_installed_registry(self, installed_registry):
+        responses.add(responses.GET, PROFILE_URL, json=PROFILE)
+        descriptor = {
+            'name': 'foo',
+            'profile': PROFILE_URL,
+            'resources': [{'name': 'bar', 'path': 'http://example.com/a.csv'}],
+        }
+
+        first = datapackage.DataPackage(json.loads(json.dumps(descriptor)))
+        second = datapackage.DataPackage(json.loads(json.dumps(descriptor)))
+
+        assert profiles.get_registry() is installed_registry
+        assert first.profile is second.profile
+        assert first.resources[0].profile is \
+            installed_registry.get('data-resource')
+        assert len(responses.calls) == 1
+
+    def test_uninstall_restores_the_librarys_profiles(self):
+        profiles.install()
+
+        profiles.uninstall()
+
+        assert datapackage.package.Profile is datapackage.profile.Profile
+        assert datapackage.resource.Profile is datapackage.profile.Profile
+        assert profiles.get_registry() is None
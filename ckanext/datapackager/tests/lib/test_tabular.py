@@ -0,0 +1,154 @@
+import zipfile
+from multiprocessing.pool import ThreadPool
+
+import six
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import pytest
+
+import ckanext.datapackager.exceptions as exceptions
+import ckanext.datapackager.lib.tabular as tabular
+
+
+def _types(schema):
+    return [(field['name'], field['type']) for field in schema['fields']]
+
+
+class TestInferSchema(object):
+
+    def test_it_infers_the_types_of_the_fields(self):
+        the_file = six.BytesIO(b'id,name,date\n1,foo,2020-01-01\n2,bar,'
+                               b'2020-02-01\n')
+
+        schema = tabular.infer_schema(the_file)
+
+        assert _types(schema) == [
+            ('id', 'integer'), ('name', 'string'), ('date', 'date')]
+
+    def test_it_only_reads_the_first_rows(self):
+        the_file = six.BytesIO(b'a\n1\n2\nfoo\n')
+
+        schema = tabular.infer_schema(the_file, max_rows=2)
+
+        assert _types(schema) == [('a', 'integer')]
+
+    def test_it_only_reads_the_first_bytes(self):
+        contents = b'a,b\n' + b'1,2020-01-01\n' * 1000
+        the_file = six.BytesIO(contents)
+
+        schema = tabular.infer_schema(the_file, max_bytes=100)
+
+        # The last row in the sample is cut off, but it isn't used
+        assert _types(schema) == [('a', 'integer'), ('b', 'date')]
+        assert the_file.tell() == 101
+
+    def test_it_uses_the_dialect(self):
+        the_file = six.BytesIO(b'a;b\n1;2\n')
+
+        schema = tabular.infer_schema(the_file, dialect={'delimiter': ';'})
+
+        assert _types(schema) == [('a', 'integer'), ('b', 'integer')]
+
+    def test_it_raises_if_the_file_is_empty(self):
+        with pytest.raises(exceptions.CouldNotReadCSVException):
+            tabular.infer_schema(six.BytesIO(b''))
+
+    def test_is_csv(self):
+        assert tabular.is_csv({'format': 'CSV'})
+        assert tabular.is_csv({'mimetype': 'text/csv'})
+        assert tabular.is_csv({}, 'data.csv')
+        assert not tabular.is_csv({'format': 'json'}, 'data.json')
+
+
+SCHEMA = {'fields': [
+    {'name': 'id', 'type': 'integer'},
+    {'name': 'date', 'type': 'date'},
+]}
+
+
+class TestValidate(object):
+
+    def test_it_returns_no_errors_for_valid_files(self):
+        source = ('data', 'id,date\n1,2020-01-01\n2,2020-01-02\n')
+
+        assert tabular.validate(source, SCHEMA) == []
+
+    def test_it_reports_the_invalid_rows(self):
+        source = ('data', 'id,date\n1,2020-01-01\nfoo,2020-01-02\n3,bar\n')
+
+        errors = tabular.validate(source, SCHEMA)
+
+        assert [error['row'] for error in errors] == [3, 4]
+        assert 'foo' in errors[0]['message']
+
+    def test_it_stops_at_the_maximum_number_of_errors(self):
+        source = ('data', 'id,date\n' + 'foo,bar\n' * 100)
+
+        errors = tabular.validate(source, SCHEMA, max_errors=3)
+
+        assert [error['row'] for error in errors] == [2, 3, 4]
+
+    def test_it_reports_a_wrong_header_once(self):
+        source = ('data', 'id,day\n1,2020-01-01\n2,2020-01-02\n')
+
+        errors = tabular.validate(source, SCHEMA)
+
+        assert [error['row'] for error in errors] == [1]
+
+    def test_it_reads_files_in_zip_archives(self, tmpdir):
+        path = str(tmpdir.join('datapackage.zip'))
+        with zipfile.ZipFile(path, 'w') as z:
+            z.writestr('datapackage.json', '{"resources": []}')
+            z.writestr('data.csv', 'id,date\nfoo,2020-01-01\n')
+
+        errors = tabular.validate(('zip', path, 'data.csv'), SCHEMA)
+
+        assert [error['row'] for error in errors] == [2]
+
+
+class TestValidateAll(object):
+
+    def test_it_names_the_resource_of_each_error(self):
+        sources = [
+            ('first', {'source': ('data', 'id,date\n1,2020-01-01\n'),
+                       'schema': SCHEMA}),
+            ('second', {'source': ('data', 'id,date\nfoo,2020-01-01\n'),
+                        'schema': SCHEMA}),
+        ]
+
+        errors = tabular.validate_all(sources, max_workers=2)
+
+        assert errors == [
+            {'resource': 'second', 'row': 2, 'message': mock.ANY}]
+
+    def test_it_stops_at_the_maximum_number_of_errors(self):
+        sources = [
+            (str(i), {'source': ('data', 'id,date\n' + 'foo,bar\n' * 10),
+                      'schema': SCHEMA})
+            for i in range(4)
+        ]
+
+        errors = tabular.validate_all(sources, max_workers=2, max_errors=5)
+
+        assert len(errors) == 5
+
+    def test_it_stops_the_files_being_checked_once_it_stops(self):
+        sources = [
+            (str(i), {'source': ('data', 'id,date\n' + 'foo,bar\n' * 10),
+                      'schema': SCHEMA})
+            for i in range(4)
+        ]
+        pool = ThreadPool(1)
+
+        with mock.patch.object(tabular, '_process_pool',
+                               return_value=pool), \
+                mock.patch.object(pool, 'terminate',
+                                  wraps=pool.terminate) as terminate:
+            errors = tabular.validate_all(sources, max_workers=2,
+                                          max_errors=5)
+
+        assert len(errors) == 5
+        terminate.assert_called_once_with()
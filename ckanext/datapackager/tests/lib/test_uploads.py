@@ -0,0 +1,88 @@
+import fcntl
+import os
+import time
+
+import pytest
+import six
+
+import ckanext.datapackager.exceptions as exceptions
+import ckanext.datapackager.lib.uploads as uploads
+
+
+class TestChunkedUpload(object):
+
+    def _read(self, upload):
+        with open(upload.data_path, 'rb') as f:
+            return f.read()
+
+    def test_it_appends_chunks(self):
+        upload = uploads.ChunkedUpload.create('user', size=6)
+
+        assert upload.write(0, six.BytesIO(b'abc')) == 3
+        assert not upload.complete
+        assert upload.write(3, six.BytesIO(b'def')) == 6
+
+        assert self._read(upload) == b'abcdef'
+        assert upload.complete
+        assert uploads.ChunkedUpload.get(upload.id).as_dict() == {
+            'id': upload.id, 'offset': 6, 'size': 6}
+
+    def test_it_rejects_chunks_after_the_end(self):
+        upload = uploads.ChunkedUpload.create('user')
+        upload.write(0, six.BytesIO(b'abc'))
+
+        with pytest.raises(exceptions.InvalidUploadChunkException):
+            upload.write(4, six.BytesIO(b'def'))
+        assert upload.offset == 3
+
+    def test_it_overwrites_chunks_sent_again(self):
+        upload = uploads.ChunkedUpload.create('user')
+        upload.write(0, six.BytesIO(b'abcdef'))
+
+        assert upload.write(3, six.BytesIO(b'x')) == 4
+        assert self._read(upload) == b'abcx'
+
+    def test_it_limits_the_size(self):
+        upload = uploads.ChunkedUpload.create('user')
+        upload.write(0, six.BytesIO(b'abc'))
+
+        with pytest.raises(exceptions.InvalidUploadChunkException):
+            upload.write(3, six.BytesIO(b'defghi'), max_size=5, chunk_size=2)
+        assert self._read(upload) == b'abc'
+
+    def test_it_raises_if_the_upload_doesnt_exist(self):
+        with pytest.raises(exceptions.UploadNotFoundException):
+            uploads.ChunkedUpload.get('0' * 32)
+        with pytest.raises(exceptions.UploadNotFoundException):
+            uploads.ChunkedUpload.get('../../etc')
+
+    def test_its_lock_is_exclusive(self):
+        upload = uploads.ChunkedUpload.create('user')
+
+        with upload.lock():
+            with open(os.path.join(upload.path, 'lock')) as f:
+                with pytest.raises(IOError):
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        with open(os.path.join(upload.path, 'lock')) as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_its_lock_raises_if_the_upload_was_deleted(self):
+        upload = uploads.ChunkedUpload.create('user')
+        upload.delete()
+
+        with pytest.raises(exceptions.UploadNotFoundException):
+            upload.lock()
+
+    def test_it_expires_abandoned_uploads(self):
+        old = uploads.ChunkedUpload.create('user')
+        new = uploads.ChunkedUpload.create('user')
+        an_hour_ago = time.time() - 3600
+        os.utime(old.data_path, (an_hour_ago, an_hour_ago))
+
+        with pytest.raises(exceptions.UploadNotFoundException):
+            uploads.ChunkedUpload.get(old.id, ttl=60)
+        assert uploads.ChunkedUpload.get(new.id, ttl=60)
+
+        os.utime(new.data_path, (an_hour_ago, an_hour_ago))
+        assert uploads.expire(60) >= 1
+        assert not os.path.exists(new.path)
@@ -1,7 +1,15 @@
+import gzip
+import hashlib
+import json
 import os
 import unittest
 
 import pytest
+import six
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 from werkzeug.datastructures import FileStorage
 
 import ckan.tests.factories as factories
@@ -42,3 +50,191 @@ class TestResourceSchemaFieldCreate(unittest.TestCase):
         
         with self.assertRaises(exceptions.ResourceFileDoesNotExistException):
             util.get_path_to_resource_file(resource)
+
+
+class _ZeroFile(object):
+    '''A file-like object of ``size`` zero bytes that is never in memory.'''
+
+    def __init__(self, size):
+        self.remaining = size
+
+    def read(self, size):
+        size = min(size, self.remaining)
+        self.remaining -= size
+        return b'\0' * size
+
+
+@pytest.mark.skipif(six.PY2, reason='tracemalloc requires Python 3')
+class TestCopyInChunks(object):
+
+    def _peak_memory_copying(self, size, chunk_size):
+        import tracemalloc
+
+        with open(os.devnull, 'wb') as target:
+            tracemalloc.start()
+            try:
+                copied = util.copy_in_chunks(
+                    _ZeroFile(size), target, chunk_size)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+        assert copied == size
+        return peak
+
+    def test_copy_in_chunks_memory_is_bounded_by_the_chunk_size(self):
+        chunk_size = 64 * 1024
+        small_peak = self._peak_memory_copying(8 * 2 ** 20, chunk_size)
+        large_peak = self._peak_memory_copying(128 * 2 ** 20, chunk_size)
+
+        assert small_peak < 4 * chunk_size
+        assert large_peak < 4 * chunk_size
+
+    def test_copy_in_chunks_encodes_text(self):
+        target = six.BytesIO()
+        copied = util.copy_in_chunks(six.StringIO(u'd\xe1ta'), target, 2)
+
+        assert target.getvalue() == u'd\xe1ta'.encode('utf-8')
+        assert copied == len(target.getvalue())
+
+
+class TestWriteJSON(object):
+
+    def test_write_json_is_compact_by_default(self):
+        target = six.BytesIO()
+        written = util.write_json({'a': [1, 2]}, target)
+
+        assert target.getvalue() == b'{"a":[1,2]}'
+        assert written == len(target.getvalue())
+
+    def test_write_json_indents(self):
+        data = {'a': [1, {'b': u'\xe1'}]}
+        target = six.BytesIO()
+        util.write_json(data, target, indent=2)
+
+        assert target.getvalue().decode('utf-8') == json.dumps(
+            data, indent=2, separators=(',', ': '))
+
+
+class TestIterJSON(object):
+
+    def test_iter_json_yields_chunks(self):
+        data = {'a': list(range(1000))}
+        chunks = list(util.iter_json(data, chunk_size=100))
+
+        assert len(chunks) > 1
+        assert all(len(chunk) < 200 for chunk in chunks)
+        assert json.loads(b''.join(chunks).decode('utf-8')) == data
+
+
+class TestCompressChunks(object):
+
+    def test_compress_chunks_with_gzip(self):
+        chunks = [b'{"a": ', b'"' + b'x' * 10000 + b'"}']
+        compressed = b''.join(util.compress_chunks(iter(chunks), 'gzip'))
+
+        assert len(compressed) < 1000
+        assert gzip.GzipFile(fileobj=six.BytesIO(compressed)).read() == \
+            b''.join(chunks)
+
+    def test_compress_chunks_rejects_unknown_encodings(self):
+        with pytest.raises(ValueError):
+            list(util.compress_chunks(iter([b'x']), 'compress'))
+
+
+class TestWriteRows(object):
+
+    def test_write_ndjson(self):
+        target = six.BytesIO()
+        written = util.write_ndjson([{'a': 1}, [1, None]], target)
+
+        assert target.getvalue() == b'{"a":1}\n[1,null]\n'
+        assert written == len(target.getvalue())
+
+    def test_write_csv_with_lists(self):
+        target = six.BytesIO()
+        written = util.write_csv(
+            [['a', 'b'], [1, None], [True, u'\xe1,b']], target)
+
+        assert target.getvalue().decode('utf-8') == \
+            u'a,b\n1,\ntrue,"\xe1,b"\n'
+        assert written == len(target.getvalue())
+
+    def test_write_csv_with_dicts(self):
+        target = six.BytesIO()
+        util.write_csv([{'a': 1, 'b': [2]}, {'c': 3}], target,
+                       headers=['a', 'b'])
+
+        assert target.getvalue() == b'a,b\n1,[2]\n,\n'
+
+
+class TestDigestingReader(object):
+
+    def test_it_hashes_the_file_as_its_read(self):
+        reader = util.DigestingReader(
+            six.BytesIO(b'abcdef'), ['md5', 'sha256'])
+
+        while reader.read(4):
+            pass
+
+        assert reader.complete
+        assert reader.size == 6
+        assert reader.hexdigest('md5') == hashlib.md5(b'abcdef').hexdigest()
+        assert reader.hexdigest('sha256') == \
+            hashlib.sha256(b'abcdef').hexdigest()
+
+    def test_rewinding_it_starts_over(self):
+        reader = util.DigestingReader(six.BytesIO(b'abcdef'))
+        reader.read(2)
+        reader.seek(0, os.SEEK_END)
+        assert reader.tell() == 6
+        assert not reader.read()
+        assert not reader.complete
+
+        reader.seek(0)
+        reader.read()
+        reader.read()
+
+        assert reader.complete
+        assert reader.size == 6
+        assert reader.hexdigest('md5') == hashlib.md5(b'abcdef').hexdigest()
+
+
+class TestPlaceFile(object):
+
+    @pytest.mark.parametrize('methods', [
+        ('hardlink',), ('copy_file_range',), ('sendfile',), ('reflink',), (),
+    ])
+    def test_place_file(self, tmpdir, methods):
+        source = tmpdir.join('source')
+        source.write_binary(b'x' * 100000)
+        target = str(tmpdir.join('target'))
+
+        method = util.place_file(str(source), target, methods)
+
+        assert method in methods + ('copy',)
+        with open(target, 'rb') as f:
+            assert f.read() == b'x' * 100000
+        assert sorted(os.listdir(str(tmpdir))) == ['source', 'target']
+
+    def test_place_file_falls_back_to_copying(self, tmpdir):
+        source = tmpdir.join('source')
+        source.write_binary(b'x')
+        target = str(tmpdir.join('target'))
+
+        with mock.patch('os.link', side_effect=OSError):
+            assert util.place_file(str(source), target, ['hardlink']) == \
+                'copy'
+
+    def test_place_file_doesnt_hardlink_by_default(self, tmpdir):
+        source = tmpdir.join('source')
+        source.write_binary(b'x')
+        target = str(tmpdir.join('target'))
+
+        util.place_file(str(source), target)
+
+        assert not os.path.samefile(str(source), target)
+
+    def test_place_file_rejects_unknown_methods(self, tmpdir):
+        with pytest.raises(ValueError):
+            util.place_file('source', 'target', ['teleport'])
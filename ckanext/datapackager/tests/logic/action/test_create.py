@@ -1,5 +1,8 @@
+import hashlib
 import json
+import os
 import tempfile
+import zipfile
 from six import StringIO, BytesIO
 import six
 try:
@@ -12,6 +15,7 @@ import responses
 
 import ckan.tests.helpers as helpers
 import ckanext.datapackager.tests.helpers as custom_helpers
+import ckanext.datapackager.lib.util as custom_util
 import ckan.plugins.toolkit as toolkit
 import ckan.tests.factories as factories
 
@@ -36,6 +40,17 @@ class TestPackageCreateFromDataPackage():
         with pytest.raises(toolkit.ValidationError):
             helpers.call_action('package_create_from_datapackage', url=url)
 
+    @responses.activate
+    def test_it_raises_if_datapackage_cant_be_fetched(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+
+        url = 'http://www.example.com/datapackage.json'
+        responses.add(responses.GET, url, status=404)
+
+        with pytest.raises(toolkit.ValidationError) as e:
+            helpers.call_action('package_create_from_datapackage', url=url)
+        assert 'url' in e.value.error_dict
+
 
     def test_it_raises_if_datapackage_is_unsafe(self):
         datapackage = {
@@ -123,43 +138,132 @@ class TestPackageCreateFromDataPackage():
 
         helpers.call_action('package_show', id=datapackage['name'])
 
-    # TODO: Fix tests with zipped files on CKAN 2.9
-    #def test_it_deletes_dataset_on_error_when_creating_resources(self):
-    #    datapkg_path = custom_helpers.fixture_path(
-    #        'datetimes-datapackage-with-inexistent-resource.zip'
-    #    )
+    def test_it_deletes_dataset_on_error_when_creating_resources(self):
+        datapkg_path = custom_helpers.fixture_path(
+            'datetimes-datapackage-with-inexistent-resource.zip'
+        )
 
-    #    original_datasets = helpers.call_action('package_list')
+        original_datasets = helpers.call_action('package_list')
 
-    #    with open(datapkg_path, 'rb') as datapkg:
-    #
-    #        with pytest.raises(toolkit.ValidationError):
-    #            helpers.call_action('package_create_from_datapackage',
-    #                upload=_UploadFile(datapkg))
+        with open(datapkg_path, 'rb') as datapkg:
+            with pytest.raises(toolkit.ValidationError):
+                helpers.call_action('package_create_from_datapackage',
+                                    upload=_upload(datapkg))
 
-    #    new_datasets = helpers.call_action('package_list')
-    #    assert original_datasets == new_datasets
+        new_datasets = helpers.call_action('package_list')
+        assert original_datasets == new_datasets
 
-    # TODO: Fix tests with zipped files on CKAN 2.9
-    #@responses.activate
-    #def test_it_uploads_local_files(self):
-    #    url = 'http://www.example.com/datapackage.zip'
-    #    datapkg_path = custom_helpers.fixture_path('datetimes-datapackage.zip')
-    #    with open(datapkg_path, 'rb') as f:
-    #        responses.add(responses.GET, url, content_type='application/zip', body=f.read())
+    @responses.activate
+    def test_it_leaves_nothing_behind_if_uploading_a_file_fails(self):
+        import ckan.model as model
 
-    #    # FIXME: Remove this when
-    #    # https://github.com/okfn/datapackage-py/issues/20 is done
-    #    timezones_url = 'https://www.example.com/timezones.csv'
-    #    responses.add(responses.GET, timezones_url, body='')
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        datapackage = {'name': 'foo', 'resources': [
+            {'name': 'the-data', 'data': 'inline data'}]}
+        responses.add(responses.GET, url, json=datapackage)
 
-    #    helpers.call_action('package_create_from_datapackage', url=url)
+        with mock.patch('ckan.lib.uploader.ResourceUpload.upload',
+                        side_effect=IOError('Disk full')):
+            with pytest.raises(IOError):
+                helpers.call_action('package_create_from_datapackage',
+                                    url=url)
 
-    #    dataset = helpers.call_action('package_show', id='datetimes')
-    #    resources = dataset.get('resources')
+        # Not even a deleted dataset
+        assert model.Session.query(model.Package).count() == 0
 
-    #    assert resources[0]['url_type'] == 'upload'
-    #    assert re.match('datetimes.csv$', resources[0]['url'])
+    @responses.activate
+    def test_it_removes_the_files_if_creating_the_dataset_fails(self):
+        import ckan.lib.uploader as uploader
+
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        datapackage = {'name': 'foo', 'resources': [
+            {'name': 'the-data', 'data': 'inline data'}]}
+        responses.add(responses.GET, url, json=datapackage)
+        resource_id = '0c0ffee0-0000-4000-8000-000000000000'
+
+        with mock.patch(
+                'ckanext.datapackager.logic.action.create.uuid.uuid4',
+                return_value=resource_id):
+            with pytest.raises(toolkit.ValidationError):
+                helpers.call_action('package_create_from_datapackage',
+                                    url=url, owner_org='not-an-org')
+
+        path = uploader.get_resource_uploader(
+            {'id': resource_id, 'url_type': 'upload'}).get_path(resource_id)
+        assert not os.path.exists(path)
+
+    def test_it_uploads_files_from_zipped_datapackages(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        datapkg_path = custom_helpers.fixture_path('datetimes-datapackage.zip')
+
+        with open(datapkg_path, 'rb') as datapkg:
+            helpers.call_action('package_create_from_datapackage',
+                                upload=_upload(datapkg))
+
+        dataset = helpers.call_action('package_show', id='datetimes')
+        resources = dataset.get('resources')
+
+        assert resources[0]['url_type'] == 'upload'
+        assert re.search('datetimes.csv$', resources[0]['url'])
+        path = custom_util.get_path_to_resource_file(resources[0])
+        with open(path, 'rb') as uploaded, \
+                custom_helpers.get_csv_file('datetimes.csv') as original:
+            assert uploaded.read() == original.read()
+
+    def test_it_uploads_zipped_resources_by_their_path(self, tmpdir):
+        # The converter turns the resources' path into their url, which
+        # must still be read from the archive instead of linked to.
+        datapkg_path = str(tmpdir.join('datapackage.zip'))
+        with zipfile.ZipFile(datapkg_path, 'w') as z:
+            z.writestr('datapackage.json', json.dumps({
+                'name': 'zipped-by-path',
+                'resources': [
+                    {'name': 'the-data', 'path': 'data/nested/data.csv'},
+                ],
+            }))
+            z.writestr('data/nested/data.csv', 'a,b\n1,2\n')
+
+        with open(datapkg_path, 'rb') as datapkg:
+            helpers.call_action('package_create_from_datapackage',
+                                upload=_upload(datapkg))
+
+        resource = helpers.call_action(
+            'package_show', id='zipped-by-path')['resources'][0]
+        assert resource['url_type'] == 'upload'
+        assert resource['url'].startswith('http')
+        path = custom_util.get_path_to_resource_file(resource)
+        with open(path, 'rb') as uploaded:
+            assert uploaded.read() == b'a,b\n1,2\n'
+
+    def test_it_hashes_zipped_resources_instead_of_using_their_crc(
+            self, tmpdir):
+        datapkg_path = str(tmpdir.join('datapackage.zip'))
+        with zipfile.ZipFile(datapkg_path, 'w') as z:
+            z.writestr('datapackage.json', json.dumps({
+                'name': 'zipped-checksum',
+                'resources': [{'name': 'the-data', 'path': 'data.csv'}],
+            }))
+            z.writestr('data.csv', 'a,b\n1,2\n')
+
+        with open(datapkg_path, 'rb') as datapkg:
+            helpers.call_action('package_create_from_datapackage',
+                                upload=_upload(datapkg))
+
+        resource = helpers.call_action(
+            'package_show', id='zipped-checksum')['resources'][0]
+        assert resource['datapackager_file_checksum'] == \
+            'sha256:' + hashlib.sha256(b'a,b\n1,2\n').hexdigest()
+
+    @pytest.mark.ckan_config('ckanext.datapackager.zip_max_total_size', 0)
+    def test_it_limits_the_size_of_zipped_datapackages(self):
+        datapkg_path = custom_helpers.fixture_path('datetimes-datapackage.zip')
+
+        with open(datapkg_path, 'rb') as datapkg:
+            with pytest.raises(toolkit.ValidationError):
+                helpers.call_action('package_create_from_datapackage',
+                                    upload=_upload(datapkg))
 
     @responses.activate
     def test_it_uploads_resources_with_inline_strings_as_data(self):
@@ -207,6 +311,139 @@ class TestPackageCreateFromDataPackage():
         assert resources[0]['url_type'] == 'upload'
         assert resources[0]['name'] in resources[0]['url']
 
+    @responses.activate
+    @pytest.mark.ckan_config('ckanext.datapackager.upload_workers', 4)
+    def test_it_uploads_resources_concurrently_keeping_their_order(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        datapackage = {
+            'name': 'foo',
+            'resources': [
+                {'name': 'resource-{0}'.format(i), 'data': {'index': i}}
+                for i in range(8)
+            ] + [
+                {'name': 'the-link', 'path': 'http://example.com/some.csv'},
+            ]
+        }
+        responses.add(responses.GET, url, json=datapackage)
+
+        helpers.call_action('package_create_from_datapackage', url=url)
+
+        dataset = helpers.call_action('package_show', id='foo')
+        resources = dataset.get('resources')
+
+        assert [r['name'] for r in resources] == [
+            r['name'] for r in datapackage['resources']]
+        for resource in resources[:-1]:
+            assert resource['url_type'] == 'upload'
+            path = custom_util.get_path_to_resource_file(resource)
+            with open(path) as f:
+                assert json.load(f)['index'] == resources.index(resource)
+
+    @responses.activate
+    def test_it_indexes_the_dataset_only_once(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        datapackage = {
+            'name': 'foo',
+            'resources': [
+                {'name': 'the-data', 'data': 'inline data'},
+                {'name': 'the-link', 'path': 'http://example.com/some.csv'},
+            ]
+        }
+        responses.add(responses.GET, url, json=datapackage)
+
+        index_package = 'ckan.lib.search.index.PackageSearchIndex.index_package'
+        with mock.patch(index_package, autospec=True) as mock_index_package:
+            dataset = helpers.call_action('package_create_from_datapackage',
+                                          url=url)
+
+        assert mock_index_package.call_count == 1
+        assert dataset['state'] == 'active'
+        assert [r['name'] for r in dataset['resources']] == [
+            'the-data', 'the-link']
+        assert dataset['resources'][0]['url_type'] == 'upload'
+
+    @responses.activate
+    def test_it_imports_in_a_background_job(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        datapackage = {
+            'name': 'foo',
+            'resources': [
+                {'name': 'bar',
+                 'path': 'http://example.com/some.csv'}
+            ]
+        }
+        responses.add(responses.GET, url, json=datapackage)
+
+        user = factories.User()
+        context = {'user': user['name'], 'ignore_auth': False}
+        with custom_helpers.in_process_job_queue():
+            job = helpers.call_action('package_create_from_datapackage',
+                                      context=dict(context),
+                                      url=url,
+                                      background=True)
+            status = helpers.call_action(
+                'package_create_from_datapackage_status',
+                context=dict(context),
+                id=job['id'])
+
+        assert status['status'] == 'finished'
+        assert status['error'] is None
+        dataset = helpers.call_action('package_show', id=status['dataset_id'])
+        assert dataset['name'] == 'foo'
+        assert dataset['resources'][0]['name'] == 'bar'
+
+    def test_it_removes_the_spooled_upload_if_the_job_cant_be_enqueued(self):
+        jobs_dir = custom_util.get_working_directory('jobs')
+        before = set(os.listdir(jobs_dir))
+        upload = six.BytesIO(json.dumps({
+            'name': 'foo',
+            'resources': [
+                {'name': 'bar', 'path': 'http://example.com/some.csv'},
+            ],
+        }).encode('utf-8'))
+
+        with mock.patch.object(toolkit, 'enqueue_job',
+                               side_effect=RuntimeError('No Redis')):
+            with pytest.raises(RuntimeError):
+                helpers.call_action('package_create_from_datapackage',
+                                    upload=_upload(upload),
+                                    background=True)
+
+        assert set(os.listdir(jobs_dir)) == before
+
+    @responses.activate
+    @pytest.mark.ckan_config('ckanext.datapackager.inline_data_indent', 0)
+    @pytest.mark.ckan_config('ckanext.datapackager.inline_data_max_memory', 8)
+    def test_it_uploads_inline_data_as_compact_json(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        data = [{'foo': 'bar', 'index': i} for i in range(100)]
+        datapackage = {
+            'name': 'foo',
+            'resources': [
+                {
+                    'name': 'the-resource',
+                    'data': data,
+                }
+            ]
+        }
+        responses.add(responses.GET, url, json=datapackage)
+
+        helpers.call_action('package_create_from_datapackage', url=url)
+
+        dataset = helpers.call_action('package_show', id='foo')
+        resource = dataset['resources'][0]
+        path = custom_util.get_path_to_resource_file(resource)
+        with open(path, 'rb') as f:
+            contents = f.read()
+
+        assert resource['url'].endswith('the-resource.json')
+        assert contents == json.dumps(data, separators=(',', ':')).encode('utf-8')
+        assert resource['size'] == len(contents)
+
     @responses.activate
     def test_it_allows_specifying_the_dataset_name(self):
         responses.add_passthru(toolkit.config['solr_url'])
@@ -243,6 +480,272 @@ class TestPackageCreateFromDataPackage():
                                       url=url)
         assert dataset['name'].startswith('foo')
 
+    @responses.activate
+    def test_it_uses_the_first_free_numeric_suffix(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        datapackage = {'name': 'foo_bar', 'resources': []}
+        responses.add(responses.GET, url, json=datapackage)
+
+        for name in ('foo_bar', 'foo_bar-1', 'foo_bar-3', 'fooxbar-2'):
+            helpers.call_action('package_create', name=name)
+        dataset = helpers.call_action('package_create_from_datapackage',
+                                      url=url)
+        assert dataset['name'] == 'foo_bar-2'
+
+    @responses.activate
+    def test_it_picks_another_name_if_its_taken_meanwhile(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        datapackage = {'name': 'foo', 'resources': []}
+        responses.add(responses.GET, url, json=datapackage)
+
+        helpers.call_action('package_create', name='foo')
+        with mock.patch(
+                'ckanext.datapackager.logic.action.create._free_dataset_name',
+                side_effect=['foo', 'foo-1']):
+            dataset = helpers.call_action('package_create_from_datapackage',
+                                          url=url)
+        assert dataset['name'] == 'foo-1'
+
+    @responses.activate
+    def test_it_stores_the_content_hash_on_the_dataset(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        datapackage = {'name': 'foo', 'resources': [
+            {'name': 'bar', 'data': [{'a': 1}]}]}
+        responses.add(responses.GET, url, json=datapackage)
+
+        first = helpers.call_action('package_create_from_datapackage', url=url)
+        second = helpers.call_action('package_create_from_datapackage', url=url)
+
+        hashes = [
+            dict((e['key'], e['value']) for e in dataset['extras'])
+            ['datapackager_content_hash']
+            for dataset in (first, second)
+        ]
+        assert first['id'] != second['id']
+        assert hashes[0] == hashes[1]
+        assert first['resources'][0]['datapackager_content_hash']
+
+    @responses.activate
+    def test_it_stores_the_size_and_hash_of_uploaded_files(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        responses.add(responses.GET, url, json={'name': 'foo', 'resources': [
+            {'name': 'bar', 'data': 'a,b\n1,2\n'}]})
+
+        dataset = helpers.call_action('package_create_from_datapackage',
+                                      url=url)
+
+        resource = dataset['resources'][0]
+        assert resource['size'] == 8
+        assert resource['hash'] == hashlib.md5(b'a,b\n1,2\n').hexdigest()
+
+    @responses.activate
+    @pytest.mark.ckan_config('ckanext.datapackager.hash_algorithm', 'sha256')
+    def test_it_uses_the_configured_hash_algorithm(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        responses.add(responses.GET, url, json={'name': 'foo', 'resources': [
+            {'name': 'bar', 'data': 'a,b\n1,2\n'}]})
+
+        dataset = helpers.call_action('package_create_from_datapackage',
+                                      url=url)
+
+        assert dataset['resources'][0]['hash'] == \
+            'sha256:' + hashlib.sha256(b'a,b\n1,2\n').hexdigest()
+
+    @responses.activate
+    def test_it_fails_if_the_file_doesnt_match_its_declared_hash(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        responses.add(responses.GET, url, json={'name': 'foo', 'resources': [
+            {'name': 'bar', 'data': 'a,b\n1,2\n',
+             'hash': 'sha256:' + '0' * 64}]})
+
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('package_create_from_datapackage', url=url)
+
+        assert not helpers.call_action('package_list')
+
+    @responses.activate
+    def test_it_fails_if_the_file_doesnt_match_its_declared_bytes(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        responses.add(responses.GET, url, json={'name': 'foo', 'resources': [
+            {'name': 'bar', 'data': 'a,b\n1,2\n', 'bytes': 100}]})
+
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('package_create_from_datapackage', url=url)
+
+    @responses.activate
+    def test_it_infers_the_schema_of_csv_files(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        responses.add(responses.GET, url, json={'name': 'foo', 'resources': [
+            {'name': 'bar', 'format': 'csv', 'data': 'a,b\n1,x\n'}]})
+
+        dataset = helpers.call_action('package_create_from_datapackage',
+                                      url=url)
+
+        schema = dataset['resources'][0]['schema']
+        if isinstance(schema, six.string_types):
+            schema = json.loads(schema)
+        assert [(f['name'], f['type']) for f in schema['fields']] == [
+            ('a', 'integer'), ('b', 'string')]
+
+    @responses.activate
+    def test_it_validates_the_data_if_asked_to(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        responses.add(responses.GET, url, json={'name': 'foo', 'resources': [
+            {'name': 'bar', 'format': 'csv', 'data': 'a\n1\nx\n',
+             'schema': {'fields': [{'name': 'a', 'type': 'integer'}]}}]})
+
+        dataset = helpers.call_action('package_create_from_datapackage',
+                                      url=url)
+        assert dataset['name'] == 'foo'
+
+        with pytest.raises(toolkit.ValidationError) as e:
+            helpers.call_action('package_create_from_datapackage',
+                                url=url, validate_data=True)
+
+        assert 'Resource "bar", row 3' in e.value.error_dict['data'][0]
+
+    @responses.activate
+    @pytest.mark.ckan_config('ckanext.datapackager.inline_data_format', 'csv')
+    def test_it_can_write_inline_data_as_csv(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        responses.add(responses.GET, url, json={'name': 'foo', 'resources': [
+            {'name': 'bar', 'data': [{'a': 1, 'b': 'x'}, {'a': 2}]}]})
+
+        dataset = helpers.call_action('package_create_from_datapackage',
+                                      url=url)
+
+        resource = dataset['resources'][0]
+        assert resource['url'].endswith('/bar.csv')
+        path = custom_util.get_path_to_resource_file(resource)
+        with open(path, 'rb') as f:
+            assert f.read() == b'a,b\n1,x\n2,\n'
+
+    @responses.activate
+    @pytest.mark.ckan_config('ckanext.datapackager.inline_data_max_rows', 2)
+    def test_it_limits_the_rows_of_inline_data(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        responses.add(responses.GET, url, json={'name': 'foo', 'resources': [
+            {'name': 'bar', 'data': [[1], [2], [3]]}]})
+
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('package_create_from_datapackage', url=url)
+
+    @responses.activate
+    @pytest.mark.ckan_config('ckanext.datapackager.inline_data_max_rows', 2)
+    def test_it_only_counts_the_rows_of_resources(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        # The rows look like resources with inline data themselves
+        responses.add(responses.GET, url, json={'name': 'foo', 'resources': [
+            {'name': 'bar', 'data': [
+                {'name': 'a', 'data': [1, 2, 3]},
+                {'name': 'b', 'data': [4, 5, 6]},
+            ]}]})
+
+        dataset = helpers.call_action('package_create_from_datapackage',
+                                      url=url)
+
+        assert dataset['name'] == 'foo'
+
+    def _local_datapackage(self, tmpdir):
+        directory = tmpdir.mkdir('pkg')
+        directory.join('data.csv').write_binary(b'a,b\n1,2\n')
+        directory.join('datapackage.json').write(json.dumps({
+            'name': 'foo',
+            'resources': [{'name': 'bar', 'path': 'data.csv'}],
+        }))
+
+    def test_sysadmins_can_import_local_datapackages(
+            self, tmpdir, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config,
+                            'ckanext.datapackager.local_import_dir',
+                            str(tmpdir))
+        self._local_datapackage(tmpdir)
+        sysadmin = factories.Sysadmin()
+
+        dataset = helpers.call_action(
+            'package_create_from_datapackage',
+            context={'user': sysadmin['name']}, path='pkg/datapackage.json')
+
+        resource = dataset['resources'][0]
+        assert resource['url'].endswith('/data.csv')
+        assert resource['size'] == 8
+        path = custom_util.get_path_to_resource_file(resource)
+        with open(path, 'rb') as f:
+            assert f.read() == b'a,b\n1,2\n'
+
+    def test_other_users_cant_import_local_datapackages(
+            self, tmpdir, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config,
+                            'ckanext.datapackager.local_import_dir',
+                            str(tmpdir))
+        self._local_datapackage(tmpdir)
+        user = factories.User()
+
+        with pytest.raises(toolkit.NotAuthorized):
+            helpers.call_action(
+                'package_create_from_datapackage',
+                context={'user': user['name'], 'ignore_auth': False},
+                path='pkg/datapackage.json')
+
+    def test_local_datapackages_must_be_in_the_import_directory(
+            self, tmpdir, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config,
+                            'ckanext.datapackager.local_import_dir',
+                            str(tmpdir.mkdir('imports')))
+        self._local_datapackage(tmpdir)
+        sysadmin = factories.Sysadmin()
+
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action(
+                'package_create_from_datapackage',
+                context={'user': sysadmin['name']},
+                path='../pkg/datapackage.json')
+
+    @responses.activate
+    def test_it_returns_the_existing_dataset_when_deduplicating(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        datapackage = {'name': 'foo', 'resources': [
+            {'name': 'bar', 'data': [{'a': 1}]}]}
+        responses.add(responses.GET, url, json=datapackage)
+
+        first = helpers.call_action('package_create_from_datapackage',
+                                    url=url, deduplicate=True)
+        with mock.patch('ckan.lib.uploader.ResourceUpload.upload') as upload:
+            second = helpers.call_action('package_create_from_datapackage',
+                                         url=url, deduplicate=True)
+
+        assert second['id'] == first['id']
+        assert not upload.called
+
+    @responses.activate
+    def test_it_doesnt_deduplicate_changed_datapackages(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        url = 'http://www.example.com/datapackage.json'
+        responses.add(responses.GET, url, json={'name': 'foo', 'resources': [
+            {'name': 'bar', 'data': [{'a': 1}]}]})
+        responses.add(responses.GET, url, json={'name': 'foo', 'resources': [
+            {'name': 'bar', 'data': [{'a': 2}]}]})
+
+        first = helpers.call_action('package_create_from_datapackage',
+                                    url=url, deduplicate=True)
+        second = helpers.call_action('package_create_from_datapackage',
+                                     url=url, deduplicate=True)
+
+        assert second['id'] != first['id']
+
     @responses.activate
     def test_it_fails_if_specifying_name_that_already_exists(self):
         responses.add_passthru(toolkit.config['solr_url'])
@@ -305,8 +808,177 @@ class TestPackageCreateFromDataPackage():
             assert dataset['name'] == 'foo'
 
 
+@pytest.mark.ckan_config('ckan.plugins', 'datapackager')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+class TestPackageCreateFromDataPackageBatch():
+
+    @responses.activate
+    def test_it_creates_a_dataset_for_each_datapackage(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        for name in ('foo', 'bar', 'baz'):
+            responses.add(
+                responses.GET,
+                'http://www.example.com/{0}/datapackage.json'.format(name),
+                json={'name': name, 'resources': [
+                    {'name': 'data', 'path': 'http://example.com/some.csv'}]})
+        organization = factories.Organization()
+
+        results = helpers.call_action(
+            'package_create_from_datapackage_batch',
+            owner_org=organization['id'],
+            datapackages=[
+                'http://www.example.com/foo/datapackage.json',
+                {'url': 'http://www.example.com/bar/datapackage.json',
+                 'name': 'bar-renamed'},
+                {'descriptor': {'name': 'qux', 'resources': [
+                    {'name': 'data', 'data': 'inline data'}]}},
+                'http://www.example.com/baz/datapackage.json',
+            ])
+
+        assert [r['success'] for r in results] == [True] * 4
+        assert [r['result']['name'] for r in results] == [
+            'foo', 'bar-renamed', 'qux', 'baz']
+        assert all(r['result']['owner_org'] == organization['id']
+                   for r in results)
+
+    @responses.activate
+    def test_it_reports_errors_for_each_datapackage(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        responses.add(responses.GET, 'http://www.example.com/missing.json',
+                      status=404)
+
+        results = helpers.call_action(
+            'package_create_from_datapackage_batch',
+            datapackages=[
+                'http://www.example.com/missing.json',
+                {'descriptor': {}},
+                {'descriptor': {'name': 'foo', 'resources': [
+                    {'name': 'data', 'data': 'inline data'}]}},
+                42,
+            ])
+
+        assert [r['success'] for r in results] == [False, False, True, False]
+        assert 'url' in results[0]['error']
+        assert 'datapackage' in results[1]['error']
+        assert 'url' in results[3]['error']
+        helpers.call_action('package_show', id='foo')
+
+    @responses.activate
+    def test_a_corrupt_zip_doesnt_stop_the_rest_of_the_batch(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        archive = six.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as z:
+            z.writestr('datapackage.json', json.dumps({
+                'name': 'corrupt', 'resources': []}))
+        # The central directory is intact, the local file header isn't
+        corrupt = b'XXXX' + archive.getvalue()[4:]
+        responses.add(responses.GET, 'http://www.example.com/corrupt.zip',
+                      body=corrupt, content_type='application/zip')
+        for name in ('foo', 'bar'):
+            responses.add(
+                responses.GET,
+                'http://www.example.com/{0}/datapackage.json'.format(name),
+                json={'name': name, 'resources': []})
+
+        results = helpers.call_action(
+            'package_create_from_datapackage_batch',
+            datapackages=[
+                'http://www.example.com/foo/datapackage.json',
+                'http://www.example.com/corrupt.zip',
+                'http://www.example.com/bar/datapackage.json',
+            ])
+
+        assert [r['success'] for r in results] == [True, False, True]
+        assert results[1]['error']
+        helpers.call_action('package_show', id='foo')
+        helpers.call_action('package_show', id='bar')
+
+    @pytest.mark.ckan_config('ckanext.datapackager.batch_max_size', 1)
+    def test_it_limits_the_size_of_the_batch(self):
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action(
+                'package_create_from_datapackage_batch',
+                datapackages=['http://www.example.com/datapackage.json'] * 2)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datapackager')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+class TestChunkedDataPackageUpload():
+
+    def _init(self, user, **kwargs):
+        return helpers.call_action('datapackage_upload_init',
+                                   context={'user': user['name']}, **kwargs)
+
+    def _chunk(self, user, upload, offset, data):
+        return helpers.call_action('datapackage_upload_chunk',
+                                   context={'user': user['name']},
+                                   id=upload['id'], offset=offset,
+                                   upload=_upload(BytesIO(data)))
+
+    def test_it_imports_a_datapackage_sent_in_chunks(self):
+        user = factories.User()
+        with open(custom_helpers.fixture_path('datetimes-datapackage.zip'),
+                  'rb') as f:
+            data = f.read()
+        upload = self._init(user, size=len(data))
+
+        middle = len(data) // 2
+        assert self._chunk(user, upload, 0, data[:middle])['offset'] == middle
+        status = helpers.call_action('datapackage_upload_show',
+                                     context={'user': user['name']},
+                                     id=upload['id'])
+        assert status['offset'] == middle
+        self._chunk(user, upload, middle, data[middle:])
+
+        dataset = helpers.call_action('datapackage_upload_finalize',
+                                      context={'user': user['name']},
+                                      id=upload['id'])
+
+        assert dataset['name'] == 'datetimes'
+        assert dataset['resources'][0]['url_type'] == 'upload'
+        with pytest.raises(toolkit.ObjectNotFound):
+            helpers.call_action('datapackage_upload_show',
+                                context={'user': user['name']},
+                                id=upload['id'])
+
+    def test_it_doesnt_import_incomplete_uploads(self):
+        user = factories.User()
+        upload = self._init(user, size=10)
+        self._chunk(user, upload, 0, b'{}')
+
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('datapackage_upload_finalize',
+                                context={'user': user['name']},
+                                id=upload['id'])
+
+    def test_it_rejects_chunks_that_leave_a_gap(self):
+        user = factories.User()
+        upload = self._init(user)
+
+        with pytest.raises(toolkit.ValidationError):
+            self._chunk(user, upload, 5, b'{}')
+
+    def test_uploads_are_private(self):
+        user = factories.User()
+        other_user = factories.User()
+        upload = self._init(user)
+
+        with pytest.raises(toolkit.NotAuthorized):
+            helpers.call_action('datapackage_upload_chunk',
+                                context={'user': other_user['name'],
+                                         'ignore_auth': False},
+                                id=upload['id'], offset=0,
+                                upload=_upload(BytesIO(b'{}')))
+
+
 class _UploadFile(object):
     '''Mock the parts from cgi.FileStorage we use.'''
 
     def __init__(self, fp):
         self.file = fp
+
+
+def _upload(fp):
+    if toolkit.check_ckan_version(min_version="2.9"):
+        return fp
+    return _UploadFile(fp)
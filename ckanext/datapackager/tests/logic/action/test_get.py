@@ -2,11 +2,15 @@
 
 '''
 
+import json
 import unittest
 import pytest
+import six
 
 import ckan.tests.factories as factories
 import ckan.tests.helpers as helpers
+import ckanext.datapackager.lib.export_cache as export_cache
+import ckanext.datapackager.tests.helpers as custom_helpers
 
 from frictionless_ckan_mapper import ckan_to_frictionless as converter
 import ckan.plugins.toolkit as toolkit
@@ -32,6 +36,113 @@ class TestGet(unittest.TestCase):
 
         assert expected_output == datapackage_dict
 
+    def test_package_show_as_datapackage_leaves_out_content_hashes(self):
+        upload = six.BytesIO(json.dumps({
+            'name': 'foo',
+            'resources': [
+                {'name': 'bar', 'path': 'http://example.com/some.csv'},
+            ],
+        }).encode('utf-8'))
+        if not toolkit.check_ckan_version(min_version="2.9"):
+            upload = custom_helpers.UploadFile(upload)
+        dataset = helpers.call_action('package_create_from_datapackage',
+                                      upload=upload)
+
+        datapackage_dict = helpers.call_action('package_show_as_datapackage',
+                                               id=dataset['id'])
+
+        assert 'datapackager_content_hash' not in datapackage_dict
+        assert 'datapackager_content_hash' not in \
+            datapackage_dict['resources'][0]
+
+    def test_package_show_as_datapackage_is_cached_until_the_dataset_changes(self):
+        export_cache.get_cache().clear()
+        dataset = factories.Dataset(title='Old title')
+
+        helpers.call_action('package_show_as_datapackage', id=dataset['id'])
+        first = helpers.call_action('package_show_as_datapackage',
+                                    id=dataset['name'])
+        helpers.call_action('package_patch', id=dataset['id'],
+                            title='New title')
+        second = helpers.call_action('package_show_as_datapackage',
+                                     id=dataset['id'])
+
+        assert first['title'] == 'Old title'
+        assert second['title'] == 'New title'
+        stats = helpers.call_action('package_show_as_datapackage_cache_stats')
+        assert stats['hits'] == 1
+        assert stats['misses'] == 2
+
+    def test_package_show_as_datapackage_is_invalidated_by_resource_changes(self):
+        dataset = factories.Dataset()
+        resource = factories.Resource(package_id=dataset['id'],
+                                      url='http://test.com/test-url-1')
+
+        helpers.call_action('package_show_as_datapackage', id=dataset['id'])
+        helpers.call_action('resource_delete', id=resource['id'])
+        datapackage_dict = helpers.call_action('package_show_as_datapackage',
+                                               id=dataset['id'])
+
+        assert datapackage_dict.get('resources', []) == []
+
+    def test_package_show_as_datapackage_checks_access_when_cached(self):
+        user = factories.User()
+        org = factories.Organization()
+        dataset = factories.Dataset(owner_org=org['id'], private=True)
+        helpers.call_action('package_show_as_datapackage', id=dataset['id'])
+
+        with self.assertRaises(toolkit.NotAuthorized):
+            helpers.call_action(
+                'package_show_as_datapackage',
+                context={'user': user['name'], 'ignore_auth': False},
+                id=dataset['id'])
+
+    def test_package_show_as_datapackage_cache_stats_is_for_sysadmins(self):
+        user = factories.User()
+
+        with self.assertRaises(toolkit.NotAuthorized):
+            helpers.call_action(
+                'package_show_as_datapackage_cache_stats',
+                context={'user': user['name'], 'ignore_auth': False})
+
     def test_package_show_as_datapackage_with_missing_id(self):
         with self.assertRaises(toolkit.ValidationError):
             helpers.call_action('package_show_as_datapackage')
+
+    def test_package_create_from_datapackage_status_is_private(self):
+        owner = factories.User()
+        other_user = factories.User()
+        upload = six.BytesIO(json.dumps({
+            'name': 'foo',
+            'resources': [
+                {'name': 'bar', 'path': 'http://example.com/some.csv'},
+            ],
+        }).encode('utf-8'))
+        if not toolkit.check_ckan_version(min_version="2.9"):
+            upload = custom_helpers.UploadFile(upload)
+
+        with custom_helpers.in_process_job_queue():
+            job = helpers.call_action(
+                'package_create_from_datapackage',
+                context={'user': owner['name'], 'ignore_auth': False},
+                upload=upload,
+                background=True)
+
+            with self.assertRaises(toolkit.NotAuthorized):
+                helpers.call_action(
+                    'package_create_from_datapackage_status',
+                    context={'user': other_user['name'], 'ignore_auth': False},
+                    id=job['id'])
+
+            status = helpers.call_action(
+                'package_create_from_datapackage_status',
+                context={'user': owner['name'], 'ignore_auth': False},
+                id=job['id'])
+
+        assert status['status'] == 'finished'
+
+    def test_package_create_from_datapackage_status_with_missing_job(self):
+        with custom_helpers.in_process_job_queue():
+            with self.assertRaises(toolkit.ObjectNotFound):
+                helpers.call_action('package_create_from_datapackage_status',
+                                    id='not-a-job')
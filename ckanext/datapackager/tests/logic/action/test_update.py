@@ -0,0 +1,192 @@
+'''Functional tests for logic/action/update.py.
+
+'''
+import hashlib
+import os
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import pytest
+import responses
+
+import ckan.tests.helpers as helpers
+import ckan.plugins.toolkit as toolkit
+
+URL = 'http://www.example.com/datapackage.json'
+
+
+def _import(datapackage):
+    responses.add(responses.GET, URL, json=datapackage)
+    return helpers.call_action('package_create_from_datapackage', url=URL)
+
+
+def _update(dataset, datapackage, **kwargs):
+    import ckan.lib.uploader as uploader
+
+    responses.add(responses.GET, URL, json=datapackage)
+    with mock.patch.object(uploader.ResourceUpload, 'upload', autospec=True,
+                           side_effect=uploader.ResourceUpload.upload) \
+            as upload:
+        dataset = helpers.call_action('package_update_from_datapackage',
+                                      id=dataset['id'], url=URL, **kwargs)
+    return dataset, upload
+
+
+class _UploadWithoutPath(object):
+    '''A FileStore uploader that can write files but not tell where they
+    are, like the ones that keep them somewhere else.
+
+    '''
+
+    def __init__(self, upload):
+        self._upload = upload
+        self.filesize = getattr(upload, 'filesize', 0)
+        self.mimetype = getattr(upload, 'mimetype', None)
+
+    def upload(self, resource_id, max_size):
+        return self._upload.upload(resource_id, max_size)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'datapackager')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+class TestPackageUpdateFromDataPackage(object):
+
+    def setup_method(self):
+        self.datapackage = {
+            'name': 'foo',
+            'title': 'Foo',
+            'resources': [
+                {'name': 'first', 'data': 'first version'},
+                {'name': 'second', 'data': 'second version'},
+                {'name': 'link', 'path': 'http://www.example.com/data.csv'},
+            ],
+        }
+
+    @responses.activate
+    def test_it_does_nothing_if_the_datapackage_didnt_change(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        dataset = _import(self.datapackage)
+
+        updated, upload = _update(dataset, self.datapackage)
+
+        assert not upload.called
+        assert updated['metadata_modified'] == dataset['metadata_modified']
+
+    @responses.activate
+    def test_it_only_uploads_the_files_that_changed(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        dataset = _import(self.datapackage)
+        resource_ids = dict((r['name'], r['id']) for r in dataset['resources'])
+
+        self.datapackage['title'] = 'New Foo'
+        self.datapackage['resources'] = [
+            {'name': 'first', 'data': 'first version'},
+            {'name': 'second', 'data': 'third version'},
+            {'name': 'new', 'data': 'new data'},
+        ]
+        updated, upload = _update(dataset, self.datapackage)
+
+        assert updated['id'] == dataset['id']
+        assert updated['name'] == dataset['name']
+        assert updated['title'] == 'New Foo'
+        assert [r['name'] for r in updated['resources']] == [
+            'first', 'second', 'new']
+        resources = dict((r['name'], r) for r in updated['resources'])
+        assert resources['first']['id'] == resource_ids['first']
+        assert resources['second']['id'] == resource_ids['second']
+        assert resources['new']['id'] not in resource_ids.values()
+        # The new file for "second" and the one for "new"
+        assert upload.call_count == 2
+
+    @responses.activate
+    def test_it_keeps_the_files_of_resources_whose_metadata_changed(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        dataset = _import(self.datapackage)
+
+        self.datapackage['resources'][0]['description'] = 'The first one'
+        updated, upload = _update(dataset, self.datapackage)
+
+        assert not upload.called
+        resource = updated['resources'][0]
+        assert resource['description'] == 'The first one'
+        assert resource['url'] == dataset['resources'][0]['url']
+        assert resource['hash'] == dataset['resources'][0]['hash']
+
+    @responses.activate
+    def test_it_deletes_the_files_of_deleted_resources(self):
+        import ckan.lib.uploader as uploader
+
+        responses.add_passthru(toolkit.config['solr_url'])
+        dataset = _import(self.datapackage)
+        resource = dataset['resources'][1]
+        path = uploader.get_resource_uploader(resource).get_path(
+            resource['id'])
+        assert os.path.exists(path)
+
+        del self.datapackage['resources'][1]
+        _update(dataset, self.datapackage)
+
+        assert not os.path.exists(path)
+
+    @responses.activate
+    def test_it_can_rename_the_dataset(self):
+        responses.add_passthru(toolkit.config['solr_url'])
+        dataset = _import(self.datapackage)
+
+        updated, _ = _update(dataset, self.datapackage, name='bar')
+
+        assert updated['name'] == 'bar'
+
+    def test_it_requires_an_id(self):
+        with pytest.raises(toolkit.ValidationError):
+            helpers.call_action('package_update_from_datapackage', url=URL)
+
+    @responses.activate
+    def test_it_keeps_the_current_files_if_the_update_fails(self):
+        import ckan.lib.uploader as uploader
+        from ckanext.datapackager.logic.action import update
+
+        responses.add_passthru(toolkit.config['solr_url'])
+        dataset = _import(self.datapackage)
+        resource = dataset['resources'][1]
+        path = uploader.get_resource_uploader(resource).get_path(
+            resource['id'])
+
+        self.datapackage['resources'][1]['data'] = 'third version'
+        get_resource_uploader = uploader.get_resource_uploader
+        with mock.patch.object(
+                uploader, 'get_resource_uploader',
+                side_effect=lambda r: _UploadWithoutPath(
+                    get_resource_uploader(r))), \
+                mock.patch.object(
+                    update, '_package_update_in_transaction',
+                    side_effect=toolkit.ValidationError({'name': ['Oops']})):
+            with pytest.raises(toolkit.ValidationError):
+                _update(dataset, self.datapackage)
+
+        with open(path, 'rb') as f:
+            assert f.read() == b'second version'
+
+    @responses.activate
+    def test_it_saves_the_size_and_hash_of_files_written_afterwards(self):
+        import ckan.lib.uploader as uploader
+
+        responses.add_passthru(toolkit.config['solr_url'])
+        dataset = _import(self.datapackage)
+
+        self.datapackage['resources'][1]['data'] = 'the third version'
+        get_resource_uploader = uploader.get_resource_uploader
+        with mock.patch.object(
+                uploader, 'get_resource_uploader',
+                side_effect=lambda r: _UploadWithoutPath(
+                    get_resource_uploader(r))):
+            updated, _ = _update(dataset, self.datapackage)
+
+        resource = helpers.call_action(
+            'resource_show', id=updated['resources'][1]['id'])
+        assert resource['size'] == len('the third version')
+        assert resource['hash'] == hashlib.md5(
+            b'the third version').hexdigest()